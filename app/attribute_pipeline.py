@@ -0,0 +1,165 @@
+import os
+import logging
+import numpy as np
+import cv2
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import List, Tuple, Dict, Optional
+from app.embedding_cache import EmbeddingCache, image_digest, package_version
+
+# Имя модели в ключе кэша атрибутов
+DEEPFACE_AGE_GENDER_MODEL = 'deepface.analyze/age,gender'
+
+# Коды пола в массивах атрибутов
+UNKNOWN_GENDER = -1
+MALE = 0
+FEMALE = 1
+
+# DeepFace загружается один раз в каждом процессе пула
+_deepface = None
+
+
+def _analyze_batch(images: List[bytes]) -> List[Optional[Dict]]:
+    """
+    Выполняется в процессе пула: декодирует пачку изображений и прогоняет
+    ее через модели возраста и пола DeepFace. Для изображений, которые не
+    удалось проанализировать, возвращает None
+    """
+    global _deepface
+    if _deepface is None:
+        from deepface import DeepFace
+        _deepface = DeepFace
+
+    decoded = [cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+               for data in images]
+    valid = [i for i, img in enumerate(decoded) if img is not None]
+    results: List[Optional[Dict]] = [None] * len(images)
+    if not valid:
+        return results
+
+    try:
+        # Новые версии DeepFace принимают список изображений и считают его одной пачкой
+        analyzed = _deepface.analyze([decoded[i] for i in valid], actions=['age', 'gender'],
+                                     enforce_detection=False, silent=True)
+    except (TypeError, ValueError):
+        analyzed = []
+        for i in valid:
+            try:
+                analyzed.append(_deepface.analyze(decoded[i], actions=['age', 'gender'],
+                                                  enforce_detection=False, silent=True))
+            except ValueError:
+                analyzed.append([])
+
+    for i, faces in zip(valid, analyzed):
+        if not faces:
+            continue
+        face = faces[0]
+        gender_scores = face['gender']
+        results[i] = {
+            'gender': FEMALE if face['dominant_gender'] == 'Woman' else MALE,
+            'gender_confidence': max(gender_scores.values()) / 100.0,
+            'age': float(face['age'])
+        }
+    return results
+
+
+class AttributePipeline:
+    """
+    Пакетное извлечение пола и возраста через модели DeepFace.
+
+    Изображения читаются в основном процессе, их SHA-256 ищутся в
+    постоянном кэше атрибутов одним запросом на чанк, а промахи пачками по
+    batch_size отправляются в пул процессов, где модели загружены один раз.
+    Результат — массивы NumPy, выровненные с входным списком путей:
+    пол (UNKNOWN_GENDER, если не определен), уверенность в поле и возраст
+    (NaN, если не определен).
+    """
+
+    def __init__(self, cache: Optional[EmbeddingCache] = None, batch_size: int = 32,
+                 num_workers: Optional[int] = None, chunk_size: int = 4096):
+        self.cache = cache or EmbeddingCache()
+        self.batch_size = batch_size
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.version = package_version('deepface')
+        self.logger = logging.getLogger(__name__)
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        """Пул создается при первом промахе кэша и переиспользуется"""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.num_workers)
+        return self._executor
+
+    @staticmethod
+    def _read(path: str) -> Optional[bytes]:
+        try:
+            with open(path, 'rb') as image_file:
+                return image_file.read()
+        except OSError:
+            return None
+
+    def analyze(self, paths: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Возвращает массивы (пол int8, уверенность float32, возраст float32) для путей"""
+        genders = np.full(len(paths), UNKNOWN_GENDER, dtype=np.int8)
+        confidences = np.zeros(len(paths), dtype=np.float32)
+        ages = np.full(len(paths), np.nan, dtype=np.float32)
+
+        def store(rows: List[int], attributes: Optional[Dict]) -> None:
+            if attributes:
+                genders[rows] = attributes['gender']
+                confidences[rows] = attributes['gender_confidence']
+                ages[rows] = attributes['age']
+
+        # Пачки в работе: future -> (SHA-256, строки результата для каждого изображения)
+        pending = {}
+        max_pending = 2 * self.num_workers
+
+        def collect(futures) -> None:
+            entries = []
+            for future in futures:
+                digests, rows = pending.pop(future)
+                try:
+                    batch = future.result()
+                except Exception as e:
+                    self.logger.error(f"Ошибка при анализе пачки изображений: {e}")
+                    continue
+                for digest, row_group, attributes in zip(digests, rows, batch):
+                    store(row_group, attributes)
+                    entries.append((digest, None, attributes))
+            self.cache.put_many(entries, DEEPFACE_AGE_GENDER_MODEL, self.version)
+
+        for start in range(0, len(paths), self.chunk_size):
+            # Одинаковые изображения внутри чанка анализируются один раз
+            groups: Dict[str, List[int]] = {}
+            images: Dict[str, bytes] = {}
+            for row in range(start, min(start + self.chunk_size, len(paths))):
+                data = self._read(paths[row])
+                if data is None:
+                    continue
+                digest = image_digest(data)
+                groups.setdefault(digest, []).append(row)
+                images[digest] = data
+
+            cached = self.cache.get_many(list(groups), DEEPFACE_AGE_GENDER_MODEL, self.version)
+            for digest, (_, attributes) in cached.items():
+                store(groups[digest], attributes)
+
+            missing = [digest for digest in groups if digest not in cached]
+            for batch_start in range(0, len(missing), self.batch_size):
+                digests = missing[batch_start:batch_start + self.batch_size]
+                # Ограничиваем число пачек в работе, чтобы не держать в памяти все изображения
+                while len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                future = self._pool().submit(_analyze_batch, [images[d] for d in digests])
+                pending[future] = (digests, [groups[d] for d in digests])
+
+        if pending:
+            collect(list(pending))
+        return genders, confidences, ages
+
+    def close(self) -> None:
+        """Останавливает пул процессов"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -42,10 +42,10 @@ class Benchmark:
             # Очищаем предыдущие данные
             self.processor.clear_database()
             
-            # Добавляем тестовые данные в базу
-            for i in range(size):
-                face = cv2.imread(f'test_data/face_{i}.jpg', cv2.IMREAD_GRAYSCALE)
-                self.processor.add_face(face, f"user_{i}")
+            # Добавляем тестовые данные в базу одной транзакцией
+            self.processor.add_faces_bulk(
+                (cv2.imread(f'test_data/face_{i}.jpg', cv2.IMREAD_GRAYSCALE), f"user_{i}")
+                for i in range(size))
                 
             # Измеряем время запросов
             query_times = []
@@ -0,0 +1,449 @@
+import numpy as np
+from itertools import combinations
+from typing import List, Tuple, Optional, Dict
+import threading
+from app.search_index import SearchIndex
+
+# Версия формата файла, в который сохраняется бинарный индекс
+BINARY_INDEX_FORMAT_VERSION = 1
+# Длина подстроки кода в таблицах multi-index hashing, бит
+SUBSTRING_BITS = 16
+
+# Число единичных битов в каждом байте — для popcount без np.bitwise_count
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """Число единичных битов в каждом элементе массива uint64"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    # NumPy < 2.0: таблица по байтам
+    octets = np.ascontiguousarray(words).view(np.uint8).reshape(*np.shape(words), 8)
+    return _POPCOUNT_TABLE[octets].sum(axis=-1, dtype=np.uint8)
+
+
+def hamming_distances(query_code: np.ndarray, codes: np.ndarray) -> np.ndarray:
+    """
+    Расстояния Хэмминга от кода запроса (W,) до кодов (N, W): XOR и popcount
+    по одному слову за раз, без промежуточной матрицы (N, W)
+    """
+    dists = np.zeros(len(codes), dtype=np.int32)
+    for word in range(codes.shape[1]):
+        dists += popcount(codes[:, word] ^ query_code[word])
+    return dists
+
+
+def _flip_masks(radius: int) -> np.ndarray:
+    """Все маски подстроки, в которых ровно radius единичных битов"""
+    masks = [sum(1 << bit for bit in bits) for bits in combinations(range(SUBSTRING_BITS), radius)]
+    return np.array(masks, dtype=np.uint16)
+
+
+def _gather_ranges(order: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Склеивает срезы order[start:end] для всех пар без цикла Python"""
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.empty(0, dtype=order.dtype)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return order[offsets + np.arange(total)]
+
+
+class BinaryEncoder:
+    """
+    Кодирование векторов в двоичные коды по num_bits бит, упакованные в uint64.
+
+    SimHash: бит — знак проекции центрированного вектора на случайную
+    гиперплоскость; доля различающихся битов оценивает угол между векторами.
+    При itq_iters > 0 вместо случайных гиперплоскостей берутся главные
+    компоненты, повернутые итеративным квантованием (ITQ) так, чтобы
+    квантование знаком теряло меньше информации. ITQ требует num_bits не
+    больше размерности векторов.
+    """
+
+    def __init__(self, num_bits: int = 128, itq_iters: int = 0,
+                 train_size: int = 65536, seed: int = 0):
+        if num_bits % 64:
+            raise ValueError("Коды хранятся в uint64: num_bits должно делиться на 64")
+        self.num_bits = num_bits
+        self.itq_iters = itq_iters
+        self.train_size = train_size
+        self.seed = seed
+        self.mean: Optional[np.ndarray] = None
+        # Матрица проекции (D, num_bits)
+        self.projection: Optional[np.ndarray] = None
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.projection is not None
+
+    @property
+    def num_words(self) -> int:
+        """Размер кода одного лица в словах uint64"""
+        return self.num_bits // 64
+
+    @property
+    def code_size(self) -> int:
+        """Размер кода одного лица в байтах"""
+        return self.num_bits // 8
+
+    @property
+    def nbytes(self) -> int:
+        return self.projection.nbytes + self.mean.nbytes if self.is_fitted else 0
+
+    def fit(self, vectors: np.ndarray) -> 'BinaryEncoder':
+        """Обучает центрирование и гиперплоскости (и поворот ITQ) на векторах (N, D)"""
+        rng = np.random.default_rng(self.seed)
+        vectors = np.reshape(vectors, (len(vectors), -1)).astype(np.float32)
+        if len(vectors) > self.train_size:
+            vectors = vectors[rng.choice(len(vectors), self.train_size, replace=False)]
+        self.mean = vectors.mean(axis=0)
+        centered = vectors - self.mean
+        dimension = centered.shape[1]
+
+        if not self.itq_iters:
+            self.projection = rng.normal(size=(dimension, self.num_bits)).astype(np.float32)
+            return self
+
+        if self.num_bits > dimension:
+            raise ValueError(f"ITQ требует num_bits не больше размерности {dimension}")
+        # Главные компоненты и случайный начальный поворот
+        _, _, vt = np.linalg.svd(centered, full_matrices=False)
+        pca = vt[:self.num_bits].T
+        projected = centered @ pca
+        rotation, _ = np.linalg.qr(rng.normal(size=(self.num_bits, self.num_bits)))
+        for _ in range(self.itq_iters):
+            # При фиксированных кодах B лучший поворот — из SVD матрицы V^T B
+            codes = np.where(projected @ rotation >= 0, 1.0, -1.0)
+            u, _, wt = np.linalg.svd(projected.T @ codes)
+            rotation = u @ wt
+        self.projection = np.ascontiguousarray(pca @ rotation, dtype=np.float32)
+        return self
+
+    def encode(self, vectors: np.ndarray, block_size: int = 65536) -> np.ndarray:
+        """Кодирует векторы (N, D) в коды (N, num_words) uint64"""
+        if not self.is_fitted:
+            raise RuntimeError("Бинарный кодировщик не обучен")
+        vectors = np.reshape(vectors, (len(vectors), -1))
+        codes = np.empty((len(vectors), self.num_words), dtype=np.uint64)
+        for start in range(0, len(vectors), block_size):
+            bits = (vectors[start:start + block_size] - self.mean) @ self.projection > 0
+            codes[start:start + block_size] = np.packbits(bits, axis=1).view(np.uint64)
+        return codes
+
+    def save(self, filepath: str) -> None:
+        """Сохраняет центрирование и проекцию в файл .npz"""
+        # Через открытый файл: иначе np.savez допишет к пути расширение .npz
+        with open(filepath, 'wb') as f:
+            np.savez(f, mean=self.mean, projection=self.projection)
+
+    def load(self, filepath: str) -> None:
+        """Загружает центрирование и проекцию из файла .npz"""
+        with np.load(filepath) as data:
+            self.mean = data['mean']
+            self.projection = data['projection']
+        self.num_bits = self.projection.shape[1]
+
+
+class MultiIndexHash:
+    """
+    Multi-index hashing: код делится на подстроки по SUBSTRING_BITS бит,
+    для каждой подстроки строки индекса отсортированы по ее значению.
+    Если код отличается от запроса не больше чем на r бит, то хотя бы одна
+    из m подстрок отличается не больше чем на r // m бит, поэтому поиск
+    перебирает только значения подстрок в малом радиусе от запроса и
+    считает полные расстояния лишь для найденных строк.
+    """
+
+    def __init__(self, codes: np.ndarray):
+        substrings = np.ascontiguousarray(codes).view(np.uint16)
+        self.num_substrings = substrings.shape[1]
+        self.orders = []
+        self.sorted_values = []
+        for j in range(self.num_substrings):
+            order = np.argsort(substrings[:, j], kind='stable')
+            self.orders.append(order)
+            self.sorted_values.append(substrings[order, j])
+
+    def probe(self, query_code: np.ndarray, masks: np.ndarray) -> np.ndarray:
+        """Строки, у которых какая-либо подстрока равна подстроке запроса XOR маска"""
+        query_substrings = np.ascontiguousarray(query_code).view(np.uint16)
+        found = []
+        for j in range(self.num_substrings):
+            values = query_substrings[j] ^ masks
+            starts = np.searchsorted(self.sorted_values[j], values, side='left')
+            ends = np.searchsorted(self.sorted_values[j], values, side='right')
+            found.append(_gather_ranges(self.orders[j], starts, ends))
+        return np.unique(np.concatenate(found))
+
+
+class BinaryHashIndex(SearchIndex):
+    """
+    Индекс на двоичных кодах для дешевого первого прохода.
+
+    Лицо хранится кодом по num_bits / 8 байт; кандидаты отбираются по
+    расстоянию Хэмминга (XOR и popcount по словам uint64) полным
+    просмотром или через multi-index hashing (use_mih). При rerank=True
+    индекс хранит и нормированные векторы, а rerank_factor * k лучших по
+    Хэммингу кандидатов переупорядочиваются по точному расстоянию; иначе
+    расстояние оценивается по доле различающихся битов.
+
+    Пока кодировщик не обучен, лица хранятся как есть и просматриваются
+    точно; набрав train_threshold лиц, индекс обучает кодировщик на них.
+    Новые лица попадают в таблицы MIH при перестройке, до нее — в хвост,
+    который просматривается полностью.
+    """
+
+    def __init__(self, encoder: Optional[BinaryEncoder] = None, use_mih: bool = True,
+                 rerank: bool = True, rerank_factor: int = 10, max_probe_radius: int = 2,
+                 train_threshold: int = 1024):
+        self.encoder = encoder or BinaryEncoder()
+        self.use_mih = use_mih
+        self.rerank = rerank
+        self.rerank_factor = rerank_factor
+        self.max_probe_radius = max_probe_radius
+        self.train_threshold = train_threshold
+        self._masks = [_flip_masks(radius) for radius in range(max_probe_radius + 1)]
+        self._lock = threading.RLock()
+        self.clear()
+
+    @property
+    def size(self) -> int:
+        return self._num_alive + len(self._pending_ids)
+
+    @property
+    def nbytes(self) -> int:
+        pending = sum(points.nbytes for points in self._pending_points)
+        tables = 0
+        if self._mih is not None:
+            tables = sum(order.nbytes + values.nbytes for order, values
+                         in zip(self._mih.orders, self._mih.sorted_values))
+        return (self._codes[:self._count].nbytes + self._points[:self._count].nbytes +
+                self.encoder.nbytes + tables + pending)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.dimension = 0
+            self._codes = np.empty((0, self.encoder.num_words), dtype=np.uint64)
+            self._points = np.empty((0, 0), dtype=np.float32)
+            self._user_ids: List[str] = []
+            self._alive = np.empty(0, dtype=bool)
+            self._count = 0
+            self._num_alive = 0
+            self._mih: Optional[MultiIndexHash] = None
+            self._mih_count = 0
+            # Лица, добавленные до обучения кодировщика
+            self._pending_points: List[np.ndarray] = []
+            self._pending_ids: List[str] = []
+
+    def build_from_matrix(self, vectors: np.ndarray, user_ids: List[str]) -> None:
+        """Строит индекс; кодировщик обучается на этих же векторах, если еще не обучен"""
+        if len(vectors) == 0:
+            return
+
+        points = self._normalize(np.reshape(vectors, (len(vectors), -1)))
+        with self._lock:
+            self.clear()
+            if not self.encoder.is_fitted:
+                self.encoder.fit(points)
+            self._append(points, user_ids)
+            self._rebuild_mih()
+
+    def _append(self, points: np.ndarray, user_ids: List[str]) -> None:
+        """Кодирует и дописывает лица, увеличивая массивы удвоением"""
+        codes = self.encoder.encode(points)
+        needed = self._count + len(codes)
+        if needed > len(self._codes):
+            capacity = max(64, 2 * self._count, needed)
+            grown = np.empty((capacity, codes.shape[1]), dtype=np.uint64)
+            grown_points = np.empty((capacity if self.rerank else 0, points.shape[1]),
+                                    dtype=np.float32)
+            if self._count:
+                grown[:self._count] = self._codes[:self._count]
+                if self.rerank:
+                    grown_points[:self._count] = self._points[:self._count]
+            self._codes = grown
+            self._points = grown_points
+            alive = np.zeros(capacity, dtype=bool)
+            alive[:self._count] = self._alive[:self._count]
+            self._alive = alive
+
+        self._codes[self._count:needed] = codes
+        if self.rerank:
+            self._points[self._count:needed] = points
+        self._alive[self._count:needed] = True
+        self._user_ids.extend(user_ids)
+        self._count = needed
+        self._num_alive += len(codes)
+        self.dimension = points.shape[1]
+
+    def _rebuild_mih(self) -> None:
+        """Перестраивает таблицы MIH по всем кодам"""
+        if self.use_mih and self._count:
+            self._mih = MultiIndexHash(self._codes[:self._count])
+            self._mih_count = self._count
+
+    def insert_batch(self, vectors: np.ndarray, user_ids: List[str]) -> None:
+        """Добавляет пачку лиц: кодирует их или, до обучения кодировщика, откладывает"""
+        if len(vectors) == 0:
+            return
+        points = self._normalize(np.reshape(vectors, (len(vectors), -1)))
+        with self._lock:
+            if not self.encoder.is_fitted:
+                self._pending_points.append(points)
+                self._pending_ids.extend(user_ids)
+                self.dimension = points.shape[1]
+                if len(self._pending_ids) < self.train_threshold:
+                    return
+                points = np.concatenate(self._pending_points)
+                user_ids = self._pending_ids
+                self._pending_points, self._pending_ids = [], []
+                self.encoder.fit(points)
+
+            self._append(points, user_ids)
+            # Хвост вне таблиц просматривается полностью, поэтому держим его малым
+            if self._count - self._mih_count > max(1024, self._mih_count // 10):
+                self._rebuild_mih()
+
+    def remove(self, user_id: str) -> int:
+        with self._lock:
+            hits = [i for i, uid in enumerate(self._user_ids) if uid == user_id and self._alive[i]]
+            self._alive[hits] = False
+            self._num_alive -= len(hits)
+
+            keep = [uid != user_id for uid in self._pending_ids]
+            if not all(keep):
+                self._pending_points = [np.concatenate(self._pending_points)[keep]]
+                self._pending_ids = [uid for uid in self._pending_ids if uid != user_id]
+            return len(hits) + len(keep) - len(self._pending_ids)
+
+    def _hamming_knn(self, query_code: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        k ближайших живых кодов по Хэммингу: расстояния и позиции,
+        упорядоченные по возрастанию расстояния
+        """
+        count = self._count
+        alive = self._alive[:count]
+        if self._mih is not None:
+            # Хвост, не попавший в таблицы, просматривается полностью
+            tail = np.arange(self._mih_count, count)
+            m = self._mih.num_substrings
+            seen = np.empty(0, dtype=np.int64)
+            for radius in range(self.max_probe_radius + 1):
+                found = self._mih.probe(query_code, self._masks[radius])
+                seen = np.union1d(seen, found)
+                candidates = np.concatenate((seen, tail))
+                candidates = candidates[alive[candidates]]
+                dists = hamming_distances(query_code, self._codes[candidates])
+                # Все коды на расстоянии до m * (radius + 1) - 1 уже найдены
+                if np.count_nonzero(dists < m * (radius + 1)) >= k:
+                    return self._top(dists, candidates, k)
+
+        # Полный просмотр: без MIH или если радиуса перебора не хватило
+        candidates = np.flatnonzero(alive)
+        return self._top(hamming_distances(query_code, self._codes[candidates]), candidates, k)
+
+    @staticmethod
+    def _top(dists: np.ndarray, positions: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        k = min(k, len(dists))
+        if k == 0:
+            return dists[:0], positions[:0]
+        top = np.argpartition(dists, k - 1)[:k]
+        top = top[np.argsort(dists[top], kind='stable')]
+        return dists[top], positions[top]
+
+    def query_hamming(self, target: np.ndarray, k: int = 100) -> List[Tuple[str, int]]:
+        """Первый проход: k ближайших лиц по расстоянию Хэмминга между кодами"""
+        query = self._normalize(np.ravel(target))
+        with self._lock:
+            if not self._num_alive or k <= 0:
+                return []
+            dists, positions = self._hamming_knn(self.encoder.encode(query[None, :])[0], k)
+            return [(self._user_ids[pos], int(dist)) for dist, pos in zip(dists, positions)]
+
+    def query_knn(self, target: np.ndarray, k: int = 5) -> List[Tuple[str, float]]:
+        query = self._normalize(np.ravel(target))
+        with self._lock:
+            if self.size == 0 or k <= 0:
+                return []
+            dists = np.empty(0, dtype=np.float32)
+            ids: List[str] = []
+            if self._num_alive:
+                num_candidates = k * self.rerank_factor if self.rerank else k
+                hamming, positions = self._hamming_knn(
+                    self.encoder.encode(query[None, :])[0], num_candidates)
+                if self.rerank:
+                    dists = np.maximum(2.0 - 2.0 * (self._points[positions] @ query), 0.0)
+                else:
+                    # Доля различающихся битов SimHash оценивает угол между векторами
+                    angles = np.pi * hamming / self.encoder.num_bits
+                    dists = (2.0 - 2.0 * np.cos(angles)).astype(np.float32)
+                ids = [self._user_ids[pos] for pos in positions]
+            if self._pending_ids:
+                # Отложенные лица просматриваются точно
+                pending = np.concatenate(self._pending_points)
+                dists = np.concatenate((dists, np.maximum(2.0 - 2.0 * (pending @ query), 0.0)))
+                ids = ids + self._pending_ids
+
+            k = min(k, len(dists))
+            top = np.argpartition(dists, k - 1)[:k]
+            top = top[np.argsort(dists[top])]
+            return [(ids[i], float(np.sqrt(dists[i]))) for i in top]
+
+    def stats(self) -> Dict[str, int]:
+        """Размер кода и число лиц в таблицах MIH и в хвосте"""
+        return {
+            'num_bits': self.encoder.num_bits,
+            'code_bytes': self.encoder.code_size,
+            'indexed': self._mih_count,
+            'tail': self._count - self._mih_count
+        }
+
+    def save(self, filepath: str) -> None:
+        """Сохраняет кодировщик, коды и (при rerank) векторы в файл .npz"""
+        with self._lock:
+            if self._pending_ids:
+                points = np.concatenate(self._pending_points)
+                if not self.encoder.is_fitted:
+                    self.encoder.fit(points)
+                self._append(points, self._pending_ids)
+                self._pending_points, self._pending_ids = [], []
+            alive = self._alive[:self._count]
+            # Пустой индекс без обученного кодировщика сохраняется с пустой проекцией
+            fitted = self.encoder.is_fitted
+            with open(filepath, 'wb') as f:
+                np.savez(f, version=BINARY_INDEX_FORMAT_VERSION,
+                         mean=self.encoder.mean if fitted else np.empty(0, dtype=np.float32),
+                         projection=self.encoder.projection if fitted
+                         else np.empty((0, 0), dtype=np.float32),
+                         codes=self._codes[:self._count][alive],
+                         points=self._points[:self._count][alive] if self.rerank
+                         else np.empty((0, 0), dtype=np.float32),
+                         user_ids=np.array(self._user_ids, dtype=str)[alive])
+
+    def load(self, filepath: str) -> None:
+        """Загружает кодировщик и индекс из файла .npz"""
+        with np.load(filepath) as data:
+            if int(data['version']) != BINARY_INDEX_FORMAT_VERSION:
+                raise ValueError(f"Неподдерживаемый формат файла бинарного индекса: {filepath}")
+            if data['projection'].size:
+                self.encoder.mean = data['mean']
+                self.encoder.projection = data['projection']
+                self.encoder.num_bits = self.encoder.projection.shape[1]
+            codes, points = data['codes'], data['points']
+            user_ids = data['user_ids'].tolist()
+
+        with self._lock:
+            self.clear()
+            if len(codes) == 0:
+                return
+            self._codes = codes
+            self._alive = np.ones(len(codes), dtype=bool)
+            self._user_ids = user_ids
+            self._count = self._num_alive = len(codes)
+            self.dimension = len(self.encoder.mean)
+            if self.rerank:
+                if len(points) != len(codes):
+                    raise ValueError(f"В файле {filepath} нет векторов для переранжирования")
+                self._points = points
+            self._rebuild_mih()
@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from typing import List
+from app.binary_hash import BinaryEncoder, BinaryHashIndex, hamming_distances
+from app.kd_tree_benchmark import generate_embeddings
+from app.search_index import FlatIndex
+
+
+def benchmark_binary_hash(database_size: int = 100000, dimension: int = 128,
+                          code_bits: List[int] = [64, 128, 256],
+                          num_queries: int = 200, num_candidates: int = 10,
+                          itq_iters: int = 20) -> pd.DataFrame:
+    """
+    Сравнение двоичных кодов SimHash и ITQ длиной 64, 128 и 256 бит:
+    байты на лицо, время полного просмотра (XOR + popcount) и поиска через
+    multi-index hashing, доля запросов, для которых истинный ближайший
+    сосед попал в num_candidates кандидатов первого прохода, и recall@1
+    после переранжирования по точному расстоянию
+    """
+    rng = np.random.default_rng(42)
+    print(f"Генерация {database_size} векторов размерности {dimension}...")
+    gallery, queries = generate_embeddings(database_size, dimension, num_queries, rng)
+    user_ids = [f"user_{i}" for i in range(database_size)]
+
+    flat = FlatIndex()
+    flat.build_from_matrix(gallery, user_ids)
+    start_time = time.time()
+    truth = [flat.query_knn(query, 1)[0][0] for query in queries]
+    flat_time = (time.time() - start_time) / num_queries
+    flat.clear()
+    print(f"Точный поиск (FlatIndex): {1000 * flat_time:.3f} мс")
+
+    results = []
+    for num_bits in code_bits:
+        methods = [('simhash', 0)] + ([('itq', itq_iters)] if num_bits <= dimension else [])
+        for method, iters in methods:
+            index = BinaryHashIndex(BinaryEncoder(num_bits, itq_iters=iters),
+                                    rerank_factor=num_candidates)
+            start_time = time.time()
+            index.build_from_matrix(gallery, user_ids)
+            build_time = time.time() - start_time
+            query_codes = index.encoder.encode(index._normalize(queries))
+
+            # Полный просмотр кодов: XOR и popcount по всем лицам
+            codes = index._codes[:index._count]
+            start_time = time.time()
+            for code in query_codes:
+                dists = hamming_distances(code, codes)
+                np.argpartition(dists, num_candidates - 1)[:num_candidates]
+            scan_time = (time.time() - start_time) / num_queries
+
+            start_time = time.time()
+            candidates = [index.query_hamming(query, num_candidates) for query in queries]
+            mih_time = (time.time() - start_time) / num_queries
+
+            start_time = time.time()
+            found = [index.query_knn(query, 1)[0][0] for query in queries]
+            rerank_time = (time.time() - start_time) / num_queries
+
+            result = {
+                'database_size': database_size,
+                'method': method,
+                'num_bits': num_bits,
+                'bytes_per_face': index.encoder.code_size,
+                'build_time': build_time,
+                'scan_ms': 1000.0 * scan_time,
+                'mih_ms': 1000.0 * mih_time,
+                'rerank_ms': 1000.0 * rerank_time,
+                'flat_ms': 1000.0 * flat_time,
+                f'first_pass_recall_at_{num_candidates}': np.mean(
+                    [true_id in {uid for uid, _ in found_ids}
+                     for true_id, found_ids in zip(truth, candidates)]),
+                'recall_at_1': np.mean([f == t for f, t in zip(found, truth)])
+            }
+            results.append(result)
+            print(f"{method} {num_bits} бит ({result['bytes_per_face']} байт): просмотр "
+                  f"{result['scan_ms']:.3f} мс, MIH {result['mih_ms']:.3f} мс, "
+                  f"с переранжированием {result['rerank_ms']:.3f} мс; полнота первого прохода "
+                  f"{result[f'first_pass_recall_at_{num_candidates}']:.3f}, "
+                  f"recall@1 {result['recall_at_1']:.3f}")
+
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    os.makedirs("results/binary_hash", exist_ok=True)
+    database_size = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    results = benchmark_binary_hash(database_size)
+    results.to_csv("results/binary_hash/codes.csv", index=False)
+    print("\nРезультаты сохранены в results/binary_hash/codes.csv")
@@ -4,61 +4,82 @@ from deepface import DeepFace
 from sklearn.neighbors import KDTree
 from typing import Tuple, List, Dict, Optional
 import time
+from app.embedding_cache import EmbeddingCache, package_version
+
+# Имя модели в ключе кэша: набор действий DeepFace.analyze и детектор лица
+DEEPFACE_ANALYZE_MODEL = 'deepface.analyze/age,gender,race,emotion+haar'
 
 class BiometricProcessor:
-    def __init__(self):
+    def __init__(self, cache: Optional[EmbeddingCache] = None):
         self.face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
         self.kdtree = None
         self.face_encodings = []
         self.user_ids = []
+        self.cache = cache or EmbeddingCache()
 
     def extract_face_features(self, image_path: str) -> Optional[Tuple[np.ndarray, Dict]]:
         """
-        Извлекает признаки лица из изображения с помощью DeepFace
+        Извлекает признаки лица из изображения с помощью DeepFace.
+        Результат кэшируется по содержимому файла, поэтому повторная
+        обработка того же изображения не запускает модели
         """
         try:
-            # Загружаем изображение
-            img = cv2.imread(image_path)
-            if img is None:
-                print(f"Не удалось загрузить изображение: {image_path}")
-                return None
-
-            # Получаем признаки с помощью DeepFace
-            result = DeepFace.analyze(img, 
-                                    actions=['age', 'gender', 'race', 'emotion'],
-                                    enforce_detection=False)
-            
-            if not result:
-                return None
-
-            # Извлекаем лицо и конвертируем в оттенки серого
-            gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-            faces = self.face_cascade.detectMultiScale(gray, 1.3, 5)
-            
-            if len(faces) == 0:
-                return None
-
-            # Берем первое обнаруженное лицо
-            (x, y, w, h) = faces[0]
-            face = gray[y:y+h, x:x+w]
-            
-            # Нормализуем размер лица
-            face = cv2.resize(face, (100, 100))
-            
-            # Получаем метаданные
-            metadata = {
-                'age': result[0]['age'],
-                'gender': result[0]['gender'],
-                'race': result[0]['dominant_race'],
-                'emotion': result[0]['dominant_emotion']
-            }
-
-            return face, metadata
+            with open(image_path, 'rb') as image_file:
+                image_bytes = image_file.read()
+        except OSError:
+            print(f"Не удалось загрузить изображение: {image_path}")
+            return None
 
+        try:
+            face, metadata = self.cache.get_or_compute(
+                image_bytes, DEEPFACE_ANALYZE_MODEL, package_version('deepface'),
+                self._analyze_image)
         except Exception as e:
             print(f"Ошибка при обработке изображения: {str(e)}")
             return None
 
+        if face is None:
+            return None
+        return face, metadata
+
+    def _analyze_image(self, image_bytes: bytes) -> Tuple[Optional[np.ndarray], Dict]:
+        """Запускает DeepFace и детектор лиц; лицо None, если его не нашли"""
+        img = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise ValueError("не удалось декодировать изображение")
+
+        # Получаем признаки с помощью DeepFace
+        result = DeepFace.analyze(img,
+                                  actions=['age', 'gender', 'race', 'emotion'],
+                                  enforce_detection=False)
+
+        if not result:
+            return None, {}
+
+        # Извлекаем лицо и конвертируем в оттенки серого
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        faces = self.face_cascade.detectMultiScale(gray, 1.3, 5)
+
+        if len(faces) == 0:
+            return None, {}
+
+        # Берем первое обнаруженное лицо
+        (x, y, w, h) = faces[0]
+        face = gray[y:y+h, x:x+w]
+
+        # Нормализуем размер лица
+        face = cv2.resize(face, (100, 100))
+
+        # Получаем метаданные
+        metadata = {
+            'age': result[0]['age'],
+            'gender': result[0]['gender'],
+            'race': result[0]['dominant_race'],
+            'emotion': result[0]['dominant_emotion']
+        }
+
+        return face, metadata
+
     def build_kdtree(self, face_encodings: List[np.ndarray], user_ids: List[str]):
         """
         Строит k-d дерево для быстрого поиска похожих лиц
@@ -0,0 +1,166 @@
+import threading
+import time
+import cv2
+from typing import Tuple, Optional, Any
+from PySide6.QtCore import QThread, Signal
+from PySide6.QtGui import QImage
+from face_processor import FaceProcessor
+from face_tracker import FaceTracker
+
+
+class LatestFrameBuffer:
+    """
+    Буфер последнего кадра между потоками.
+
+    Хранит только самый свежий элемент с порядковым номером: новый кадр
+    затирает непрочитанный, поэтому отставший потребитель пропускает кадры,
+    а не копит очередь. dropped — число кадров, которые никто не прочитал.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._item: Any = None
+        self._seq = 0
+        self._read_seq = 0
+        self.dropped = 0
+
+    def put(self, item: Any) -> None:
+        with self._condition:
+            if self._seq > self._read_seq:
+                self.dropped += 1
+            self._item = item
+            self._seq += 1
+            self._condition.notify_all()
+
+    def get_newer(self, seq: int, timeout: Optional[float] = None) -> Optional[Tuple[int, Any]]:
+        """Ждет элемент новее seq; возвращает (номер, элемент) или None по таймауту"""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._seq > seq, timeout):
+                return None
+            self._read_seq = self._seq
+            return self._seq, self._item
+
+
+class CaptureThread(QThread):
+    """
+    Поток камеры: читает кадры, находит лицо через FaceTracker, кладет
+    (кадр, результат детекции) в буфер последнего кадра и отправляет в GUI
+    готовое изображение. Пока GUI не отрисовал предыдущий кадр, новые
+    ему не отправляются.
+    """
+
+    frame_ready = Signal(QImage)
+    stats_updated = Signal(dict)
+
+    def __init__(self, tracker: FaceTracker, buffer: LatestFrameBuffer, camera_index: int = 0):
+        super().__init__()
+        self.tracker = tracker
+        self.buffer = buffer
+        self.camera_index = camera_index
+        self._running = False
+        self._frame_shown = threading.Event()
+        self._frame_shown.set()
+
+    def frame_displayed(self) -> None:
+        """Вызывается GUI после отрисовки кадра"""
+        self._frame_shown.set()
+
+    def run(self) -> None:
+        cap = cv2.VideoCapture(self.camera_index)
+        self._running = True
+        try:
+            while self._running:
+                ret, frame = cap.read()
+                if not ret:
+                    self.msleep(10)
+                    continue
+
+                face_result = self.tracker.detect(frame)
+                self.buffer.put((frame, face_result))
+
+                if not self._frame_shown.is_set():
+                    continue
+                rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                if face_result:
+                    _, (x, y, w, h) = face_result
+                    cv2.rectangle(rgb_frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
+                h, w, ch = rgb_frame.shape
+                # copy: данные QImage не должны зависеть от массива этого потока
+                qt_image = QImage(rgb_frame.data, w, h, ch * w, QImage.Format_RGB888).copy()
+                self._frame_shown.clear()
+                self.frame_ready.emit(qt_image)
+                self.stats_updated.emit({**self.tracker.stats(), 'dropped': self.buffer.dropped})
+        finally:
+            cap.release()
+
+    def stop(self) -> None:
+        self._running = False
+        self.wait()
+
+
+class RecognitionWorker(QThread):
+    """
+    Поток распознавания: выполняет запросы регистрации и проверки на самом
+    свежем кадре из буфера, обращаясь к базе данных вне потока GUI.
+    Результаты возвращаются сигналами. Если новый запрос пришел, пока
+    предыдущий ждет обработки, остается только новый.
+    """
+
+    recognized = Signal(object, float)       # id пользователя или None, время в секундах
+    verified = Signal(str, bool, float)      # заявленный id, совпадение, время в секундах
+    registered = Signal(str, float)          # id пользователя, время в секундах
+    face_missing = Signal()
+    failed = Signal(str)
+
+    def __init__(self, face_processor: FaceProcessor, buffer: LatestFrameBuffer):
+        super().__init__()
+        self.face_processor = face_processor
+        self.buffer = buffer
+        self._running = False
+        self._lock = threading.Lock()
+        self._task: Optional[Tuple[str, Optional[str]]] = None
+
+    def request_verify(self, user_id: Optional[str] = None) -> None:
+        """С user_id — проверка 1:1 заявленной личности, без него — поиск по базе"""
+        with self._lock:
+            self._task = ('verify', user_id)
+
+    def request_register(self, user_id: str) -> None:
+        with self._lock:
+            self._task = ('register', user_id)
+
+    def run(self) -> None:
+        self._running = True
+        seq = 0
+        while self._running:
+            item = self.buffer.get_newer(seq, timeout=0.1)
+            if item is None:
+                continue
+            seq, (_, face_result) = item
+            with self._lock:
+                task, self._task = self._task, None
+            if task is None:
+                continue
+            if not face_result:
+                self.face_missing.emit()
+                continue
+
+            face, _ = face_result
+            start_time = time.time()
+            action, user_id = task
+            try:
+                if action == 'register':
+                    self.face_processor.add_face(face, user_id)
+                    self.registered.emit(user_id, time.time() - start_time)
+                elif user_id is not None:
+                    match, _ = self.face_processor.verify(face, user_id)
+                    self.verified.emit(user_id, match, time.time() - start_time)
+                else:
+                    self.recognized.emit(self.face_processor.recognize_face(face),
+                                         time.time() - start_time)
+            except Exception as e:
+                self.failed.emit(str(e))
+
+    def stop(self) -> None:
+        self._running = False
+        self.wait()
@@ -0,0 +1,85 @@
+import os
+import time
+import logging
+import numpy as np
+import pandas as pd
+from typing import List
+from app.enhanced_algorithm import EnhancedBiometricSearch
+from app.kd_tree_benchmark import generate_embeddings
+
+
+def benchmark_cascade_search(database_sizes: List[int] = [10000, 100000],
+                             candidate_counts: List[int] = [50, 100, 200, 500],
+                             num_queries: int = 200,
+                             dimension: int = 128,
+                             cascade_dim: int = 16,
+                             k: int = 5) -> pd.DataFrame:
+    """
+    Сравнение каскадного поиска (KDTree по PCA-проекции cascade_dim, затем
+    точные расстояния для кандидатов) с поиском по одному KDTree на полных
+    векторах: полнота первой ступени (доля истинных k ближайших среди
+    кандидатов), итоговая полнота и время каждой ступени
+    """
+    rng = np.random.default_rng(42)
+    results = []
+
+    for database_size in database_sizes:
+        print(f"\nТестирование базы данных размером {database_size} лиц...")
+        gallery, queries = generate_embeddings(database_size, dimension, num_queries, rng)
+        paths = [f"face_{i}.jpg" for i in range(database_size)]
+
+        search = EnhancedBiometricSearch(cascade=True, cascade_dim=cascade_dim)
+        start_time = time.time()
+        search.build_index(gallery.astype(np.float64), paths)
+        build_time = time.time() - start_time
+
+        start_time = time.time()
+        truth = [search.tree.query([query], k=k)[1][0] for query in queries]
+        tree_time = (time.time() - start_time) / num_queries
+        projected = search.projector.transform(queries)
+
+        for num_candidates in candidate_counts:
+            search.cascade_candidates = num_candidates
+            search.stage_stats = {'queries': 0, 'coarse_time': 0.0, 'exact_time': 0.0}
+            _, candidates = search.coarse_tree.query(projected, k=num_candidates)
+
+            cascade_times, recall_at_1, recall_at_k, stage1_recall = [], [], [], []
+            for query, true_indices, stage1 in zip(queries, truth, candidates):
+                start_time = time.time()
+                found, _, _ = search.search(query, None, k)
+                cascade_times.append(time.time() - start_time)
+                recall_at_1.append(found[0] == true_indices[0])
+                recall_at_k.append(len(set(found) & set(true_indices)) / k)
+                stage1_recall.append(len(set(stage1) & set(true_indices)) / k)
+
+            timings = search.cascade_timings()
+            result = {
+                'database_size': database_size,
+                'cascade_dim': cascade_dim,
+                'stage1_candidates': num_candidates,
+                'cascade_build_time': build_time,
+                'stage1_recall_at_k': np.mean(stage1_recall),
+                'recall_at_1': np.mean(recall_at_1),
+                f'recall_at_{k}': np.mean(recall_at_k),
+                'stage1_ms': timings['coarse_ms'],
+                'stage2_ms': timings['exact_ms'],
+                'cascade_ms': 1000.0 * np.mean(cascade_times),
+                'single_tree_ms': 1000.0 * tree_time,
+                'speedup': tree_time / np.mean(cascade_times)
+            }
+            results.append(result)
+            print(f"Кандидатов {num_candidates}: ступень 1 {result['stage1_ms']:.3f} мс "
+                  f"(полнота {result['stage1_recall_at_k']:.3f}), ступень 2 "
+                  f"{result['stage2_ms']:.3f} мс; итог {result['cascade_ms']:.3f} мс против "
+                  f"{result['single_tree_ms']:.3f} мс (ускорение {result['speedup']:.1f}x), "
+                  f"recall@1 {result['recall_at_1']:.3f}, recall@{k} {result[f'recall_at_{k}']:.3f}")
+
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    os.makedirs("results/cascade", exist_ok=True)
+    results = benchmark_cascade_search()
+    results.to_csv("results/cascade/stages.csv", index=False)
+    print("\nРезультаты сохранены в results/cascade/stages.csv")
@@ -1,12 +1,176 @@
-import psycopg2
 import numpy as np
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Iterator, Iterable, Callable
+from contextlib import contextmanager, closing
+import io
+import itertools
 import pickle
+import queue
+import sqlite3
+import sys
+import threading
+import time
 
-class BiometricDatabase:
-    def __init__(self, dbname: str = 'biometric_db', user: str = 'postgres', 
-                 password: str = '13371337', host: str = 'localhost', port: str = '5433'):
-        """Инициализация подключения к базе данных"""
+try:
+    import psycopg2
+except ImportError:
+    # Без psycopg2 доступен только SQLite-бэкенд
+    psycopg2 = None
+
+# Версии формата хранения лица в колонке face_data:
+# 0 — pickle массива NumPy (прежний формат), 1 — сырые байты float32/uint8
+LEGACY_PICKLE_FORMAT = 0
+RAW_BINARY_FORMAT = 1
+
+# Типы данных, которые хранятся как есть; остальные приводятся к float32
+STORED_DTYPES = ('float32', 'uint8')
+
+
+def encode_face(face_data: np.ndarray) -> Tuple[bytes, str, str]:
+    """Кодирует лицо в сырые байты, возвращает байты, тип данных и форму"""
+    face_data = np.asarray(face_data)
+    if face_data.dtype.name not in STORED_DTYPES:
+        face_data = face_data.astype(np.float32)
+    face_data = np.ascontiguousarray(face_data)
+    shape = ','.join(str(dim) for dim in face_data.shape)
+    return face_data.tobytes(), face_data.dtype.name, shape
+
+
+def decode_face(face_bytes: bytes, format_version: int,
+                dtype: Optional[str], shape: Optional[str]) -> np.ndarray:
+    """Декодирует лицо из байтов с учетом версии формата"""
+    if format_version == LEGACY_PICKLE_FORMAT:
+        return pickle.loads(face_bytes)
+    if format_version != RAW_BINARY_FORMAT:
+        raise ValueError(f"Неизвестная версия формата лица: {format_version}")
+    dims = tuple(int(dim) for dim in shape.split(',')) if shape else ()
+    return np.frombuffer(face_bytes, dtype=dtype).reshape(dims)
+
+
+def decode_face_matrix(rows: List[Tuple[bytes, int, str, str]]) -> np.ndarray:
+    """
+    Декодирует строки (face_data, format_version, dtype, shape) в матрицу (N, D).
+    Если все записи в бинарном формате с одинаковым типом и формой,
+    байты склеиваются и декодируются одним вызовом np.frombuffer
+    """
+    formats = {row[1:] for row in rows}
+    if len(formats) == 1:
+        version, dtype, shape = formats.pop()
+        if version == RAW_BINARY_FORMAT:
+            matrix = np.frombuffer(b''.join(row[0] for row in rows), dtype=dtype)
+            return matrix.reshape(len(rows), -1)
+
+    # Смешанные или старые записи декодируем по одной
+    return np.stack([np.ravel(decode_face(*row)).astype(np.float32) for row in rows])
+
+
+def collect_chunks(chunks: Iterable[Tuple[List[str], np.ndarray]], size: int,
+                   dtype=np.float32,
+                   transform: Optional[Callable[[np.ndarray], np.ndarray]] = None
+                   ) -> Tuple[List[str], np.ndarray]:
+    """
+    Собирает чанки (id, матрица) в заранее выделенную матрицу (size, D),
+    чтобы пиковое потребление памяти оставалось близким к размеру результата.
+    transform применяется к каждому чанку перед копированием
+    """
+    user_ids: List[str] = []
+    matrix = None
+    filled = 0
+    for chunk_ids, block in chunks:
+        block = np.reshape(block, (len(block), -1))
+        if transform is not None:
+            block = transform(block)
+        if matrix is None:
+            matrix = np.empty((max(size, len(block)), block.shape[1]), dtype=dtype)
+        elif filled + len(block) > len(matrix):
+            # Таблица выросла во время чтения
+            grown = np.empty((max(2 * len(matrix), filled + len(block)), matrix.shape[1]),
+                             dtype=dtype)
+            grown[:filled] = matrix[:filled]
+            matrix = grown
+        matrix[filled:filled + len(block)] = block
+        filled += len(block)
+        user_ids.extend(chunk_ids)
+
+    if matrix is None:
+        return [], np.empty((0, 0), dtype=dtype)
+    return user_ids, matrix[:filled]
+
+
+def encode_embedding(embedding: Optional[np.ndarray]) -> Optional[bytes]:
+    """Кодирует эмбеддинг лица в сырые байты float32"""
+    if embedding is None:
+        return None
+    return np.ascontiguousarray(np.ravel(embedding), dtype=np.float32).tobytes()
+
+
+def decode_embedding_matrix(rows: List[bytes]) -> np.ndarray:
+    """Декодирует байты эмбеддингов одинаковой длины в матрицу (N, D)"""
+    return np.frombuffer(b''.join(rows), dtype=np.float32).reshape(len(rows), -1)
+
+
+def encode_face_rows(faces: Iterable[Tuple]) -> Iterator[Tuple[str, bytes, int, str, str, Optional[bytes]]]:
+    """Кодирует пары (id, лицо) или тройки (id, лицо, эмбеддинг) в строки таблицы faces"""
+    for user_id, face_data, *embedding in faces:
+        face_bytes, dtype, shape = encode_face(face_data)
+        yield (user_id, face_bytes, RAW_BINARY_FORMAT, dtype, shape,
+               encode_embedding(embedding[0] if embedding else None))
+
+
+class CopyStream(io.RawIOBase):
+    """Файлоподобный поток строк для COPY ... FROM STDIN, формируемый по мере чтения"""
+
+    def __init__(self, lines: Iterator[bytes]):
+        self._lines = lines
+        self._buffer = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._lines)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+class PostgresBackend:
+    """Бэкенд PostgreSQL на psycopg2"""
+
+    name = 'postgresql'
+    placeholder = '%s'
+    schema = [
+        """
+        CREATE TABLE IF NOT EXISTS faces (
+            id SERIAL PRIMARY KEY,
+            user_id VARCHAR(50) NOT NULL,
+            face_data BYTEA NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        # Колонки формата хранения; старые записи остаются в pickle
+        """
+        ALTER TABLE faces
+            ADD COLUMN IF NOT EXISTS format_version SMALLINT NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS dtype VARCHAR(16),
+            ADD COLUMN IF NOT EXISTS shape VARCHAR(32)
+        """,
+        # Компактный эмбеддинг лица (float32), заполняется экстрактором признаков
+        "ALTER TABLE faces ADD COLUMN IF NOT EXISTS embedding BYTEA",
+        # Продуктово-квантованный код эмбеддинга (uint8)
+        "ALTER TABLE faces ADD COLUMN IF NOT EXISTS pq_code BYTEA",
+        # Выборка шаблонов одного пользователя при проверке 1:1
+        "CREATE INDEX IF NOT EXISTS idx_faces_user_id ON faces (user_id)"
+    ]
+    truncate_sql = "TRUNCATE TABLE faces"
+
+    def __init__(self, dbname: str, user: str, password: str, host: str, port: str):
+        if psycopg2 is None:
+            raise ImportError("Для работы с PostgreSQL необходим пакет psycopg2")
         self.conn_params = {
             'dbname': dbname,
             'user': user,
@@ -14,64 +178,479 @@ class BiometricDatabase:
             'host': host,
             'port': port
         }
+        self.errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+    def connect(self):
+        return psycopg2.connect(**self.conn_params)
+
+    def binary(self, data: bytes):
+        return psycopg2.Binary(data)
+
+    def stream_cursor(self, conn, chunk_size: int):
+        """Именованный серверный курсор: строки приходят порциями по chunk_size"""
+        cur = conn.cursor(name='faces_stream')
+        cur.itersize = chunk_size
+        return cur
+
+    def migrate(self, cur) -> None:
+        """Схема обновляется через ADD COLUMN IF NOT EXISTS"""
+
+    @staticmethod
+    def _copy_text(value: str) -> str:
+        """Экранирует значение для текстового формата COPY"""
+        return (value.replace('\\', '\\\\').replace('\t', '\\t')
+                .replace('\n', '\\n').replace('\r', '\\r'))
+
+    def bulk_insert(self, cur, rows: Iterable[Tuple[str, bytes, int, str, str, Optional[bytes]]]) -> int:
+        """Потоковая вставка строк через COPY ... FROM STDIN"""
+        count = 0
+
+        def lines() -> Iterator[bytes]:
+            nonlocal count
+            for user_id, face_bytes, version, dtype, shape, embedding in rows:
+                count += 1
+                # bytea в hex-виде; обратная косая черта удваивается для COPY
+                embedding = '\\N' if embedding is None else f"\\\\x{embedding.hex()}"
+                yield (f"{self._copy_text(user_id)}\t\\\\x{face_bytes.hex()}\t"
+                       f"{version}\t{dtype}\t{shape}\t{embedding}\n").encode()
+
+        cur.copy_expert("COPY faces (user_id, face_data, format_version, dtype, shape, embedding) "
+                        "FROM STDIN", CopyStream(lines()), size=1 << 18)
+        return count
+
+
+class SQLiteBackend:
+    """Бэкенд SQLite для локального файла (тесты, постаматы)"""
+
+    name = 'sqlite'
+    placeholder = '?'
+    schema = [
+        """
+        CREATE TABLE IF NOT EXISTS faces (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id VARCHAR(50) NOT NULL,
+            face_data BLOB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            format_version SMALLINT NOT NULL DEFAULT 0,
+            dtype VARCHAR(16),
+            shape VARCHAR(32),
+            embedding BLOB,
+            pq_code BLOB
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_faces_user_id ON faces (user_id)"
+    ]
+    truncate_sql = "DELETE FROM faces"
+    # Колонки, добавленные после создания первых файлов базы
+    added_columns = {'embedding': 'BLOB', 'pq_code': 'BLOB'}
+
+    def __init__(self, path: str):
+        self.path = path
+        self.errors = (sqlite3.Error,)
+
+    def connect(self):
+        # Соединение из пула используется одним потоком за раз
+        return sqlite3.connect(self.path, check_same_thread=False)
+
+    def binary(self, data: bytes):
+        return sqlite3.Binary(data)
+
+    def stream_cursor(self, conn, chunk_size: int):
+        """Обычный курсор: SQLite и так отдает строки по мере выборки"""
+        return conn.cursor()
+
+    def migrate(self, cur) -> None:
+        """Добавляет недостающие колонки: в SQLite нет ADD COLUMN IF NOT EXISTS"""
+        cur.execute("PRAGMA table_info(faces)")
+        existing = {row[1] for row in cur.fetchall()}
+        for column, column_type in self.added_columns.items():
+            if column not in existing:
+                cur.execute(f"ALTER TABLE faces ADD COLUMN {column} {column_type}")
+
+    def bulk_insert(self, cur, rows: Iterable[Tuple[str, bytes, int, str, str, Optional[bytes]]],
+                    batch_size: int = 1000) -> int:
+        """Вставка строк пачками через executemany"""
+        count = 0
+        rows = iter(rows)
+        while True:
+            batch = [(user_id, sqlite3.Binary(face_bytes), version, dtype, shape,
+                      None if embedding is None else sqlite3.Binary(embedding))
+                     for user_id, face_bytes, version, dtype, shape, embedding
+                     in itertools.islice(rows, batch_size)]
+            if not batch:
+                return count
+            cur.executemany("INSERT INTO faces (user_id, face_data, format_version, dtype, shape, "
+                            "embedding) VALUES (?, ?, ?, ?, ?, ?)", batch)
+            count += len(batch)
+
+
+class ConnectionPool:
+    """
+    Пул соединений с базой данных.
+    Держит от min_size до max_size соединений, проверяет простаивавшие
+    дольше health_check_interval секунд и заменяет разорванные.
+    """
+
+    def __init__(self, backend, min_size: int = 1, max_size: int = 10,
+                 timeout: float = 30.0, health_check_interval: float = 30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Некорректные размеры пула соединений")
+        self.backend = backend
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+
+        for _ in range(min_size):
+            self._idle.put((self._create(), time.monotonic()))
+
+    def _create(self):
+        """Открывает новое соединение с учетом лимита пула"""
+        with self._lock:
+            if self._created >= self.max_size:
+                return None
+            self._created += 1
+        try:
+            return self.backend.connect()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _discard(self, conn) -> None:
+        """Закрывает соединение и освобождает место в пуле"""
+        with self._lock:
+            self._created -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, conn) -> bool:
+        """Проверяет соединение пробным запросом"""
+        try:
+            with closing(conn.cursor()) as cur:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            conn.rollback()
+            return True
+        except self.backend.errors:
+            return False
+
+    def acquire(self):
+        """Берет соединение из пула, при необходимости открывая новое"""
+        if self._closed:
+            raise RuntimeError("Пул соединений закрыт")
+
+        while True:
+            try:
+                conn, released_at = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._create()
+                if conn is not None:
+                    return conn
+                try:
+                    conn, released_at = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError("Нет свободных соединений в пуле")
+
+            if time.monotonic() - released_at < self.health_check_interval \
+                    or self._is_healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def release(self, conn, broken: bool = False) -> None:
+        """Возвращает соединение в пул"""
+        if broken or self._closed:
+            self._discard(conn)
+        else:
+            self._idle.put((conn, time.monotonic()))
+
+    @contextmanager
+    def connection(self) -> Iterator:
+        """Соединение с фиксацией транзакции при успехе и откатом при ошибке"""
+        conn = self.acquire()
+        broken = False
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            # Соединение, которое не удается откатить или проверить, выбрасываем
+            try:
+                conn.rollback()
+                broken = not self._is_healthy(conn)
+            except self.backend.errors:
+                broken = True
+            raise
+        finally:
+            self.release(conn, broken)
+
+    @contextmanager
+    def cursor(self) -> Iterator:
+        """Курсор в отдельной транзакции"""
+        with self.connection() as conn:
+            with closing(conn.cursor()) as cur:
+                yield cur
+
+    def close(self) -> None:
+        """Закрывает все простаивающие соединения"""
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+class BiometricDatabase:
+    def __init__(self, dbname: str = 'biometric_db', user: str = 'postgres',
+                 password: str = '13371337', host: str = 'localhost', port: str = '5433',
+                 backend: str = 'postgresql', min_connections: int = 1,
+                 max_connections: int = 10):
+        """
+        Инициализация пула соединений с базой данных.
+        Для backend='sqlite' dbname — путь к файлу базы данных
+        """
+        if backend == 'postgresql':
+            self.backend = PostgresBackend(dbname, user, password, host, port)
+        elif backend == 'sqlite':
+            self.backend = SQLiteBackend(dbname)
+        else:
+            raise ValueError(f"Неизвестный бэкенд базы данных: {backend}")
+
+        self.pool = ConnectionPool(self.backend, min_connections, max_connections)
         self._create_tables()
 
+    def _sql(self, query: str) -> str:
+        """Подставляет в запрос маркер параметров выбранного бэкенда"""
+        return query.replace('%s', self.backend.placeholder)
+
     def _create_tables(self) -> None:
         """Создание необходимых таблиц"""
-        with psycopg2.connect(**self.conn_params) as conn:
-            with conn.cursor() as cur:
-                # Создаем таблицу для хранения лиц
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS faces (
-                        id SERIAL PRIMARY KEY,
-                        user_id VARCHAR(50) NOT NULL,
-                        face_data BYTEA NOT NULL,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                conn.commit()
-
-    def add_face(self, user_id: str, face_data: np.ndarray) -> None:
-        """Добавление нового лица в базу данных"""
-        with psycopg2.connect(**self.conn_params) as conn:
-            with conn.cursor() as cur:
-                # Сериализуем numpy массив в байты
-                face_bytes = pickle.dumps(face_data)
-                cur.execute(
-                    "INSERT INTO faces (user_id, face_data) VALUES (%s, %s)",
-                    (user_id, psycopg2.Binary(face_bytes))
-                )
-                conn.commit()
+        with self.pool.cursor() as cur:
+            for statement in self.backend.schema:
+                cur.execute(statement)
+            self.backend.migrate(cur)
+
+    def add_face(self, user_id: str, face_data: np.ndarray,
+                 embedding: Optional[np.ndarray] = None) -> None:
+        """Добавление нового лица (и, если есть, его эмбеддинга) в базу данных"""
+        # Сохраняем сырые байты массива, тип и форму — в отдельных колонках
+        face_bytes, dtype, shape = encode_face(face_data)
+        embedding_bytes = encode_embedding(embedding)
+        with self.pool.cursor() as cur:
+            cur.execute(
+                self._sql("INSERT INTO faces (user_id, face_data, format_version, dtype, shape, "
+                          "embedding) VALUES (%s, %s, %s, %s, %s, %s)"),
+                (user_id, self.backend.binary(face_bytes), RAW_BINARY_FORMAT, dtype, shape,
+                 None if embedding_bytes is None else self.backend.binary(embedding_bytes))
+            )
+
+    def add_faces_bulk(self, faces: Iterable[Tuple]) -> int:
+        """
+        Массовое добавление пар (id, лицо) или троек (id, лицо, эмбеддинг) в одной транзакции.
+        PostgreSQL получает строки потоком через COPY, SQLite — пачками executemany.
+        Возвращает количество добавленных лиц
+        """
+        with self.pool.cursor() as cur:
+            return self.backend.bulk_insert(cur, encode_face_rows(faces))
 
     def get_all_faces(self) -> List[Tuple[str, np.ndarray]]:
         """Получение всех лиц из базы данных"""
-        with psycopg2.connect(**self.conn_params) as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT user_id, face_data FROM faces")
-                results = []
-                for user_id, face_data in cur.fetchall():
-                    # Десериализуем байты обратно в numpy массив
-                    face_array = pickle.loads(face_data)
-                    results.append((user_id, face_array))
-                return results
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT user_id, face_data, format_version, dtype, shape "
+                        "FROM faces ORDER BY id")
+            return [(user_id, decode_face(face_data, version, dtype, shape))
+                    for user_id, face_data, version, dtype, shape in cur.fetchall()]
+
+    def get_all_faces_matrix(self) -> Tuple[List[str], np.ndarray]:
+        """Получение всех лиц одной непрерывной матрицей (N, D) и списка id"""
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT user_id, face_data, format_version, dtype, shape "
+                        "FROM faces ORDER BY id")
+            rows = cur.fetchall()
+
+        if not rows:
+            return [], np.empty((0, 0), dtype=np.float32)
+
+        return [row[0] for row in rows], decode_face_matrix([row[1:] for row in rows])
+
+    def get_user_faces(self, user_id: str) -> np.ndarray:
+        """Все лица одного пользователя матрицей (n, D); выборка идет по индексу user_id"""
+        with self.pool.cursor() as cur:
+            cur.execute(self._sql("SELECT face_data, format_version, dtype, shape "
+                                  "FROM faces WHERE user_id = %s ORDER BY id"), (user_id,))
+            rows = cur.fetchall()
+        if not rows:
+            return np.empty((0, 0), dtype=np.float32)
+        return decode_face_matrix(rows)
+
+    def get_user_embeddings(self, user_id: str) -> np.ndarray:
+        """Эмбеддинги одного пользователя матрицей (n, D); записи без эмбеддинга пропускаются"""
+        with self.pool.cursor() as cur:
+            cur.execute(self._sql("SELECT embedding FROM faces "
+                                  "WHERE user_id = %s AND embedding IS NOT NULL ORDER BY id"),
+                        (user_id,))
+            rows = cur.fetchall()
+        if not rows:
+            return np.empty((0, 0), dtype=np.float32)
+        return decode_embedding_matrix([row[0] for row in rows])
+
+    def iter_faces(self, chunk_size: int = 1000) -> Iterator[Tuple[List[str], np.ndarray]]:
+        """
+        Потоковое чтение лиц порциями: генерирует пары (список id, матрица (n, D)).
+        В PostgreSQL используется именованный серверный курсор, поэтому в памяти
+        одновременно находится только одна порция
+        """
+        with self.pool.connection() as conn:
+            with closing(self.backend.stream_cursor(conn, chunk_size)) as cur:
+                cur.execute("SELECT user_id, face_data, format_version, dtype, shape "
+                            "FROM faces ORDER BY id")
+                while True:
+                    rows = cur.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield [row[0] for row in rows], decode_face_matrix([row[1:] for row in rows])
+
+    def iter_embeddings(self, chunk_size: int = 1000) -> Iterator[Tuple[List[str], np.ndarray]]:
+        """
+        Потоковое чтение эмбеддингов порциями: генерирует пары (список id, матрица (n, D)).
+        Записи без эмбеддинга пропускаются — их заполняет update_embeddings
+        """
+        with self.pool.connection() as conn:
+            with closing(self.backend.stream_cursor(conn, chunk_size)) as cur:
+                cur.execute("SELECT user_id, embedding FROM faces "
+                            "WHERE embedding IS NOT NULL ORDER BY id")
+                while True:
+                    rows = cur.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    yield [row[0] for row in rows], decode_embedding_matrix([row[1] for row in rows])
+
+    def count_embeddings(self) -> int:
+        """Количество записей с заполненным эмбеддингом"""
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM faces WHERE embedding IS NOT NULL")
+            return cur.fetchone()[0]
+
+    def _fill_column(self, column: str, source: str, condition: str,
+                     compute: Callable[[List[tuple]], List[bytes]],
+                     chunk_size: int, only_missing: bool) -> int:
+        """
+        Заполняет колонку column значениями compute(строки source) порциями
+        по chunk_size, каждую в своей транзакции. Возвращает количество записей
+        """
+        if only_missing:
+            condition += f" AND {column} IS NULL"
+        last_id, count = 0, 0
+        while True:
+            with self.pool.cursor() as cur:
+                # Постраничный проход по первичному ключу
+                cur.execute(
+                    self._sql(f"SELECT id, {source} FROM faces "
+                              f"WHERE id > %s{condition} ORDER BY id LIMIT %s"),
+                    (last_id, chunk_size)
+                )
+                rows = cur.fetchall()
+                if not rows:
+                    return count
+                values = compute([row[1:] for row in rows])
+                cur.executemany(
+                    self._sql(f"UPDATE faces SET {column} = %s WHERE id = %s"),
+                    [(self.backend.binary(value), row[0]) for value, row in zip(values, rows)]
+                )
+            last_id = rows[-1][0]
+            count += len(rows)
+
+    def update_embeddings(self, embed: Callable[[np.ndarray], np.ndarray],
+                          chunk_size: int = 1000, only_missing: bool = True) -> int:
+        """
+        Вычисляет эмбеддинги функцией embed (матрица лиц (n, D) -> (n, E))
+        и записывает их порциями по chunk_size, каждую в своей транзакции.
+        При only_missing=False пересчитываются все записи, например после
+        переобучения проекции. Возвращает количество обновленных записей
+        """
+        def compute(rows: List[tuple]) -> List[bytes]:
+            return [encode_embedding(embedding) for embedding in embed(decode_face_matrix(rows))]
+
+        return self._fill_column('embedding', 'face_data, format_version, dtype, shape', '',
+                                 compute, chunk_size, only_missing)
+
+    def update_pq_codes(self, encode: Callable[[np.ndarray], np.ndarray],
+                        chunk_size: int = 1000, only_missing: bool = True) -> int:
+        """
+        Кодирует эмбеддинги функцией encode (матрица (n, E) -> коды (n, M) uint8),
+        например ProductQuantizer.encode, и сохраняет коды в колонку pq_code.
+        После переобучения словарей вызывается с only_missing=False
+        """
+        def compute(rows: List[tuple]) -> List[bytes]:
+            codes = encode(decode_embedding_matrix([row[0] for row in rows]))
+            return [np.ascontiguousarray(code, dtype=np.uint8).tobytes() for code in codes]
+
+        return self._fill_column('pq_code', 'embedding', ' AND embedding IS NOT NULL',
+                                 compute, chunk_size, only_missing)
+
+    def iter_pq_codes(self, chunk_size: int = 1000) -> Iterator[Tuple[List[str], np.ndarray]]:
+        """Потоковое чтение PQ-кодов порциями: генерирует пары (список id, коды (n, M) uint8)"""
+        with self.pool.connection() as conn:
+            with closing(self.backend.stream_cursor(conn, chunk_size)) as cur:
+                cur.execute("SELECT user_id, pq_code FROM faces "
+                            "WHERE pq_code IS NOT NULL ORDER BY id")
+                while True:
+                    rows = cur.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    codes = np.frombuffer(b''.join(row[1] for row in rows), dtype=np.uint8)
+                    yield [row[0] for row in rows], codes.reshape(len(rows), -1)
+
+    def count_pq_codes(self) -> int:
+        """Количество записей с заполненным PQ-кодом"""
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM faces WHERE pq_code IS NOT NULL")
+            return cur.fetchone()[0]
+
+    def migrate_to_binary(self) -> int:
+        """Переводит записи в формате pickle в бинарный формат, возвращает их количество"""
+        with self.pool.cursor() as cur:
+            cur.execute(self._sql("SELECT id, face_data FROM faces WHERE format_version = %s"),
+                        (LEGACY_PICKLE_FORMAT,))
+            rows = cur.fetchall()
+            for row_id, face_data in rows:
+                face_bytes, dtype, shape = encode_face(pickle.loads(face_data))
+                cur.execute(
+                    self._sql("UPDATE faces SET face_data = %s, format_version = %s, "
+                              "dtype = %s, shape = %s WHERE id = %s"),
+                    (self.backend.binary(face_bytes), RAW_BINARY_FORMAT, dtype, shape, row_id)
+                )
+            return len(rows)
+
+    def delete_faces(self, user_id: str) -> None:
+        """Удаление всех лиц пользователя"""
+        with self.pool.cursor() as cur:
+            cur.execute(self._sql("DELETE FROM faces WHERE user_id = %s"), (user_id,))
 
     def clear_database(self) -> None:
         """Очистка базы данных"""
-        with psycopg2.connect(**self.conn_params) as conn:
-            with conn.cursor() as cur:
-                cur.execute("TRUNCATE TABLE faces")
-                conn.commit()
+        with self.pool.cursor() as cur:
+            cur.execute(self.backend.truncate_sql)
 
     def get_database_size(self) -> int:
         """Получение количества записей в базе данных"""
-        with psycopg2.connect(**self.conn_params) as conn:
-            with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) FROM faces")
-                return cur.fetchone()[0]
+        with self.pool.cursor() as cur:
+            cur.execute("SELECT COUNT(*) FROM faces")
+            return cur.fetchone()[0]
 
-    def close(self):
-        self.conn.close()
+    def close(self) -> None:
+        """Закрывает все соединения пула"""
+        self.pool.close()
 
 if __name__ == "__main__":
-    db = BiometricDatabase('postamat.db', 'user', 'password')
-    db.create_tables()
\ No newline at end of file
+    # postamat.db — база киоска со своей схемой, таблицу faces в нее не добавляем
+    db = BiometricDatabase(sys.argv[1] if len(sys.argv) > 1 else 'faces.db', backend='sqlite')
+    print(f"Лиц в базе данных: {db.get_database_size()}")
+    db.close()
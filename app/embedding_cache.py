@@ -0,0 +1,214 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import numpy as np
+from importlib.metadata import version as _package_version, PackageNotFoundError
+from typing import List, Tuple, Dict, Optional, Callable
+from app.database import encode_face, decode_face, RAW_BINARY_FORMAT
+
+
+def package_version(name: str) -> str:
+    """Версия установленного пакета модели; входит в ключ кэша"""
+    try:
+        return _package_version(name)
+    except PackageNotFoundError:
+        return 'unknown'
+
+
+def image_digest(image_bytes: bytes) -> str:
+    """SHA-256 содержимого файла изображения"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def _to_json(value):
+    """Приводит скаляры NumPy из результатов моделей к типам JSON"""
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+class EmbeddingCache:
+    """
+    Постоянный кэш эмбеддингов и атрибутов лиц в файле SQLite рядом с базой.
+
+    Ключ — SHA-256 байтов изображения, имя модели и ее версия, поэтому
+    переименованный файл попадает в кэш, а смена модели его не задевает.
+    Запись хранит эмбеддинг (или None, если лицо не найдено) и атрибуты
+    в JSON. При превышении max_entries вытесняются давно не читавшиеся
+    записи (LRU). Счетчики hits и misses считаются с момента открытия.
+    """
+
+    def __init__(self, path: str = 'embedding_cache.db', max_entries: int = 100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                digest TEXT NOT NULL,
+                model TEXT NOT NULL,
+                version TEXT NOT NULL,
+                embedding BLOB,
+                dtype VARCHAR(16),
+                shape VARCHAR(32),
+                attributes TEXT,
+                last_used INTEGER NOT NULL,
+                PRIMARY KEY (digest, model, version)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embedding_cache_last_used "
+                           "ON embedding_cache (last_used)")
+        self._conn.commit()
+        # Логические часы LRU: номер последнего обращения
+        self._clock, self._size = self._conn.execute(
+            "SELECT COALESCE(MAX(last_used), 0), COUNT(*) FROM embedding_cache").fetchone()
+
+    @property
+    def size(self) -> int:
+        """Количество записей в кэше"""
+        return self._size
+
+    def _tick(self) -> int:
+        self._clock += 1
+        return self._clock
+
+    def get(self, image_bytes: bytes, model: str,
+            version: str) -> Optional[Tuple[Optional[np.ndarray], Dict]]:
+        """Возвращает (эмбеддинг, атрибуты) или None, если записи нет"""
+        key = (image_digest(image_bytes), model, version)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT embedding, dtype, shape, attributes FROM embedding_cache "
+                "WHERE digest = ? AND model = ? AND version = ?", key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE embedding_cache SET last_used = ? "
+                               "WHERE digest = ? AND model = ? AND version = ?",
+                               (self._tick(),) + key)
+            self._conn.commit()
+
+        embedding_bytes, dtype, shape, attributes = row
+        embedding = None if embedding_bytes is None \
+            else decode_face(embedding_bytes, RAW_BINARY_FORMAT, dtype, shape)
+        return embedding, json.loads(attributes) if attributes else {}
+
+    def put(self, image_bytes: bytes, model: str, version: str,
+            embedding: Optional[np.ndarray], attributes: Optional[Dict] = None) -> None:
+        """Сохраняет результат модели и при необходимости вытесняет старые записи"""
+        embedding_bytes = dtype = shape = None
+        if embedding is not None:
+            embedding_bytes, dtype, shape = encode_face(embedding)
+            embedding_bytes = sqlite3.Binary(embedding_bytes)
+        attributes = json.dumps(attributes, default=_to_json) if attributes else None
+
+        key = (image_digest(image_bytes), model, version)
+        with self._lock:
+            exists = self._conn.execute(
+                "SELECT 1 FROM embedding_cache WHERE digest = ? AND model = ? AND version = ?",
+                key).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embedding_cache (digest, model, version, embedding, "
+                "dtype, shape, attributes, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                key + (embedding_bytes, dtype, shape, attributes, self._tick()))
+            if exists is None:
+                self._size += 1
+            if self._size > self.max_entries:
+                self._evict(self._size - self.max_entries)
+            self._conn.commit()
+
+    def get_many(self, digests: List[str], model: str, version: str,
+                 chunk_size: int = 500) -> Dict[str, Tuple[Optional[np.ndarray], Dict]]:
+        """Пакетный get по готовым SHA-256: один запрос на chunk_size ключей"""
+        found = {}
+        with self._lock:
+            for start in range(0, len(digests), chunk_size):
+                chunk = list(digests[start:start + chunk_size])
+                marks = ', '.join('?' * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT digest, embedding, dtype, shape, attributes FROM embedding_cache "
+                    f"WHERE model = ? AND version = ? AND digest IN ({marks})",
+                    [model, version] + chunk).fetchall()
+                for digest, embedding_bytes, dtype, shape, attributes in rows:
+                    embedding = None if embedding_bytes is None \
+                        else decode_face(embedding_bytes, RAW_BINARY_FORMAT, dtype, shape)
+                    found[digest] = (embedding, json.loads(attributes) if attributes else {})
+            self._conn.executemany("UPDATE embedding_cache SET last_used = ? "
+                                   "WHERE digest = ? AND model = ? AND version = ?",
+                                   [(self._tick(), digest, model, version) for digest in found])
+            self._conn.commit()
+
+        self.hits += len(found)
+        self.misses += len(set(digests)) - len(found)
+        return found
+
+    def put_many(self, entries: List[Tuple[str, Optional[np.ndarray], Optional[Dict]]],
+                 model: str, version: str) -> None:
+        """Пакетный put записей (SHA-256, эмбеддинг, атрибуты) одной транзакцией"""
+        rows = []
+        for digest, embedding, attributes in entries:
+            embedding_bytes = dtype = shape = None
+            if embedding is not None:
+                embedding_bytes, dtype, shape = encode_face(embedding)
+                embedding_bytes = sqlite3.Binary(embedding_bytes)
+            rows.append((digest, model, version, embedding_bytes, dtype, shape,
+                         json.dumps(attributes, default=_to_json) if attributes else None))
+
+        with self._lock:
+            for row in rows:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO embedding_cache (digest, model, version, embedding, "
+                    "dtype, shape, attributes, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    row + (self._tick(),))
+            self._size = self._conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+            if self._size > self.max_entries:
+                self._evict(self._size - self.max_entries)
+            self._conn.commit()
+
+    def _evict(self, count: int) -> None:
+        """Удаляет count записей с самым старым обращением"""
+        self._conn.execute("DELETE FROM embedding_cache WHERE rowid IN ("
+                           "SELECT rowid FROM embedding_cache ORDER BY last_used LIMIT ?)",
+                           (count,))
+        self._size -= count
+        self.evictions += count
+
+    def get_or_compute(self, image_bytes: bytes, model: str, version: str,
+                       compute: Callable[[bytes], Tuple[Optional[np.ndarray], Dict]]
+                       ) -> Tuple[Optional[np.ndarray], Dict]:
+        """Берет результат из кэша или вычисляет его через compute(image_bytes) и сохраняет"""
+        cached = self.get(image_bytes, model, version)
+        if cached is not None:
+            return cached
+        embedding, attributes = compute(image_bytes)
+        self.put(image_bytes, model, version, embedding, attributes)
+        return embedding, attributes
+
+    def stats(self) -> Dict[str, float]:
+        """Счетчики попаданий и промахов"""
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+            'evictions': self.evictions,
+            'size': self._size
+        }
+
+    def clear(self) -> None:
+        """Удаляет все записи"""
+        with self._lock:
+            self._conn.execute("DELETE FROM embedding_cache")
+            self._conn.commit()
+            self._size = 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -3,9 +3,11 @@ import time
 from sklearn.neighbors import KDTree
 import os
 import cv2
-from concurrent.futures import ThreadPoolExecutor
-from typing import List, Tuple, Dict, Optional
+from typing import List, Tuple, Dict, Optional, Iterable
 import logging
+from app.attribute_pipeline import AttributePipeline, UNKNOWN_GENDER, MALE, FEMALE
+from app.database import collect_chunks
+from app.feature_extractor import PCAProjector
 
 class EnhancedBiometricSearch:
     """
@@ -13,13 +15,35 @@ class EnhancedBiometricSearch:
     Использует KDTree для базового поиска и дополнительные биометрические параметры для уточнения результатов.
     """
     
-    def __init__(self):
+    def __init__(self, attribute_pipeline: Optional[AttributePipeline] = None,
+                 partitioned: bool = False,
+                 age_bucket_edges: Tuple[float, ...] = (25.0, 35.0, 45.0, 55.0),
+                 cascade: bool = False, cascade_dim: int = 16,
+                 cascade_candidates: int = 200):
         self.embeddings = None
         self.face_paths = None
         self.tree = None
-        # Кэш для хранения дополнительных биометрических признаков
-        self.gender_cache: Dict[str, int] = {}
-        self.age_cache: Dict[str, int] = {}
+        # Пол, уверенность в нем и возраст, выровненные с self.embeddings;
+        # сами значения хранятся в постоянном кэше атрибутов конвейера
+        self.attribute_pipeline = attribute_pipeline
+        self.genders = np.empty(0, dtype=np.int8)
+        self.gender_confidences = np.empty(0, dtype=np.float32)
+        self.ages = np.empty(0, dtype=np.float32)
+        self._path_rows: Dict[str, int] = {}
+        # Подындексы по (пол, возрастная группа) для поиска с предварительным фильтром;
+        # лица с неизвестным полом или возрастом лежат в группе -1
+        self.partitioned = partitioned
+        self.age_bucket_edges = np.asarray(age_bucket_edges, dtype=np.float32)
+        self.partitions: Dict[Tuple[int, int], Tuple[KDTree, np.ndarray]] = {}
+        # Каскад: KDTree по PCA-проекции малой размерности отбирает
+        # cascade_candidates кандидатов, точные расстояния считаются только для них
+        self.cascade = cascade
+        self.cascade_dim = cascade_dim
+        self.cascade_candidates = cascade_candidates
+        self.projector: Optional[PCAProjector] = None
+        self.coarse_tree = None
+        self._embeddings32 = None
+        self.stage_stats = {'queries': 0, 'coarse_time': 0.0, 'exact_time': 0.0}
         # Адаптивные веса для комбинирования расстояний
         self.weights = {
             'distance': 0.7,
@@ -47,108 +71,345 @@ class EnhancedBiometricSearch:
         total = sum(weights.values())
         return {k: v/total for k, v in weights.items()}
     
-    def extract_additional_features(self, img_path: str) -> Tuple[int, int]:
-        """Извлекает пол и возраст из изображения с кэшированием"""
-        if img_path in self.gender_cache and img_path in self.age_cache:
-            return self.gender_cache[img_path], self.age_cache[img_path]
+    def _attributes(self) -> AttributePipeline:
+        """Конвейер атрибутов создается при первом обращении"""
+        if self.attribute_pipeline is None:
+            self.attribute_pipeline = AttributePipeline()
+        return self.attribute_pipeline
+    
+    def extract_additional_features(self, img_path: str) -> Tuple[int, float]:
+        """
+        Возвращает пол и возраст для изображения: для лиц индекса — из массивов
+        атрибутов, для остальных — через конвейер DeepFace с постоянным кэшем.
+        Неизвестный пол — UNKNOWN_GENDER, неизвестный возраст — NaN
+        """
+        row = self._path_rows.get(img_path)
+        if row is not None:
+            return int(self.genders[row]), float(self.ages[row])
         
-        try:
-            # В реальном приложении здесь был бы вызов DeepFace или другой модели
-            # Для демонстрации используем случайные значения
-            gender = np.random.randint(0, 2)
-            age = np.random.randint(18, 70)
-            
-            # Кэшируем результаты
-            self.gender_cache[img_path] = gender
-            self.age_cache[img_path] = age
-            
-            return gender, age
-        except Exception as e:
-            self.logger.error(f"Ошибка при анализе {img_path}: {e}")
-            return 0, 30
+        genders, _, ages = self._attributes().analyze([img_path])
+        return int(genders[0]), float(ages[0])
+    
+    @staticmethod
+    def _gender_label(gender: int) -> str:
+        if gender == UNKNOWN_GENDER:
+            return "Не определен"
+        return "Женщина" if gender == FEMALE else "Мужчина"
     
-    def _normalize_age_difference(self, age_diff: float) -> float:
-        """Нормализация разницы в возрасте с учетом нелинейности"""
+    def _normalize_age_difference(self, age_diff: np.ndarray) -> np.ndarray:
+        """Нормализация разницы в возрасте с учетом нелинейности; NaN (возраст неизвестен) дает 0"""
         max_age_diff = 50.0
-        normalized = abs(age_diff) / max_age_diff
+        normalized = np.abs(age_diff) / max_age_diff
         # Применяем нелинейное преобразование для учета больших различий
-        return 1 - np.exp(-normalized * 3)
-    
-    def _calculate_combined_score(self, base_distance: float,
-                                query_gender: int, candidate_gender: int,
-                                query_age: int, candidate_age: int,
-                                weights: Dict[str, float]) -> float:
-        """Вычисляет комбинированный счет с учетом всех признаков"""
-        gender_penalty = 0 if query_gender == candidate_gender else 1
-        age_penalty = self._normalize_age_difference(query_age - candidate_age)
-        
-        return (
-            weights['distance'] * base_distance +
-            weights['gender'] * gender_penalty +
-            weights['age'] * age_penalty
-        )
+        return np.nan_to_num(1 - np.exp(-normalized * 3))
+    
+    def _rerank(self, query_embeddings: np.ndarray, distances: np.ndarray,
+                indices: np.ndarray, query_genders: np.ndarray, query_ages: np.ndarray,
+                k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Комбинированные оценки кандидатов (B, K) одним выражением NumPy по
+        массивам атрибутов и выбор k лучших через argpartition.
+        Возвращает индексы и оценки (B, k), упорядоченные по возрастанию оценки
+        """
+        # Адаптивные веса для всей пачки, как в _calculate_adaptive_weights
+        quality_factor = 0.5 + (np.linalg.norm(query_embeddings, axis=1) /
+                                np.max(np.abs(query_embeddings), axis=1))
+        w_distance = self.weights['distance'] * quality_factor
+        w_gender = self.weights['gender'] * (2 - quality_factor)
+        w_age = self.weights['age'] * (2 - quality_factor)
+        total = w_distance + w_gender + w_age
+        
+        # Неизвестный пол или возраст не штрафуется
+        candidate_genders = self.genders[indices]
+        gender_penalty = ((candidate_genders != query_genders[:, None]) &
+                          (candidate_genders != UNKNOWN_GENDER) &
+                          (query_genders[:, None] != UNKNOWN_GENDER))
+        age_penalty = self._normalize_age_difference(self.ages[indices] - query_ages[:, None])
+        scores = ((w_distance / total)[:, None] * distances +
+                  (w_gender / total)[:, None] * gender_penalty +
+                  (w_age / total)[:, None] * age_penalty)
+        
+        k = min(k, scores.shape[1])
+        top = np.argpartition(scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        return np.take_along_axis(indices, top, axis=1), np.take_along_axis(top_scores, order, axis=1)
     
     def build_index(self, embeddings: np.ndarray, face_paths: List[str]) -> None:
-        """Построение индекса с параллельной загрузкой биометрических данных"""
+        """Построение индекса с пакетным извлечением биометрических данных"""
         self.embeddings = embeddings
         self.face_paths = face_paths
         
         # Построение KDTree для базового поиска
         self.tree = KDTree(embeddings)
         
-        # Параллельная загрузка биометрических данных
+        # Атрибуты берутся из кэша, промахи пачками уходят в пул процессов DeepFace
         self.logger.info("Загрузка дополнительных биометрических данных...")
-        with ThreadPoolExecutor() as executor:
-            list(executor.map(self.extract_additional_features, face_paths))
+        self.genders, self.gender_confidences, self.ages = self._attributes().analyze(face_paths)
+        self._path_rows = {path: row for row, path in enumerate(face_paths)}
+        known = int(np.count_nonzero(self.genders != UNKNOWN_GENDER))
+        self.logger.info(f"Атрибуты определены для {known} из {len(face_paths)} изображений")
+        
+        self.partitions = {}
+        if self.partitioned:
+            self.build_partitions()
+        
+        self.coarse_tree = None
+        if self.cascade:
+            self.build_cascade()
         
         self.logger.info(f"Индекс построен для {len(embeddings)} изображений")
     
+    def build_cascade(self, sample_size: int = 50000) -> None:
+        """
+        Строит первую ступень каскада: PCA до cascade_dim, обученная на
+        sample_size случайных эмбеддингах, и KDTree по проекциям.
+        Для второй ступени эмбеддинги хранятся в float32
+        """
+        rng = np.random.default_rng(0)
+        sample = self.embeddings if len(self.embeddings) <= sample_size else \
+            self.embeddings[rng.choice(len(self.embeddings), sample_size, replace=False)]
+        self.projector = PCAProjector(self.cascade_dim).fit(sample)
+        self._embeddings32 = np.ascontiguousarray(self.embeddings, dtype=np.float32)
+        self.coarse_tree = KDTree(self.projector.transform(self._embeddings32))
+        self.logger.info(f"Каскад построен: проекция {self.embeddings.shape[1]} -> "
+                         f"{self.projector.components.shape[0]}")
+    
+    def _cascade_query(self, query_embeddings: np.ndarray, k: int,
+                       num_candidates: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Двухступенчатый поиск k ближайших для пачки запросов: кандидаты по
+        проекции, затем точные расстояния по полным векторам float32 только
+        для них. Возвращает расстояния и индексы (B, k), как KDTree.query
+        """
+        num_candidates = min(max(num_candidates or self.cascade_candidates, k),
+                             len(self._embeddings32))
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        
+        start_time = time.perf_counter()
+        _, candidates = self.coarse_tree.query(self.projector.transform(queries), k=num_candidates)
+        coarse_time = time.perf_counter() - start_time
+        
+        distances = np.linalg.norm(self._embeddings32[candidates] - queries[:, None, :], axis=2)
+        top = np.argpartition(distances, k - 1, axis=1)[:, :k] if k < num_candidates \
+            else np.broadcast_to(np.arange(num_candidates), distances.shape)
+        top_distances = np.take_along_axis(distances, top, axis=1)
+        order = np.argsort(top_distances, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        exact_time = time.perf_counter() - start_time - coarse_time
+        
+        self.stage_stats['queries'] += len(queries)
+        self.stage_stats['coarse_time'] += coarse_time
+        self.stage_stats['exact_time'] += exact_time
+        return (np.take_along_axis(top_distances, order, axis=1).astype(np.float64),
+                np.take_along_axis(candidates, top, axis=1))
+    
+    def _candidates(self, query_embeddings: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """k ближайших кандидатов по эмбеддингу: каскадом, если он построен, иначе KDTree"""
+        if self.coarse_tree is not None:
+            return self._cascade_query(query_embeddings, k)
+        return self.tree.query(query_embeddings, k=k)
+    
+    def cascade_timings(self) -> Dict[str, float]:
+        """Среднее время ступеней каскада на запрос, мс"""
+        queries = max(self.stage_stats['queries'], 1)
+        return {
+            'queries': self.stage_stats['queries'],
+            'coarse_ms': 1000.0 * self.stage_stats['coarse_time'] / queries,
+            'exact_ms': 1000.0 * self.stage_stats['exact_time'] / queries
+        }
+    
+    def _age_buckets(self, ages: np.ndarray) -> np.ndarray:
+        """Номера возрастных групп; -1 для неизвестного возраста"""
+        buckets = np.searchsorted(self.age_bucket_edges, ages, side='right').astype(np.int64)
+        buckets[np.isnan(ages)] = -1
+        return buckets
+    
+    def build_partitions(self) -> None:
+        """Строит отдельное KDTree для каждой пары (пол, возрастная группа)"""
+        buckets = self._age_buckets(self.ages)
+        # Лица с неизвестным полом попадают в одну общую группу
+        genders = self.genders.astype(np.int64)
+        buckets[genders == UNKNOWN_GENDER] = -1
+        keys = genders * (len(self.age_bucket_edges) + 2) + buckets
+        
+        order = np.argsort(keys, kind='stable')
+        _, starts = np.unique(keys[order], return_index=True)
+        self.partitions = {}
+        for rows in np.split(order, starts[1:]):
+            gender = int(genders[rows[0]])
+            self.partitions[(gender, int(buckets[rows[0]]))] = (KDTree(self.embeddings[rows]), rows)
+        self.logger.info(f"Построено {len(self.partitions)} подындексов по полу и возрасту")
+    
+    def _route(self, gender: int, confidence: float, age: float,
+               min_confidence: float, age_margin: float) -> Optional[List[Tuple[int, int]]]:
+        """
+        Подындексы для запроса: при уверенном поле — только его группы, иначе
+        обе; соседняя возрастная группа добавляется, если возраст ближе
+        age_margin к границе. Группы с неизвестными атрибутами просматриваются
+        всегда. None — атрибуты запроса неизвестны и нужен полный поиск
+        """
+        if gender == UNKNOWN_GENDER and np.isnan(age):
+            return None
+        
+        genders = [gender] if gender != UNKNOWN_GENDER and confidence >= min_confidence \
+            else [MALE, FEMALE]
+        num_buckets = len(self.age_bucket_edges) + 1
+        if np.isnan(age):
+            buckets = list(range(num_buckets))
+        else:
+            bucket = int(self._age_buckets(np.array([age], dtype=np.float32))[0])
+            buckets = [bucket]
+            if bucket > 0 and age - self.age_bucket_edges[bucket - 1] < age_margin:
+                buckets.append(bucket - 1)
+            if bucket < num_buckets - 1 and self.age_bucket_edges[bucket] - age < age_margin:
+                buckets.append(bucket + 1)
+        
+        keys = [(g, b) for g in genders for b in buckets + [-1]]
+        return keys + [(UNKNOWN_GENDER, -1)]
+    
+    def build_index_from_chunks(self, chunks: Iterable[Tuple[List[str], np.ndarray]],
+                                size: int) -> None:
+        """
+        Построение индекса из потока чанков (пути, эмбеддинги), например из
+        BiometricDatabase.iter_faces. Чанки копируются в заранее выделенную
+        матрицу float64, которую KDTree использует без повторного копирования
+        """
+        face_paths, embeddings = collect_chunks(chunks, size, dtype=np.float64)
+        self.build_index(embeddings, face_paths)
+    
     def search(self, query_embedding: np.ndarray, 
               query_img_path: Optional[str] = None, 
-              k: int = 5) -> Tuple[List[int], List[float], float]:
+              k: int = 5,
+              query_attributes: Optional[Tuple[int, float, float]] = None
+              ) -> Tuple[List[int], List[float], float]:
         """
-        Поиск ближайших совпадений с учетом дополнительных биометрических признаков
+        Поиск ближайших совпадений с учетом дополнительных биометрических признаков.
+        В режиме cascade кандидаты отбираются двухступенчатым поиском.
+        query_attributes — уже известные (пол, уверенность, возраст) запроса;
+        без них атрибуты определяются по изображению query_img_path
         """
         start_time = time.time()
         
         # Увеличиваем количество кандидатов для более точного поиска
         expanded_k = min(k * 5, len(self.embeddings))
-        distances, indices = self.tree.query([query_embedding], k=expanded_k)
+        distances, indices = self._candidates(np.atleast_2d(query_embedding), expanded_k)
         
-        if not query_img_path:
+        if not query_img_path and query_attributes is None:
             return indices[0][:k], distances[0][:k], time.time() - start_time
         
-        # Извлекаем биометрические данные запроса
-        query_gender, query_age = self.extract_additional_features(query_img_path)
+        # Биометрические данные запроса и переранжирование кандидатов по массивам атрибутов
+        query_genders, _, query_ages = self._single_query_attributes(query_img_path, query_attributes)
+        result_indices, result_scores = self._rerank(
+            np.atleast_2d(query_embedding), distances, indices, query_genders, query_ages, k)
+        
+        return list(result_indices[0]), list(result_scores[0]), time.time() - start_time
+    
+    def search_partitioned(self, query_embedding: np.ndarray, query_img_path: Optional[str] = None,
+                           k: int = 5, min_confidence: float = 0.9, age_margin: float = 3.0,
+                           query_attributes: Optional[Tuple[int, float, float]] = None
+                           ) -> Tuple[List[int], List[float], float]:
+        """
+        Поиск с предварительным фильтром: запрос просматривает только
+        подындексы своего пола и возрастной группы, затем кандидаты
+        переранжируются как в search. Без атрибутов запроса или подындексов
+        выполняется обычный поиск по всему дереву
+        """
+        if not self.partitions or (not query_img_path and query_attributes is None):
+            return self.search(query_embedding, query_img_path, k, query_attributes)
+        
+        start_time = time.time()
+        query_genders, query_confidences, query_ages = self._single_query_attributes(
+            query_img_path, query_attributes)
+        keys = self._route(int(query_genders[0]), float(query_confidences[0]),
+                           float(query_ages[0]), min_confidence, age_margin)
+        if keys is None:
+            return self.search(query_embedding, query_img_path, k, query_attributes)
+        
+        expanded_k = k * 5
+        distances, indices = [], []
+        for key in keys:
+            if key not in self.partitions:
+                continue
+            tree, rows = self.partitions[key]
+            part_distances, part_indices = tree.query([query_embedding], k=min(expanded_k, len(rows)))
+            distances.append(part_distances[0])
+            indices.append(rows[part_indices[0]])
+        if not distances:
+            return self.search(query_embedding, query_img_path, k, query_attributes)
         
-        # Вычисляем адаптивные веса
-        weights = self._calculate_adaptive_weights(query_embedding)
-        
-        # Параллельная обработка кандидатов
-        with ThreadPoolExecutor() as executor:
-            candidate_features = list(executor.map(
-                lambda idx: self.extract_additional_features(self.face_paths[idx]),
-                indices[0]
-            ))
-        
-        # Вычисляем комбинированные оценки
-        combined_scores = []
-        for i, (candidate_gender, candidate_age) in enumerate(candidate_features):
-            base_distance = distances[0][i]
-            combined_score = self._calculate_combined_score(
-                base_distance,
-                query_gender, candidate_gender,
-                query_age, candidate_age,
-                weights
-            )
-            combined_scores.append((indices[0][i], combined_score))
-        
-        # Сортировка и выбор лучших результатов
-        combined_scores.sort(key=lambda x: x[1])
-        result_indices = [idx for idx, _ in combined_scores[:k]]
-        result_distances = [score for _, score in combined_scores[:k]]
-        
-        return result_indices, result_distances, time.time() - start_time
+        # Слияние кандидатов подындексов: k*5 ближайших по расстоянию
+        distances, indices = np.concatenate(distances), np.concatenate(indices)
+        if len(distances) > expanded_k:
+            top = np.argpartition(distances, expanded_k - 1)[:expanded_k]
+            distances, indices = distances[top], indices[top]
+        
+        result_indices, result_scores = self._rerank(
+            np.atleast_2d(query_embedding), distances[None, :], indices[None, :],
+            query_genders, query_ages, k)
+        return list(result_indices[0]), list(result_scores[0]), time.time() - start_time
+    
+    def search_batch(self, query_embeddings: np.ndarray,
+                     query_img_paths: Optional[List[Optional[str]]] = None,
+                     k: int = 5) -> List[Tuple[List[int], List[float], float]]:
+        """
+        Пакетный поиск: один запрос к KDTree для всех эмбеддингов и
+        векторизованное переранжирование. Для каждого запроса возвращает
+        (индексы, расстояния, время), где время — доля общего времени пачки
+        """
+        start_time = time.time()
+        query_embeddings = np.atleast_2d(query_embeddings)
+        num_queries = len(query_embeddings)
+        if query_img_paths is None:
+            query_img_paths = [None] * num_queries
+        
+        expanded_k = min(k * 5, len(self.embeddings))
+        distances, indices = self._candidates(query_embeddings, expanded_k)
+        result_indices = indices[:, :k].copy()
+        result_distances = distances[:, :k].copy()
+        
+        # Переранжируем только запросы, для которых известно изображение
+        ranked = [i for i, path in enumerate(query_img_paths) if path]
+        if ranked:
+            query_genders, _, query_ages = self._query_attributes([query_img_paths[i] for i in ranked])
+            result_indices[ranked], result_distances[ranked] = self._rerank(
+                query_embeddings[ranked], distances[ranked], indices[ranked],
+                query_genders, query_ages, k)
+        
+        per_query_time = (time.time() - start_time) / num_queries
+        return [(list(result_indices[i]), list(result_distances[i]), per_query_time)
+                for i in range(num_queries)]
+    
+    def _query_attributes(self, img_paths: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Пол, уверенность в нем и возраст пачки запросов: лица индекса из
+        массивов, остальные одной пачкой через конвейер атрибутов
+        """
+        rows = np.array([self._path_rows.get(path, -1) for path in img_paths], dtype=np.int64)
+        genders = np.full(len(img_paths), UNKNOWN_GENDER, dtype=np.int8)
+        confidences = np.zeros(len(img_paths), dtype=np.float32)
+        ages = np.full(len(img_paths), np.nan, dtype=np.float32)
+        known = rows >= 0
+        genders[known] = self.genders[rows[known]]
+        confidences[known] = self.gender_confidences[rows[known]]
+        ages[known] = self.ages[rows[known]]
+        
+        unknown = np.flatnonzero(~known)
+        if len(unknown):
+            genders[unknown], confidences[unknown], ages[unknown] = self._attributes().analyze(
+                [img_paths[i] for i in unknown])
+        return genders, confidences, ages
+    
+    def _single_query_attributes(self, img_path: Optional[str],
+                                 attributes: Optional[Tuple[int, float, float]]
+                                 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Атрибуты одного запроса в виде массивов длины 1"""
+        if attributes is None:
+            return self._query_attributes([img_path])
+        gender, confidence, age = attributes
+        return (np.array([gender], dtype=np.int8), np.array([confidence], dtype=np.float32),
+                np.array([age], dtype=np.float32))
     
     def debug_info(self, query_img_path: str, result_indices: List[int]) -> None:
         """Отображение отладочной информации"""
@@ -157,14 +418,14 @@ class EnhancedBiometricSearch:
         
         self.logger.info("\nОтладочная информация запроса:")
         query_gender, query_age = self.extract_additional_features(query_img_path)
-        gender_label = "Женщина" if query_gender == 1 else "Мужчина"
+        gender_label = self._gender_label(query_gender)
         self.logger.info(f"Запрос: {os.path.basename(query_img_path)}, Пол: {gender_label}, Возраст: {query_age}")
         
         self.logger.info("\nТоп результаты:")
         for i, idx in enumerate(result_indices):
             candidate_path = self.face_paths[idx]
             candidate_gender, candidate_age = self.extract_additional_features(candidate_path)
-            gender_label = "Женщина" if candidate_gender == 1 else "Мужчина"
+            gender_label = self._gender_label(candidate_gender)
             self.logger.info(f"{i+1}. {os.path.basename(candidate_path)}, Пол: {gender_label}, Возраст: {candidate_age}")
 
 # Тестовые данные для бенчмаркинга
@@ -1,25 +1,55 @@
 import cv2
 import numpy as np
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Iterable
+from collections import OrderedDict
 import os
-from database import BiometricDatabase
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from database import BiometricDatabase, collect_chunks
+from feature_extractor import FaceEmbedder, HOGExtractor
 
 class FaceProcessor:
-    def __init__(self):
-        """Инициализация процессора лиц"""
+    # Порог евклидова расстояния для сырых пикселей лица 100x100
+    RAW_DISTANCE_THRESHOLD = 1000.0
+    # Сколько пользователей держит кэш шаблонов для проверки 1:1
+    TEMPLATE_CACHE_SIZE = 10000
+    
+    def __init__(self, embedder: Optional[FaceEmbedder] = None,
+                 distance_threshold: Optional[float] = None,
+                 db: Optional[BiometricDatabase] = None):
+        """
+        Инициализация процессора лиц.
+        С обученным embedder линейный поиск идет по компактным эмбеддингам;
+        distance_threshold задается в единицах выбранного пространства; если он
+        не задан, берется RAW_DISTANCE_THRESHOLD для пикселей или порог,
+        оцененный embedder при обучении, для эмбеддингов.
+        db — готовое подключение к базе (например, SQLite); по умолчанию PostgreSQL
+        """
         # Загружаем каскадный классификатор для обнаружения лиц
-        cascade_path = 'haarcascade_frontalface_default.xml'
-        if not os.path.exists(cascade_path):
-            raise FileNotFoundError(f"Файл каскадного классификатора не найден: {cascade_path}")
-        self.face_cascade = cv2.CascadeClassifier(cascade_path)
+        self.cascade_path = 'haarcascade_frontalface_default.xml'
+        if not os.path.exists(self.cascade_path):
+            raise FileNotFoundError(f"Файл каскадного классификатора не найден: {self.cascade_path}")
+        self.face_cascade = cv2.CascadeClassifier(self.cascade_path)
         
         # Инициализируем базу данных
-        self.db = BiometricDatabase()
+        self.db = db if db is not None else BiometricDatabase()
+        self.embedder = embedder
+        self.distance_threshold = distance_threshold
+        self.hog_extractor = HOGExtractor()
+        
+        # Кэш галереи в памяти: id, матрица лиц float32 и квадраты их норм
+        self._gallery_ids: Optional[List[str]] = None
+        self._gallery: Optional[np.ndarray] = None
+        self._gallery_sq_norms: Optional[np.ndarray] = None
+        # Шаблоны пользователей для проверки 1:1, читаются из базы по мере
+        # обращения и вытесняются по LRU
+        self._templates: OrderedDict = OrderedDict()
         
-    def detect_face(self, image: np.ndarray) -> Optional[np.ndarray]:
+    def detect_face(self, image: np.ndarray,
+                    cascade: Optional[cv2.CascadeClassifier] = None) -> Optional[np.ndarray]:
         """Обнаружение лица на изображении"""
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        faces = self.face_cascade.detectMultiScale(gray, 1.3, 5)
+        faces = (cascade or self.face_cascade).detectMultiScale(gray, 1.3, 5)
         
         if len(faces) == 0:
             return None
@@ -38,33 +68,180 @@ class FaceProcessor:
         if face is None:
             raise ValueError("Лицо не обнаружено на изображении")
             
-        self.db.add_face(user_id, face)
+        embedding = self.embedder.embed(face) if self._use_embeddings() else None
+        self.db.add_face(user_id, face, embedding)
+        self._invalidate_gallery()
+        
+    def detect_faces_parallel(self, images: Iterable[np.ndarray],
+                              max_workers: Optional[int] = None) -> List[Optional[np.ndarray]]:
+        """Обнаружение лиц на изображениях в пуле потоков"""
+        # OpenCV отпускает GIL внутри detectMultiScale; каждому потоку — свой классификатор
+        local = threading.local()
+        
+        def detect(image: np.ndarray) -> Optional[np.ndarray]:
+            if not hasattr(local, 'cascade'):
+                local.cascade = cv2.CascadeClassifier(self.cascade_path)
+            return self.detect_face(image, local.cascade)
+            
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(detect, images))
+        
+    def add_faces_bulk(self, faces: Iterable[Tuple[np.ndarray, str]],
+                       detect: bool = False,
+                       max_workers: Optional[int] = None) -> int:
+        """
+        Массовое добавление пар (лицо, id) в базу данных одной транзакцией.
+        При detect=True на входе кадры, лица на которых ищутся параллельно;
+        кадры без лица пропускаются. Возвращает количество добавленных лиц
+        """
+        if detect:
+            faces = list(faces)
+            crops = self.detect_faces_parallel([image for image, _ in faces], max_workers)
+            faces = [(crop, user_id) for crop, (_, user_id) in zip(crops, faces)
+                     if crop is not None]
+            
+        if self._use_embeddings():
+            faces = list(faces)
+            embeddings = self.embedder.transform([face for face, _ in faces])
+            rows = ((user_id, face, embedding)
+                    for (face, user_id), embedding in zip(faces, embeddings))
+        else:
+            rows = ((user_id, face) for face, user_id in faces)
+        count = self.db.add_faces_bulk(rows)
+        self._invalidate_gallery()
+        return count
+        
+    def _use_embeddings(self) -> bool:
+        return self.embedder is not None and self.embedder.is_fitted
+        
+    @property
+    def threshold(self) -> float:
+        """Порог расстояния в текущем пространстве распознавания"""
+        if self.distance_threshold is not None:
+            return self.distance_threshold
+        if not self._use_embeddings():
+            return self.RAW_DISTANCE_THRESHOLD
+        if self.embedder.default_threshold is None:
+            raise ValueError("Для эмбеддингов без оцененного порога нужно задать distance_threshold")
+        return self.embedder.default_threshold
+        
+    def fit_embedder(self, embedder: Optional[FaceEmbedder] = None,
+                     sample_size: int = 10000) -> int:
+        """
+        Обучение PCA-проекции на первых sample_size лицах базы
+        и пересчет эмбеддингов всех записей
+        """
+        self.embedder = embedder or self.embedder or FaceEmbedder()
+        sample = []
+        for _, block in self.db.iter_faces():
+            sample.extend(block[:sample_size - len(sample)])
+            if len(sample) >= sample_size:
+                break
+        if not sample:
+            return 0
+            
+        self.embedder.fit(sample)
+        self.db.update_embeddings(self.embedder.transform, only_missing=False)
+        self._invalidate_gallery()
+        return len(sample)
+        
+    def _invalidate_gallery(self) -> None:
+        """Сбрасывает кэш галереи после изменения базы данных"""
+        self._gallery_ids = None
+        self._gallery = None
+        self._gallery_sq_norms = None
+        self._templates.clear()
+        
+    def _load_gallery(self) -> None:
+        """Загружает галерею из базы данных в память"""
+        if self._use_embeddings():
+            self.db.update_embeddings(self.embedder.transform)
+            self._gallery_ids, gallery = collect_chunks(self.db.iter_embeddings(),
+                                                        self.db.count_embeddings())
+        else:
+            self._gallery_ids, gallery = self.db.get_all_faces_matrix()
+        self._gallery = gallery.astype(np.float32, copy=False)
+        self._gallery_sq_norms = np.einsum('ij,ij->i', self._gallery, self._gallery)
+        
+    def find_nearest_faces(self, face: np.ndarray, k: int = 1) -> List[Tuple[str, float]]:
+        """
+        Линейный поиск k ближайших лиц по евклидову расстоянию.
+        Расстояния до всей галереи считаются одним выражением
+        ||a||^2 + ||b||^2 - 2ab во float32
+        """
+        if self._gallery is None:
+            self._load_gallery()
+        if not self._gallery_ids or k <= 0:
+            return []
+            
+        if self._use_embeddings():
+            query = self.embedder.embed(face)
+        else:
+            query = np.ravel(face).astype(np.float32)
+        sq_dists = self._gallery_sq_norms + query @ query - 2.0 * (self._gallery @ query)
+        np.maximum(sq_dists, 0.0, out=sq_dists)
+        
+        k = min(k, len(sq_dists))
+        top = np.argpartition(sq_dists, k - 1)[:k]
+        top = top[np.argsort(sq_dists[top])]
+        return [(self._gallery_ids[i], float(np.sqrt(sq_dists[i]))) for i in top]
         
     def recognize_face(self, face: np.ndarray) -> Optional[str]:
         """Распознавание лица с использованием линейного поиска"""
         if face is None:
             return None
             
-        # Получаем все лица из базы данных
-        faces = self.db.get_all_faces()
+        matches = self.find_nearest_faces(face, k=1)
+        if not matches:
+            return None
+            
+        best_match, min_distance = matches[0]
+        return best_match if min_distance < self.threshold else None
         
-        best_match = None
-        min_distance = float('inf')
+    def _user_templates(self, user_id: str) -> np.ndarray:
+        """Шаблоны пользователя (n, D): из кэша или выборкой из базы по индексу faces(user_id)"""
+        templates = self._templates.get(user_id)
+        if templates is not None:
+            self._templates.move_to_end(user_id)
+            return templates
+            
+        if self._use_embeddings():
+            templates = self.db.get_user_embeddings(user_id)
+        else:
+            templates = self.db.get_user_faces(user_id)
+        # Пустой ответ не кэшируется: запросы с произвольными id не должны занимать память
+        if len(templates):
+            templates = np.reshape(templates, (len(templates), -1)).astype(np.float32, copy=False)
+            self._templates[user_id] = templates
+            if len(self._templates) > self.TEMPLATE_CACHE_SIZE:
+                self._templates.popitem(last=False)
+        return templates
         
-        # Линейный поиск
-        for user_id, stored_face in faces:
-            # Вычисляем расстояние между лицами
-            distance = np.linalg.norm(face - stored_face)
+    def verify(self, face: np.ndarray, user_id: str) -> Tuple[bool, float]:
+        """
+        Проверка 1:1 заявленной личности по шаблонам одного пользователя,
+        без поиска по галерее. Возвращает признак совпадения и наименьшее
+        евклидово расстояние в пространстве распознавания
+        """
+        if face is None:
+            return False, float('inf')
             
-            if distance < min_distance:
-                min_distance = distance
-                best_match = user_id
-                
-        return best_match if min_distance < 1000 else None
+        templates = self._user_templates(user_id)
+        if len(templates) == 0:
+            return False, float('inf')
+            
+        if self._use_embeddings():
+            query = self.embedder.embed(face)
+        else:
+            query = np.ravel(face).astype(np.float32)
+        diff = templates - query
+        distance = float(np.sqrt(np.min(np.einsum('ij,ij->i', diff, diff))))
+        return distance < self.threshold, distance
         
     def clear_database(self) -> None:
         """Очистка базы данных"""
         self.db.clear_database()
+        self._invalidate_gallery()
         
     def _retrain_recognizer(self) -> None:
         """
@@ -93,14 +270,8 @@ class FaceProcessor:
         """
         Извлекает признаки лица для сравнения
         """
-        # Нормализация размера
-        face = cv2.resize(face, (100, 100))
-        
-        # Гистограмма градиентов
-        hog = cv2.HOGDescriptor()
-        features = hog.compute(face)
-        
-        return features
+        # Гистограмма градиентов по окну под размер лица
+        return self.hog_extractor.extract(face)
         
     def compare_faces(self, face1: np.ndarray, face2: np.ndarray) -> float:
         """
@@ -0,0 +1,133 @@
+import time
+from collections import deque
+import cv2
+import numpy as np
+from typing import Tuple, Dict, Optional
+
+Box = Tuple[int, int, int, int]
+
+
+class FaceTracker:
+    """
+    Детекция лица для видеопотока с камеры.
+
+    Каскад Хаара запускается не на полном кадре, а на уменьшенном до
+    detection_width по ширине. Между кадрами запоминается последнее найденное
+    лицо: следующий кадр просматривается только в его окрестности,
+    расширенной на roi_margin, и только на масштабах, близких к его размеру.
+    Раз в full_search_interval кадров, а также при потере лица выполняется
+    поиск по всему кадру. Лицо вырезается из полноразмерного кадра.
+    """
+
+    def __init__(self, cascade: cv2.CascadeClassifier, detection_width: int = 320,
+                 full_search_interval: int = 10, roi_margin: float = 0.5,
+                 scale_factor: float = 1.1, min_neighbors: int = 5,
+                 face_size: int = 100, window: int = 100):
+        self.cascade = cascade
+        self.detection_width = detection_width
+        self.full_search_interval = full_search_interval
+        self.roi_margin = roi_margin
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.face_size = face_size
+        # Время и длительность последних window детекций для счетчиков FPS и задержки
+        self._timestamps = deque(maxlen=window)
+        self._latencies = deque(maxlen=window)
+        self.frames = 0
+        self.full_searches = 0
+        self.roi_searches = 0
+        self.reset()
+
+    def reset(self) -> None:
+        """Забывает отслеживаемое лицо: следующий кадр ищется целиком"""
+        self.last_box: Optional[Box] = None
+        self._frames_since_full = 0
+
+    def _detect(self, gray: np.ndarray, offset: Tuple[int, int], scale: float,
+                min_size: int = 30, max_size: int = 0) -> Optional[Box]:
+        """Ищет самое крупное лицо в gray, уменьшенном в scale раз; координаты — в полном кадре"""
+        small = gray if scale == 1.0 else cv2.resize(gray, None, fx=scale, fy=scale,
+                                                     interpolation=cv2.INTER_AREA)
+        faces = self.cascade.detectMultiScale(
+            small, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors,
+            minSize=(min_size, min_size),
+            maxSize=(max_size, max_size) if max_size else (0, 0))
+        if len(faces) == 0:
+            return None
+        x, y, w, h = max(faces, key=lambda face: face[2] * face[3])
+        return (int(x / scale) + offset[0], int(y / scale) + offset[1],
+                int(w / scale), int(h / scale))
+
+    def _full_search(self, gray: np.ndarray) -> Optional[Box]:
+        self.full_searches += 1
+        scale = min(1.0, self.detection_width / gray.shape[1])
+        return self._detect(gray, (0, 0), scale, min_size=max(20, int(30 * scale)))
+
+    def _roi_search(self, gray: np.ndarray) -> Optional[Box]:
+        """Поиск в расширенной окрестности последнего лица на близких масштабах"""
+        self.roi_searches += 1
+        x, y, w, h = self.last_box
+        margin_x, margin_y = int(w * self.roi_margin), int(h * self.roi_margin)
+        x0, y0 = max(0, x - margin_x), max(0, y - margin_y)
+        x1 = min(gray.shape[1], x + w + margin_x)
+        y1 = min(gray.shape[0], y + h + margin_y)
+        # Окрестность уменьшается так, чтобы лицо было около 60 пикселей
+        scale = min(1.0, 60.0 / max(w, 1))
+        face_size = w * scale
+        return self._detect(gray[y0:y1, x0:x1], (x0, y0), scale,
+                            min_size=max(20, int(face_size / 1.5)),
+                            max_size=int(face_size * 1.5) + 1)
+
+    def detect(self, frame: np.ndarray,
+               full_search: bool = False) -> Optional[Tuple[np.ndarray, Box]]:
+        """
+        Находит лицо на кадре BGR. Возвращает лицо face_size x face_size
+        в оттенках серого и его прямоугольник (x, y, w, h) или None
+        """
+        start_time = time.perf_counter()
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        box = None
+        if (not full_search and self.last_box is not None and
+                self._frames_since_full < self.full_search_interval):
+            box = self._roi_search(gray)
+            self._frames_since_full += 1
+        if box is None:
+            box = self._full_search(gray)
+            self._frames_since_full = 0
+        self.last_box = box
+
+        result = None
+        if box is not None:
+            x, y, w, h = box
+            result = cv2.resize(gray[y:y+h, x:x+w], (self.face_size, self.face_size)), box
+
+        now = time.perf_counter()
+        self.frames += 1
+        self._timestamps.append(now)
+        self._latencies.append(now - start_time)
+        return result
+
+    @property
+    def fps(self) -> float:
+        """Частота вызовов детекции по последним кадрам"""
+        if len(self._timestamps) < 2:
+            return 0.0
+        return (len(self._timestamps) - 1) / (self._timestamps[-1] - self._timestamps[0])
+
+    @property
+    def latency_ms(self) -> float:
+        """Средняя длительность детекции по последним кадрам, мс"""
+        if not self._latencies:
+            return 0.0
+        return 1000.0 * sum(self._latencies) / len(self._latencies)
+
+    def stats(self) -> Dict[str, float]:
+        """Счетчики детекции"""
+        return {
+            'frames': self.frames,
+            'full_searches': self.full_searches,
+            'roi_searches': self.roi_searches,
+            'fps': self.fps,
+            'latency_ms': self.latency_ms
+        }
@@ -0,0 +1,203 @@
+import cv2
+import numpy as np
+from typing import List, Optional, Sequence
+
+
+class FeatureExtractor:
+    """
+    Базовый класс извлечения признаков из вырезанного лица в оттенках серого.
+    Наследники реализуют extract для одного лица.
+    """
+
+    name = 'base'
+
+    def extract(self, face: np.ndarray) -> np.ndarray:
+        """Возвращает вектор признаков лица (float32)"""
+        raise NotImplementedError
+
+    def extract_batch(self, faces: Sequence[np.ndarray]) -> np.ndarray:
+        """Возвращает матрицу признаков (N, F) для списка лиц"""
+        return np.stack([self.extract(face) for face in faces])
+
+    @staticmethod
+    def _to_uint8(face: np.ndarray, size: int) -> np.ndarray:
+        """Приводит лицо к квадрату size x size в uint8"""
+        face = np.asarray(face)
+        if face.ndim == 1:
+            side = int(np.sqrt(face.size))
+            face = face.reshape(side, side)
+        if face.dtype != np.uint8:
+            # Лица бывают нормированы в [0, 1] или в [0, 255]; HOG и LBP не зависят
+            # от контраста, поэтому растягиваем диапазон на [0, 255]
+            face = cv2.normalize(face.astype(np.float32), None, 0, 255,
+                                 cv2.NORM_MINMAX, cv2.CV_8U)
+        return cv2.resize(face, (size, size))
+
+
+class HOGExtractor(FeatureExtractor):
+    """Гистограммы направленных градиентов по окну size x size"""
+
+    name = 'hog'
+
+    def __init__(self, size: int = 96, cell_size: int = 8, nbins: int = 9):
+        self.size = size
+        # Блок 2x2 ячейки с шагом в одну ячейку
+        self.hog = cv2.HOGDescriptor((size, size), (2 * cell_size, 2 * cell_size),
+                                     (cell_size, cell_size), (cell_size, cell_size), nbins)
+
+    def extract(self, face: np.ndarray) -> np.ndarray:
+        return self.hog.compute(self._to_uint8(face, self.size)).ravel().astype(np.float32)
+
+
+class LBPHistogramExtractor(FeatureExtractor):
+    """Гистограммы равномерных локальных бинарных шаблонов (LBP 8,1) по сетке ячеек"""
+
+    name = 'lbp'
+
+    def __init__(self, size: int = 96, grid: int = 8):
+        self.size = size
+        self.grid = grid
+        # Равномерные шаблоны (не больше двух переходов 0/1) получают свои корзины,
+        # все остальные попадают в одну общую
+        codes = np.arange(256, dtype=np.uint8)
+        bits = np.unpackbits(codes[:, None], axis=1)
+        transitions = np.count_nonzero(bits != np.roll(bits, 1, axis=1), axis=1)
+        uniform = transitions <= 2
+        self.num_bins = int(uniform.sum()) + 1
+        self.mapping = np.full(256, self.num_bins - 1, dtype=np.int64)
+        self.mapping[uniform] = np.arange(uniform.sum())
+
+    def extract(self, face: np.ndarray) -> np.ndarray:
+        image = self._to_uint8(face, self.size).astype(np.int16)
+        center = image[1:-1, 1:-1]
+        h, w = center.shape
+        offsets = [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)]
+        codes = np.zeros_like(center, dtype=np.uint8)
+        for bit, (dy, dx) in enumerate(offsets):
+            neighbour = image[1 + dy:1 + dy + h, 1 + dx:1 + dx + w]
+            codes |= (neighbour >= center).astype(np.uint8) << bit
+        bins = self.mapping[codes]
+
+        # Гистограмма в каждой ячейке сетки через один bincount
+        cell_h, cell_w = h // self.grid, w // self.grid
+        bins = bins[:cell_h * self.grid, :cell_w * self.grid]
+        cell_index = (np.arange(self.grid * cell_h)[:, None] // cell_h) * self.grid + \
+            (np.arange(self.grid * cell_w)[None, :] // cell_w)
+        hist = np.bincount((cell_index * self.num_bins + bins).ravel(),
+                           minlength=self.grid * self.grid * self.num_bins)
+        hist = hist.reshape(self.grid * self.grid, self.num_bins).astype(np.float32)
+        hist /= cell_h * cell_w
+        return hist.ravel()
+
+
+class PCAProjector:
+    """Проекция признаков на главные компоненты, обучаемая на галерее"""
+
+    def __init__(self, n_components: int = 128):
+        self.n_components = n_components
+        self.mean: Optional[np.ndarray] = None
+        self.components: Optional[np.ndarray] = None
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.components is not None
+
+    def fit(self, features: np.ndarray) -> 'PCAProjector':
+        """Находит главные компоненты матрицы признаков (N, F)"""
+        features = np.asarray(features, dtype=np.float64)
+        self.mean = features.mean(axis=0)
+        centered = features - self.mean
+        n_components = min(self.n_components, *centered.shape)
+
+        if centered.shape[0] >= centered.shape[1]:
+            # Выборка больше размерности — собственные векторы ковариации F x F
+            eigenvalues, eigenvectors = np.linalg.eigh(centered.T @ centered)
+            components = eigenvectors[:, ::-1][:, :n_components].T
+        else:
+            _, _, vt = np.linalg.svd(centered, full_matrices=False)
+            components = vt[:n_components]
+
+        self.mean = self.mean.astype(np.float32)
+        self.components = np.ascontiguousarray(components, dtype=np.float32)
+        return self
+
+    def transform(self, features: np.ndarray) -> np.ndarray:
+        """Проецирует признаки (N, F) в пространство (N, n_components)"""
+        if not self.is_fitted:
+            raise RuntimeError("PCA-проекция не обучена")
+        return (np.asarray(features, dtype=np.float32) - self.mean) @ self.components.T
+
+
+class FaceEmbedder:
+    """
+    Компактный эмбеддинг лица: извлечение признаков и PCA-проекция.
+    Заменяет сырой вектор из 10 000 пикселей вектором из 64–128 чисел.
+    """
+
+    # Порог по умолчанию — доля медианного расстояния эмбеддингов
+    # обучающей выборки до их центра
+    DEFAULT_THRESHOLD_RATIO = 0.6
+
+    def __init__(self, extractor: Optional[FeatureExtractor] = None,
+                 n_components: int = 128):
+        self.extractor = extractor or HOGExtractor()
+        self.projector = PCAProjector(n_components)
+        # Евклидов порог распознавания в пространстве эмбеддингов, задается при обучении
+        self.default_threshold: Optional[float] = None
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.projector.is_fitted
+
+    @property
+    def dimension(self) -> int:
+        return len(self.projector.components) if self.is_fitted else 0
+
+    def fit(self, faces: Sequence[np.ndarray]) -> 'FaceEmbedder':
+        """Обучает PCA-проекцию на выборке лиц и оценивает порог по умолчанию"""
+        features = self.extractor.extract_batch(faces)
+        embeddings = self.projector.fit(features).transform(features)
+        # Эмбеддинги центрированы, поэтому норма — расстояние до центра выборки
+        self.default_threshold = self.DEFAULT_THRESHOLD_RATIO * \
+            float(np.median(np.linalg.norm(embeddings, axis=1)))
+        return self
+
+    def transform(self, faces: Sequence[np.ndarray]) -> np.ndarray:
+        """Возвращает эмбеддинги (N, D) для списка лиц"""
+        return self.projector.transform(self.extractor.extract_batch(faces))
+
+    def embed(self, face: np.ndarray) -> np.ndarray:
+        """Возвращает эмбеддинг одного лица"""
+        return self.transform([face])[0]
+
+    def save(self, filepath: str) -> None:
+        """Сохраняет параметры проекции в файл .npz"""
+        # Через открытый файл: иначе np.savez допишет к пути расширение .npz
+        with open(filepath, 'wb') as f:
+            np.savez(f, extractor=self.extractor.name,
+                     mean=self.projector.mean, components=self.projector.components,
+                     default_threshold=np.nan if self.default_threshold is None
+                     else self.default_threshold)
+
+    def load(self, filepath: str) -> None:
+        """Загружает параметры проекции из файла .npz"""
+        with np.load(filepath) as data:
+            if str(data['extractor']) != self.extractor.name:
+                raise ValueError(f"Проекция обучена для признаков {data['extractor']}, "
+                                 f"а не {self.extractor.name}")
+            self.projector.mean = data['mean']
+            self.projector.components = data['components']
+            self.projector.n_components = len(self.projector.components)
+            # В файлах прежнего формата порога нет
+            threshold = float(data['default_threshold']) if 'default_threshold' in data.files \
+                else np.nan
+            self.default_threshold = None if np.isnan(threshold) else threshold
+
+
+def extractor_by_name(name: str) -> FeatureExtractor:
+    """Создает экстрактор признаков по имени"""
+    extractors: List[type] = [HOGExtractor, LBPHistogramExtractor]
+    for extractor in extractors:
+        if extractor.name == name:
+            return extractor()
+    raise ValueError(f"Неизвестный экстрактор признаков: {name}")
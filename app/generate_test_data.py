@@ -1,6 +1,10 @@
 import pandas as pd
 import numpy as np
 from pathlib import Path
+from app.enhanced_algorithm import EnhancedBiometricSearch
+from app.kd_tree import KDTree
+from app.search_index import FlatIndex
+from app.search_index_benchmark import sklearn_tree_nbytes
 
 # Создаем директории для результатов
 for dir_name in ['linear', 'kd_tree', 'enhanced']:
@@ -10,12 +14,30 @@ Path('results/comparison').mkdir(parents=True, exist_ok=True)
 # Генерируем размеры баз данных
 database_sizes = [10, 50, 100, 250, 500, 1000]
 
+# Память не выдумывается, а измеряется на индексах из 128-мерных эмбеддингов
+embedding_dimension = 128
+rng = np.random.default_rng(0)
+memory_usage = {}
+for size in database_sizes:
+    embeddings = rng.standard_normal((size, embedding_dimension)).astype(np.float32)
+    user_ids = [f"user_{i}" for i in range(size)]
+    linear_index, kd_tree_index = FlatIndex(), KDTree()
+    linear_index.build_from_matrix(embeddings, user_ids)
+    kd_tree_index.build_from_matrix(embeddings, user_ids)
+    enhanced_index = EnhancedBiometricSearch()
+    enhanced_index.build_index(embeddings, user_ids)
+    memory_usage[size] = {
+        'linear': linear_index.nbytes / 2**20,
+        'kd_tree': kd_tree_index.nbytes / 2**20,
+        'enhanced': sklearn_tree_nbytes(enhanced_index.tree) / 2**20
+    }
+
 # Генерируем данные для линейного поиска
 linear_data = []
 for size in database_sizes:
     avg_time = 0.05 + size * 0.0002  # Линейный рост времени
     std_time = avg_time * 0.1  # 10% отклонение
-    memory = size * 0.5  # Линейный рост памяти
+    memory = memory_usage[size]['linear']
     linear_data.append({
         'database_size': size,
         'avg_query_time': avg_time,
@@ -28,7 +50,7 @@ kd_tree_data = []
 for size in database_sizes:
     avg_time = 0.001 + np.log2(size) * 0.0001  # Логарифмический рост времени
     std_time = avg_time * 0.05  # 5% отклонение
-    memory = size * 0.7  # Немного больше памяти из-за структуры дерева
+    memory = memory_usage[size]['kd_tree']
     kd_tree_data.append({
         'database_size': size,
         'avg_query_time': avg_time,
@@ -41,7 +63,7 @@ enhanced_data = []
 for size in database_sizes:
     avg_time = 0.0015 + np.log2(size) * 0.00012  # Чуть медленнее k-d дерева
     std_time = avg_time * 0.06  # 6% отклонение
-    memory = size * 0.8  # Больше памяти из-за дополнительных данных
+    memory = memory_usage[size]['enhanced']
     enhanced_data.append({
         'database_size': size,
         'avg_query_time': avg_time,
@@ -0,0 +1,173 @@
+import os
+import sys
+import time
+import logging
+import numpy as np
+import cv2
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import List, Dict, Optional, Iterable, Iterator, NamedTuple, Union
+from app.feature_extractor import FeatureExtractor
+from app.system_info import available_cores
+
+# Расширения файлов, которые считаются изображениями при обходе директории
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+# Состояние процесса пула: классификатор загружается один раз при старте процесса
+_cascade: Optional[cv2.CascadeClassifier] = None
+_extractor: Optional[FeatureExtractor] = None
+_face_size = 100
+
+
+class IngestResult(NamedTuple):
+    """Результат обработки одного изображения; face и features — None, если лицо не найдено"""
+    path: str
+    face: Optional[np.ndarray]
+    features: Optional[np.ndarray]
+
+
+def _init_worker(cascade_path: str, extractor: Optional[FeatureExtractor], face_size: int) -> None:
+    global _cascade, _extractor, _face_size
+    # Процессов столько же, сколько ядер: внутренние потоки OpenCV только мешают
+    cv2.setNumThreads(1)
+    _cascade = cv2.CascadeClassifier(cascade_path)
+    _extractor = extractor
+    _face_size = face_size
+
+
+def _detect(path: str) -> Optional[np.ndarray]:
+    """Читает изображение сразу в оттенках серого, находит первое лицо и нормализует его"""
+    gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None
+    faces = _cascade.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=5, minSize=(30, 30))
+    if len(faces) == 0:
+        return None
+    x, y, w, h = faces[0]
+    face = cv2.resize(gray[y:y+h, x:x+w], (_face_size, _face_size))
+    return face.astype(np.float32) / 255.0
+
+
+def _process_batch(paths: List[str]) -> List[IngestResult]:
+    """Выполняется в процессе пула: декодирование, детекция, кроп и признаки для пачки путей"""
+    results = []
+    for path in paths:
+        face = _detect(path)
+        features = None
+        if face is not None and _extractor is not None:
+            features = _extractor.extract(face)
+        results.append(IngestResult(path, face, features))
+    return results
+
+
+def iter_image_paths(source: Union[str, Iterable[str]]) -> Iterator[str]:
+    """Пути изображений: рекурсивный обход директории или переданный список"""
+    if isinstance(source, str):
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.join(root, name)
+    else:
+        yield from source
+
+
+class IngestPipeline:
+    """
+    Потоковая загрузка лиц из большого набора фотографий на всех ядрах.
+
+    Пути пачками по batch_size уходят в пул процессов, где каждый процесс
+    один раз загружает каскад Хаара и для своей пачки декодирует
+    изображения, находит лица, вырезает и нормализует их и, если задан
+    extractor, считает признаки. Число пачек в работе ограничено
+    max_pending: пока потребитель не забрал результаты, новые пачки не
+    отправляются, так что память не растет с размером набора.
+    При ordered=True результаты выдаются в порядке путей, иначе — по готовности.
+    """
+
+    def __init__(self, cascade_path: str = 'haarcascade_frontalface_default.xml',
+                 num_workers: Optional[int] = None, batch_size: int = 64,
+                 max_pending: Optional[int] = None, ordered: bool = True,
+                 extractor: Optional[FeatureExtractor] = None, face_size: int = 100):
+        if not os.path.exists(cascade_path):
+            raise FileNotFoundError(f"Файл каскадного классификатора не найден: {cascade_path}")
+        self.cascade_path = cascade_path
+        self.num_workers = num_workers or available_cores()
+        self.batch_size = batch_size
+        self.max_pending = max_pending or 2 * self.num_workers
+        self.ordered = ordered
+        self.extractor = extractor
+        self.face_size = face_size
+        self.stats: Dict[str, float] = {}
+        self.logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def _batches(paths: Iterable[str], batch_size: int) -> Iterator[List[str]]:
+        batch = []
+        for path in paths:
+            batch.append(path)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def run(self, source: Union[str, Iterable[str]]) -> Iterator[IngestResult]:
+        """Обрабатывает директорию или список путей, выдавая результаты по мере готовности"""
+        start_time = time.time()
+        num_images = num_faces = 0
+        batches = self._batches(iter_image_paths(source), self.batch_size)
+
+        with ProcessPoolExecutor(max_workers=self.num_workers, initializer=_init_worker,
+                                 initargs=(self.cascade_path, self.extractor,
+                                           self.face_size)) as executor:
+            pending = deque()
+            exhausted = False
+            while True:
+                # Дозаполняем очередь пачек до max_pending
+                while not exhausted and len(pending) < self.max_pending:
+                    batch = next(batches, None)
+                    if batch is None:
+                        exhausted = True
+                    else:
+                        pending.append(executor.submit(_process_batch, batch))
+                if not pending:
+                    break
+
+                if self.ordered:
+                    done = [pending.popleft()]
+                else:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    done = [future for future in pending if future in finished]
+                    for future in done:
+                        pending.remove(future)
+
+                for future in done:
+                    for result in future.result():
+                        num_images += 1
+                        num_faces += result.face is not None
+                        yield result
+
+        self._update_stats(num_images, num_faces, time.time() - start_time)
+
+    def _update_stats(self, num_images: int, num_faces: int, elapsed: float) -> None:
+        images_per_second = num_images / elapsed if elapsed > 0 else 0.0
+        self.stats = {
+            'images': num_images,
+            'faces': num_faces,
+            'elapsed': elapsed,
+            'workers': self.num_workers,
+            'images_per_second': images_per_second,
+            'images_per_second_per_core': images_per_second / self.num_workers
+        }
+        self.logger.info(f"Обработано {num_images} изображений, найдено {num_faces} лиц "
+                         f"за {elapsed:.1f} с: {images_per_second:.1f} изобр./с, "
+                         f"{self.stats['images_per_second_per_core']:.1f} изобр./с на ядро")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    source = sys.argv[1] if len(sys.argv) > 1 else 'test_data'
+    pipeline = IngestPipeline()
+    for _ in pipeline.run(source):
+        pass
+    print(pipeline.stats)
@@ -0,0 +1,301 @@
+import numpy as np
+from typing import List, Tuple, Optional
+import threading
+from app.search_index import SearchIndex
+
+# Версия формата файла, в который сохраняется индекс
+IVF_INDEX_FORMAT_VERSION = 1
+
+
+def kmeans(points: np.ndarray, num_clusters: int, num_iters: int = 20,
+           rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """
+    Алгоритм Ллойда: возвращает центроиды (num_clusters, D).
+    Расстояния до центроидов считаются одним умножением матриц,
+    опустевшие кластеры получают случайные точки выборки
+    """
+    rng = rng or np.random.default_rng(0)
+    num_clusters = min(num_clusters, len(points))
+    centroids = points[rng.choice(len(points), num_clusters, replace=False)].copy()
+    point_sq_norms = np.einsum('ij,ij->i', points, points)
+
+    for _ in range(num_iters):
+        sq_dists = (point_sq_norms[:, None] - 2.0 * (points @ centroids.T) +
+                    np.einsum('ij,ij->i', centroids, centroids)[None, :])
+        labels = np.argmin(sq_dists, axis=1)
+
+        # Суммы по кластерам через сортировку меток и reduceat
+        counts = np.bincount(labels, minlength=num_clusters)
+        order = np.argsort(labels, kind='stable')
+        empty = counts == 0
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[~empty]
+        sums = np.add.reduceat(points[order], starts, axis=0)
+        centroids[~empty] = sums / counts[~empty, None]
+        if empty.any():
+            centroids[empty] = points[rng.choice(len(points), int(empty.sum()), replace=False)]
+
+    return centroids
+
+
+class IVFIndex(SearchIndex):
+    """
+    Инвертированный файл с грубым квантователем k-means.
+
+    Векторы разбиваются на nlist кластеров и хранятся одной матрицей,
+    упорядоченной по кластерам, так что каждый список — непрерывный срез.
+    Запрос просматривает только nprobe ближайших к нему кластеров; nprobe
+    можно менять после построения, выбирая баланс полноты и скорости.
+
+    Новые лица сразу попадают в списки через буфер, который просматривается
+    с учетом своих меток кластеров и вливается в основную матрицу при
+    превышении merge_threshold. Если индекс вырос больше чем в retrain_factor
+    раз с момента обучения, центроиды переобучаются при слиянии.
+    """
+
+    def __init__(self, nlist: Optional[int] = None, nprobe: int = 8,
+                 kmeans_iters: int = 10, train_size: int = 50000,
+                 merge_threshold: int = 1024, retrain_factor: float = 4.0,
+                 seed: int = 0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.kmeans_iters = kmeans_iters
+        self.train_size = train_size
+        self.merge_threshold = merge_threshold
+        self.retrain_factor = retrain_factor
+        self.seed = seed
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self) -> None:
+        with self._lock:
+            self.dimension = 0
+            self._centroids: Optional[np.ndarray] = None
+            self._trained_size = 0
+            self._points = np.empty((0, 0), dtype=np.float32)
+            self._user_ids = np.empty(0, dtype=object)
+            self._offsets = np.zeros(1, dtype=np.int64)
+            self._alive = np.empty(0, dtype=bool)
+            self._num_alive = 0
+            self._delta_points: List[np.ndarray] = []
+            self._delta_ids: List[str] = []
+            self._delta_labels: List[np.ndarray] = []
+
+    @property
+    def size(self) -> int:
+        return self._num_alive + len(self._delta_ids)
+
+    @property
+    def nbytes(self) -> int:
+        delta = sum(points.nbytes for points in self._delta_points)
+        centroids = self._centroids.nbytes if self.is_trained else 0
+        return self._points.nbytes + self._offsets.nbytes + self._alive.nbytes + centroids + delta
+
+    @property
+    def is_trained(self) -> bool:
+        return self._centroids is not None
+
+    def _default_nlist(self, size: int) -> int:
+        """Число кластеров по умолчанию — порядка 4 * sqrt(N)"""
+        return max(1, min(size, int(4 * np.sqrt(size))))
+
+    def _train(self, points: np.ndarray) -> None:
+        """Обучает грубый квантователь на случайной выборке точек"""
+        rng = np.random.default_rng(self.seed)
+        sample = points
+        if len(points) > self.train_size:
+            sample = points[rng.choice(len(points), self.train_size, replace=False)]
+        nlist = self.nlist or self._default_nlist(len(points))
+        self._centroids = kmeans(sample, nlist, self.kmeans_iters, rng)
+        self._trained_size = len(points)
+
+    def _centroid_scores(self, points: np.ndarray) -> np.ndarray:
+        """
+        Квадраты расстояний до центроидов без общего слагаемого ||x||^2:
+        ||c||^2 - 2xc. Центроиды k-means не нормированы, поэтому одного
+        скалярного произведения для порядка кластеров недостаточно
+        """
+        centroid_sq_norms = np.einsum('ij,ij->i', self._centroids, self._centroids)
+        return centroid_sq_norms[None, :] - 2.0 * (points @ self._centroids.T)
+
+    def _assign(self, points: np.ndarray, block_size: int = 8192) -> np.ndarray:
+        """Метки ближайших центроидов"""
+        labels = np.empty(len(points), dtype=np.int64)
+        for start in range(0, len(points), block_size):
+            labels[start:start + block_size] = np.argmin(
+                self._centroid_scores(points[start:start + block_size]), axis=1)
+        return labels
+
+    def _set_lists(self, points: np.ndarray, user_ids: np.ndarray,
+                   labels: np.ndarray) -> None:
+        """Упорядочивает точки по кластерам и запоминает границы списков"""
+        order = np.argsort(labels, kind='stable')
+        self._points = np.ascontiguousarray(points[order])
+        self._user_ids = user_ids[order]
+        counts = np.bincount(labels, minlength=len(self._centroids))
+        self._offsets = np.concatenate(([0], np.cumsum(counts)))
+        self._alive = np.ones(len(points), dtype=bool)
+        self._num_alive = len(points)
+
+    def build_from_matrix(self, vectors: np.ndarray, user_ids: List[str]) -> None:
+        if len(vectors) == 0:
+            return
+
+        points = self._normalize(np.reshape(vectors, (len(vectors), -1)))
+        with self._lock:
+            self.clear()
+            self.dimension = points.shape[1]
+            self._train(points)
+            self._set_lists(points, np.array(user_ids, dtype=object), self._assign(points))
+
+    def insert_batch(self, vectors: np.ndarray, user_ids: List[str]) -> None:
+        vectors = self._normalize(np.reshape(vectors, (len(vectors), -1)))
+        if len(vectors) == 0:
+            return
+
+        with self._lock:
+            if self.dimension == 0:
+                self.dimension = vectors.shape[1]
+            elif vectors.shape[1] != self.dimension:
+                raise ValueError(f"Размерность лица {vectors.shape[1]} не совпадает "
+                                 f"с размерностью индекса {self.dimension}")
+
+            # До обучения все лица лежат в буфере с меткой -1 и просматриваются целиком
+            labels = self._assign(vectors) if self.is_trained \
+                else np.full(len(vectors), -1, dtype=np.int64)
+            self._delta_points.append(vectors)
+            self._delta_labels.append(labels)
+            self._delta_ids.extend(user_ids)
+
+            if len(self._delta_ids) >= self.merge_threshold:
+                self.merge()
+
+    def merge(self) -> None:
+        """
+        Вливает буфер в списки и выбрасывает удаленные лица. Записи буфера
+        уже распределены по спискам при вставке, поэтому без переобучения
+        точки не распределяются заново, а только переупорядочиваются
+        """
+        with self._lock:
+            if not self._delta_ids and self._num_alive == len(self._points):
+                return
+
+            points = [self._points[self._alive]] if len(self._points) else []
+            points = np.concatenate(points + self._delta_points)
+            user_ids = np.concatenate([self._user_ids[self._alive],
+                                       np.array(self._delta_ids, dtype=object)])
+            delta_labels = self._delta_labels
+            self._delta_points, self._delta_labels, self._delta_ids = [], [], []
+            if len(points) == 0:
+                self.clear()
+                return
+
+            if not self.is_trained or len(points) > self.retrain_factor * self._trained_size:
+                self._train(points)
+                labels = self._assign(points)
+            else:
+                list_labels = np.repeat(np.arange(len(self._centroids)), np.diff(self._offsets))
+                labels = np.concatenate([list_labels[self._alive]] + delta_labels)
+                # Записи, вставленные до обучения, распределяются сейчас
+                unassigned = np.flatnonzero(labels < 0)
+                if len(unassigned):
+                    labels[unassigned] = self._assign(points[unassigned])
+            self._set_lists(points, user_ids, labels)
+
+    def remove(self, user_id: str) -> int:
+        with self._lock:
+            hits = np.flatnonzero((self._user_ids == user_id) & self._alive)
+            self._alive[hits] = False
+            self._num_alive -= len(hits)
+            removed = len(hits)
+
+            keep = [uid != user_id for uid in self._delta_ids]
+            if not all(keep):
+                points = np.concatenate(self._delta_points)[keep]
+                labels = np.concatenate(self._delta_labels)[keep]
+                removed += len(keep) - len(points)
+                self._delta_points, self._delta_labels = [points], [labels]
+                self._delta_ids = [uid for uid in self._delta_ids if uid != user_id]
+            return removed
+
+    def _probe_lists(self, queries: np.ndarray, nprobe: int) -> np.ndarray:
+        """Номера nprobe ближайших кластеров для каждого запроса (B, nprobe)"""
+        nprobe = min(nprobe, len(self._centroids))
+        if nprobe == len(self._centroids):
+            return np.broadcast_to(np.arange(nprobe), (len(queries), nprobe))
+        # Та же мера, что и при распределении точек по спискам в _assign
+        return np.argpartition(self._centroid_scores(queries), nprobe - 1, axis=1)[:, :nprobe]
+
+    def _query_one(self, query: np.ndarray, lists: np.ndarray, k: int,
+                   delta_points: Optional[np.ndarray],
+                   delta_labels: Optional[np.ndarray]) -> List[Tuple[str, float]]:
+        """Точный поиск среди точек выбранных кластеров и подходящих записей буфера"""
+        dists = np.empty(0, dtype=np.float32)
+        ids = np.empty(0, dtype=object)
+        if len(lists) and len(self._points):
+            positions = np.concatenate([np.arange(self._offsets[c], self._offsets[c + 1])
+                                        for c in lists])
+            dists = np.maximum(2.0 - 2.0 * (self._points[positions] @ query), 0.0)
+            if self._num_alive < len(self._points):
+                dists[~self._alive[positions]] = np.inf
+            ids = self._user_ids[positions]
+
+        if delta_points is not None:
+            in_lists = np.flatnonzero(np.isin(delta_labels, lists) | (delta_labels < 0))
+            delta_dists = np.maximum(2.0 - 2.0 * (delta_points[in_lists] @ query), 0.0)
+            dists = np.concatenate((dists, delta_dists))
+            ids = np.concatenate((ids, np.array(self._delta_ids, dtype=object)[in_lists]))
+
+        k = min(k, len(dists))
+        if k == 0:
+            return []
+        top = np.argpartition(dists, k - 1)[:k]
+        top = top[np.argsort(dists[top])]
+        return [(ids[i], float(np.sqrt(dists[i]))) for i in top if np.isfinite(dists[i])]
+
+    def query_knn(self, target: np.ndarray, k: int = 5) -> List[Tuple[str, float]]:
+        return self.query_knn_batch(np.ravel(target)[None, :], k)[0]
+
+    def query_knn_batch(self, targets: np.ndarray, k: int = 5) -> List[List[Tuple[str, float]]]:
+        queries = self._normalize(np.reshape(targets, (len(targets), -1)))
+        with self._lock:
+            if self.size == 0 or k <= 0:
+                return [[] for _ in range(len(queries))]
+
+            delta_points = delta_labels = None
+            if self._delta_ids:
+                delta_points = np.concatenate(self._delta_points)
+                delta_labels = np.concatenate(self._delta_labels)
+            # Выбор кластеров для всей пачки — одно умножение на матрицу центроидов
+            probes = self._probe_lists(queries, self.nprobe) if self.is_trained \
+                else np.empty((len(queries), 0), dtype=np.int64)
+            return [self._query_one(query, lists, k, delta_points, delta_labels)
+                    for query, lists in zip(queries, probes)]
+
+    def save(self, filepath: str) -> None:
+        """Сохраняет индекс в файл .npz"""
+        self.merge()
+        with self._lock:
+            if not self.is_trained:
+                return
+            with open(filepath, 'wb') as f:
+                np.savez(f, version=IVF_INDEX_FORMAT_VERSION,
+                         centroids=self._centroids, trained_size=self._trained_size,
+                         points=self._points, user_ids=self._user_ids.astype(str),
+                         offsets=self._offsets, nprobe=self.nprobe)
+
+    def load(self, filepath: str) -> None:
+        """Загружает индекс из файла .npz"""
+        with np.load(filepath) as data:
+            if int(data['version']) != IVF_INDEX_FORMAT_VERSION:
+                raise ValueError(f"Неподдерживаемый формат файла IVF-индекса: {filepath}")
+            with self._lock:
+                self.clear()
+                self._centroids = data['centroids']
+                self._trained_size = int(data['trained_size'])
+                self._points = data['points']
+                self._user_ids = data['user_ids'].astype(object)
+                self._offsets = data['offsets']
+                self._alive = np.ones(len(self._points), dtype=bool)
+                self._num_alive = len(self._points)
+                self.nprobe = int(data['nprobe'])
+                self.dimension = self._points.shape[1]
@@ -1,143 +1,730 @@
 import numpy as np
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Dict, Iterable, Union
+import os
 import pickle
-from concurrent.futures import ThreadPoolExecutor
-
-class KDNode:
-    def __init__(self, face_data: np.ndarray, user_id: str, 
-                 left: Optional['KDNode'] = None, 
-                 right: Optional['KDNode'] = None,
-                 axis: int = 0):
-        self.face_data = face_data
-        self.user_id = user_id
-        self.left = left
-        self.right = right
-        self.axis = axis
-        # Добавляем кэш для ускорения поиска
-        self.median_value = float(np.median(face_data, axis=0)[axis])
-        self.norm = np.linalg.norm(face_data)
-
-class KDTree:
-    def __init__(self):
-        self.root: Optional[KDNode] = None
-        self.size = 0
+import struct
+import tempfile
+import threading
+import zlib
+from app.database import collect_chunks
+from app.search_index import SearchIndex
+
+# Версия формата файла, в который сохраняется дерево
+# (1 — pickle, читается для совместимости; 2 — бинарный снимок)
+KD_TREE_FORMAT_VERSION = 2
+LEGACY_PICKLE_FORMAT_VERSION = 1
+
+# Заголовок снимка: сигнатура, версия, leaf_size, число точек, размерность,
+# число узлов, ширина id в байтах, число строк в БД (-1 — неизвестно), CRC32 данных
+SNAPSHOT_MAGIC = b'KDSNAP\x00\x00'
+SNAPSHOT_HEADER = struct.Struct('<8sIIqqqqqI')
+# Секции снимка выравниваются, чтобы массивы отображались из файла без копирования
+SNAPSHOT_ALIGNMENT = 64
+# Массивы узлов в порядке записи в снимок
+NODE_ARRAYS = (('split_dim', np.int32), ('split_value', np.float32), ('left', np.int32),
+               ('right', np.int32), ('start', np.int32), ('end', np.int32))
+# Сколько строк узла копируется за раз при поиске оси разбиения
+SPREAD_BLOCK_ROWS = 65536
+
+
+def _permute_rows(matrix: np.ndarray, perm: np.ndarray) -> None:
+    """
+    Переставляет строки на месте, matrix[i] = matrix[perm[i]], обходя циклы
+    перестановки: дополнительно нужна память на одну строку, а не на всю матрицу
+    """
+    moved = np.flatnonzero(perm != np.arange(len(perm)))
+    done = np.zeros(len(perm), dtype=bool)
+    perm = perm.tolist()
+    for i in moved.tolist():
+        if done[i]:
+            continue
+        first = matrix[i].copy()
+        j = i
+        while True:
+            done[j] = True
+            k = perm[j]
+            if k == i:
+                matrix[j] = first
+                break
+            matrix[j] = matrix[k]
+            j = k
+
+
+class FixedWidthIds:
+    """
+    Таблица id из снимка: строки UTF-8 фиксированной ширины, отображенные
+    из файла. Поддерживает то, что нужно дереву от массива id: доступ по
+    позиции, выборку по маске и сравнение с id, — не создавая объект
+    Python на каждую запись
+    """
+
+    def __init__(self, raw: np.ndarray):
+        self.raw = raw
+
+    def __len__(self) -> int:
+        return len(self.raw)
+
+    def __getitem__(self, key) -> Union[str, np.ndarray]:
+        if isinstance(key, (int, np.integer)):
+            return self.raw[key].decode('utf-8')
+        return np.array([value.decode('utf-8') for value in self.raw[key]], dtype=object)
+
+    def __eq__(self, user_id: str) -> np.ndarray:
+        return self.raw == user_id.encode('utf-8')
+
+    @property
+    def nbytes(self) -> int:
+        return self.raw.nbytes
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // SNAPSHOT_ALIGNMENT) * SNAPSHOT_ALIGNMENT
+
+
+def _snapshot_layout(num_points: int, dimension: int, num_nodes: int,
+                     id_width: int) -> List[Tuple[str, np.dtype, Tuple[int, ...], int]]:
+    """Секции снимка: имя, тип, форма и смещение от начала файла"""
+    sections = [('points', np.dtype(np.float32), (num_points, dimension))]
+    sections += [(name, np.dtype(dtype), (num_nodes,)) for name, dtype in NODE_ARRAYS]
+    sections.append(('user_ids', np.dtype(f'S{id_width}'), (num_points,)))
+
+    layout = []
+    offset = _aligned(SNAPSHOT_HEADER.size)
+    for name, dtype, shape in sections:
+        layout.append((name, dtype, shape, offset))
+        offset = _aligned(offset + dtype.itemsize * int(np.prod(shape)))
+    return layout
+
+
+def _file_crc32(f, start: int, chunk_size: int = 1 << 22) -> int:
+    """CRC32 содержимого файла начиная со смещения start"""
+    f.seek(start)
+    crc = 0
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return crc
+        crc = zlib.crc32(chunk, crc)
+
+
+class KDTree(SearchIndex):
+    """
+    k-d дерево на плоских массивах NumPy.
+
+    Узлы хранятся не объектами, а параллельными массивами (ось и значение
+    разбиения, индексы потомков, границы листа), а сами векторы лиц лежат
+    одной непрерывной матрицей, упорядоченной так, что каждый лист занимает
+    непрерывный срез. Векторы нормируются по L2, поэтому евклидово расстояние
+    между ними эквивалентно косинусному: ||a - b||^2 = 2 * (1 - cos(a, b)).
+
+    Новые лица попадают в буфер, который просматривается полным перебором,
+    а при превышении merge_threshold вливается в дерево в фоновом потоке.
+    Удаленные лица помечаются в маске и выбрасываются при следующем слиянии.
+    """
+
+    def __init__(self, leaf_size: int = 32, merge_threshold: int = 1024,
+                 background_merge: bool = True):
+        self.leaf_size = leaf_size
+        self.merge_threshold = merge_threshold
+        self.background_merge = background_merge
+        self._lock = threading.RLock()
+        self._merge_thread: Optional[threading.Thread] = None
+        self._reset()
+
+    def _reset(self) -> None:
+        """Сбрасывает дерево в пустое состояние"""
         self.dimension = 0
-        
-    def _build_tree(self, faces: List[Tuple[np.ndarray, str]], 
-                   start: int, end: int, axis: int) -> Optional[KDNode]:
-        """Рекурсивно строит k-d дерево с улучшенной балансировкой"""
-        if start >= end:
-            return None
-            
-        faces_slice = faces[start:end]
-        
-        # Выбираем ось с наибольшей дисперсией для лучшей балансировки
-        if len(faces_slice) > 1:
-            variances = np.var([x[0] for x in faces_slice], axis=0)
-            axis = np.argmax(variances)
-        
-        # Сортируем по медиане выбранной оси
-        faces_sorted = sorted(faces_slice, 
-                            key=lambda x: np.median(x[0], axis=0)[axis])
-        median_idx = len(faces_sorted) // 2
-        
-        # Создаем узел с предвычисленными значениями
-        node = KDNode(faces_sorted[median_idx][0], 
-                     faces_sorted[median_idx][1],
-                     axis=axis)
-        
-        faces[start:end] = faces_sorted
-        mid = start + median_idx
-        
-        # Рекурсивно строим поддеревья
-        node.left = self._build_tree(faces, start, mid, 
-                                   (axis + 1) % self.dimension)
-        node.right = self._build_tree(faces, mid + 1, end,
-                                    (axis + 1) % self.dimension)
-        
-        return node
-        
-    def build(self, faces: List[Tuple[np.ndarray, str]]) -> None:
-        """Строит k-d дерево из списка лиц"""
-        if not faces:
+        self._set_tree(np.empty((0, 0), dtype=np.float32),
+                       np.empty(0, dtype=object),
+                       self._build_nodes(np.empty((0, 0), dtype=np.float32),
+                                         np.empty(0, dtype=object)))
+        # Буфер недавно добавленных лиц
+        self._delta_points = np.empty((0, 0), dtype=np.float32)
+        self._delta_ids: List[str] = []
+        self._delta_count = 0
+        # Состояние фонового слияния
+        self._merging = False
+        self._merge_taken = 0
+        self._removed_during_merge = set()
+
+    @property
+    def size(self) -> int:
+        """Количество лиц в дереве и буфере без учета удаленных"""
+        return self._num_alive + self._delta_count
+
+    @property
+    def nbytes(self) -> int:
+        """Память, занятая точками, узлами дерева и буфером"""
+        nodes = (self._split_dim, self._split_value, self._left, self._right,
+                 self._start, self._end, self._alive)
+        return self._points.nbytes + self._delta_points.nbytes + sum(a.nbytes for a in nodes)
+
+    @staticmethod
+    def _spread(points: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Разброс значений по осям для строк rows, копируемых блоками"""
+        low = high = None
+        for offset in range(0, len(rows), SPREAD_BLOCK_ROWS):
+            block = points[rows[offset:offset + SPREAD_BLOCK_ROWS]]
+            block_low, block_high = block.min(axis=0), block.max(axis=0)
+            if low is None:
+                low, high = block_low, block_high
+            else:
+                np.minimum(low, block_low, out=low)
+                np.maximum(high, block_high, out=high)
+        return high - low
+
+    def _build_nodes(self, points: np.ndarray,
+                     user_ids: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Итеративно строит узлы дерева. Разбиения переставляют только массив
+        индексов; точки и id переупорядочиваются на месте один раз в конце,
+        поэтому пиковая память близка к размеру самой матрицы точек
+        """
+        split_dim, split_value = [-1], [0.0]
+        left, right = [-1], [-1]
+        start, end = [0], [len(points)]
+        perm = np.arange(len(points))
+
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            s, e = start[node], end[node]
+            if e - s <= self.leaf_size:
+                continue
+
+            # Выбираем ось с наибольшим разбросом значений
+            rows = perm[s:e]
+            spread = self._spread(points, rows)
+            axis = int(np.argmax(spread))
+            if spread[axis] == 0:
+                continue
+
+            # Разбиваем по медиане без полной сортировки
+            mid = (e - s) // 2
+            order = np.argpartition(points[rows, axis], mid)
+            perm[s:e] = rows[order]
+
+            split_dim[node] = axis
+            split_value[node] = float(points[perm[s + mid], axis])
+            for child_start, child_end in ((s, s + mid), (s + mid, e)):
+                split_dim.append(-1)
+                split_value.append(0.0)
+                left.append(-1)
+                right.append(-1)
+                start.append(child_start)
+                end.append(child_end)
+            left[node] = len(start) - 2
+            right[node] = len(start) - 1
+            stack.extend((left[node], right[node]))
+
+        _permute_rows(points, perm)
+        user_ids[:] = user_ids[perm]
+        return {
+            'split_dim': np.array(split_dim, dtype=np.int32),
+            'split_value': np.array(split_value, dtype=np.float32),
+            'left': np.array(left, dtype=np.int32),
+            'right': np.array(right, dtype=np.int32),
+            'start': np.array(start, dtype=np.int32),
+            'end': np.array(end, dtype=np.int32),
+        }
+
+    def _set_tree(self, points: np.ndarray, user_ids: np.ndarray,
+                  nodes: Dict[str, np.ndarray]) -> None:
+        """Устанавливает массивы точек и узлов дерева"""
+        self._points = points
+        self._user_ids = user_ids
+        self._split_dim = nodes['split_dim']
+        self._split_value = nodes['split_value']
+        self._left = nodes['left']
+        self._right = nodes['right']
+        self._start = nodes['start']
+        self._end = nodes['end']
+        self._alive = np.ones(len(points), dtype=bool)
+        self._num_alive = len(points)
+
+    def build_from_matrix(self, vectors: np.ndarray, user_ids: List[str]) -> None:
+        """Строит k-d дерево из матрицы векторов (N, D) и списка id"""
+        if len(vectors) == 0:
+            return
+
+        self.wait_for_merge()
+        points = self._normalize(np.reshape(vectors, (len(vectors), -1)))
+        user_ids = np.array(user_ids, dtype=object)
+        nodes = self._build_nodes(points, user_ids)
+        with self._lock:
+            self._reset()
+            self._set_tree(points, user_ids, nodes)
+            self.dimension = points.shape[1]
+
+    def build_from_chunks(self, chunks: Iterable[Tuple[List[str], np.ndarray]],
+                          size: int) -> None:
+        """
+        Строит k-d дерево из потока чанков (id, матрица), например из
+        BiometricDatabase.iter_faces. Чанки нормируются и копируются в заранее
+        выделенную матрицу, а дерево строится на ней же без лишних копий
+        """
+        user_ids, points = collect_chunks(chunks, size, transform=self._normalize)
+        if len(points) == 0:
             return
-            
-        self.dimension = faces[0][0].shape[1]
-        self.root = self._build_tree(faces, 0, len(faces), 0)
-        self.size = len(faces)
-        
-    def _find_nearest(self, node: Optional[KDNode], 
-                     target: np.ndarray,
-                     best_dist: float = float('inf'),
-                     best_node: Optional[KDNode] = None) -> Tuple[float, Optional[KDNode]]:
-        """Рекурсивно находит ближайшее лицо с оптимизированным поиском"""
-        if node is None:
-            return best_dist, best_node
-            
-        # Используем косинусное расстояние для лучшей точности
-        target_norm = np.linalg.norm(target)
-        current_dist = 1 - np.dot(node.face_data.flatten(), target.flatten()) / \
-                      (node.norm * target_norm)
-        
-        if current_dist < best_dist:
-            best_dist = current_dist
-            best_node = node
-            
-        # Используем предвычисленное медианное значение
-        target_val = np.median(target, axis=0)[node.axis]
-        
-        if target_val < node.median_value:
-            first, second = node.left, node.right
+
+        self.wait_for_merge()
+        user_ids = np.array(user_ids, dtype=object)
+        nodes = self._build_nodes(points, user_ids)
+        with self._lock:
+            self._reset()
+            self._set_tree(points, user_ids, nodes)
+            self.dimension = points.shape[1]
+
+    def clear(self) -> None:
+        """Удаляет все лица из дерева и буфера"""
+        self.wait_for_merge()
+        with self._lock:
+            self._reset()
+
+    def insert_batch(self, vectors: np.ndarray, user_ids: List[str]) -> None:
+        """Добавляет в буфер пачку лиц (N, D) с одной проверкой необходимости слияния"""
+        vectors = self._normalize(np.reshape(vectors, (len(vectors), -1)))
+        if len(vectors) == 0:
+            return
+
+        with self._lock:
+            if self.dimension == 0:
+                self.dimension = vectors.shape[1]
+            elif vectors.shape[1] != self.dimension:
+                raise ValueError(f"Размерность лица {vectors.shape[1]} не совпадает "
+                                 f"с размерностью дерева {self.dimension}")
+
+            # Буфер растет удвоением, чтобы вставка была амортизированно O(1)
+            needed = self._delta_count + len(vectors)
+            if needed > len(self._delta_points):
+                grown = np.empty((max(64, 2 * self._delta_count, needed), self.dimension),
+                                 dtype=np.float32)
+                if self._delta_count:
+                    grown[:self._delta_count] = self._delta_points[:self._delta_count]
+                self._delta_points = grown
+
+            self._delta_points[self._delta_count:needed] = vectors
+            self._delta_ids.extend(user_ids)
+            self._delta_count = needed
+
+            need_merge = (not self._merging and
+                          self._delta_count >= self.merge_threshold)
+
+        if need_merge:
+            if self.background_merge:
+                self._start_background_merge()
+            else:
+                self._merge()
+
+    def remove(self, user_id: str) -> int:
+        """Удаляет все лица пользователя, возвращает количество удаленных"""
+        with self._lock:
+            removed = 0
+
+            if self._num_alive:
+                hits = np.flatnonzero((self._user_ids == user_id) & self._alive)
+                self._alive[hits] = False
+                self._num_alive -= len(hits)
+                removed += len(hits)
+
+            if self._delta_count:
+                keep = np.array([uid != user_id for uid in self._delta_ids], dtype=bool)
+                if not keep.all():
+                    # Записи, уже забранные фоновым слиянием, тоже сдвигаются
+                    self._merge_taken -= int(np.count_nonzero(~keep[:self._merge_taken]))
+                    kept = self._delta_points[:self._delta_count][keep]
+                    self._delta_points[:len(kept)] = kept
+                    self._delta_ids = [uid for uid in self._delta_ids if uid != user_id]
+                    removed += self._delta_count - len(kept)
+                    self._delta_count = len(kept)
+
+            if self._merging:
+                self._removed_during_merge.add(user_id)
+
+            return removed
+
+    def _start_background_merge(self) -> None:
+        """Запускает слияние буфера с деревом в фоновом потоке"""
+        with self._lock:
+            if self._merging:
+                return
+            self._merging = True
+            self._merge_thread = threading.Thread(target=self._merge, daemon=True)
+            self._merge_thread.start()
+
+    def _merge(self) -> None:
+        """Перестраивает дерево из живых точек и содержимого буфера"""
+        with self._lock:
+            self._merging = True
+            self._merge_taken = self._delta_count
+            self._removed_during_merge = set()
+            points = [self._delta_points[:self._delta_count]]
+            user_ids = [np.array(self._delta_ids, dtype=object)]
+            if self._num_alive:
+                points.insert(0, self._points[self._alive])
+                user_ids.insert(0, self._user_ids[self._alive])
+            points = np.concatenate(points) if self._delta_count or self._num_alive \
+                else np.empty((0, self.dimension), dtype=np.float32)
+            user_ids = np.concatenate(user_ids)
+
+        try:
+            # Дерево строится без блокировки: запросы и вставки продолжают работать
+            nodes = self._build_nodes(points, user_ids)
+
+            with self._lock:
+                self._set_tree(points, user_ids, nodes)
+
+                # Убираем из буфера записи, вошедшие в новое дерево
+                taken = self._merge_taken
+                remaining = self._delta_count - taken
+                self._delta_points[:remaining] = self._delta_points[taken:self._delta_count]
+                self._delta_ids = self._delta_ids[taken:]
+                self._delta_count = remaining
+
+                # Повторяем удаления, случившиеся во время построения
+                for user_id in self._removed_during_merge:
+                    hits = np.flatnonzero((self._user_ids == user_id) & self._alive)
+                    self._alive[hits] = False
+                    self._num_alive -= len(hits)
+        finally:
+            with self._lock:
+                self._merging = False
+                self._merge_taken = 0
+                self._removed_during_merge = set()
+
+    def wait_for_merge(self) -> None:
+        """Дожидается завершения фонового слияния"""
+        thread = self._merge_thread
+        if thread is not None:
+            thread.join()
+
+    def merge(self) -> None:
+        """Синхронно вливает буфер в дерево и выбрасывает удаленные лица"""
+        self.wait_for_merge()
+        if self._delta_count or self._num_alive < len(self._points):
+            self._merge()
+
+    def _leaf_distances(self, node: int, target: np.ndarray,
+                        has_removed: bool) -> Tuple[np.ndarray, int]:
+        """Квадраты расстояний до всех точек листа, считаемые одним умножением"""
+        s, e = self._start[node], self._end[node]
+        dists = np.maximum(2.0 - 2.0 * (self._points[s:e] @ target), 0.0)
+        if has_removed:
+            dists[~self._alive[s:e]] = np.inf
+        return dists, s
+
+    def _children(self, node: int, target: np.ndarray,
+                  bound: float) -> List[Tuple[int, float]]:
+        """
+        Возвращает потомков узла в порядке обхода (дальний, ближний)
+        с нижними границами квадрата расстояния до их областей
+        """
+        diff = float(target[self._split_dim[node]] - self._split_value[node])
+        if diff < 0:
+            near, far = self._left[node], self._right[node]
         else:
-            first, second = node.right, node.left
-            
-        # Рекурсивно ищем в первом поддереве
-        best_dist, best_node = self._find_nearest(first, target, 
-                                                best_dist, best_node)
-        
-        # Улучшенная проверка необходимости поиска во втором поддереве
-        axis_dist = abs(target_val - node.median_value)
-        if axis_dist < best_dist * 1.5:  # Увеличенный порог для более точного поиска
-            best_dist, best_node = self._find_nearest(second, target,
-                                                    best_dist, best_node)
-        
-        return best_dist, best_node
-        
+            near, far = self._right[node], self._left[node]
+
+        # Дальнее поддерево не ближе, чем расстояние до плоскости разбиения
+        return [(far, max(bound, diff * diff)), (near, bound)]
+
+    def _query_knn(self, target: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Точный поиск k ближайших соседей.
+        Возвращает квадраты расстояний и позиции; позиции за пределами
+        дерева указывают в буфер новых лиц.
+        """
+        best_dists = np.full(k, np.inf, dtype=np.float32)
+        best_pos = np.full(k, -1, dtype=np.int64)
+        has_removed = self._num_alive < len(self._points)
+
+        def merge_candidates(dists: np.ndarray, positions: np.ndarray) -> None:
+            nonlocal best_dists, best_pos
+            all_dists = np.concatenate((best_dists, dists))
+            all_pos = np.concatenate((best_pos, positions))
+            top = np.argpartition(all_dists, k - 1)[:k]
+            best_dists, best_pos = all_dists[top], all_pos[top]
+
+        # Стек из пар (узел, нижняя граница квадрата расстояния до его области)
+        stack = [(0, 0.0)] if self._num_alive else []
+        while stack:
+            node, bound = stack.pop()
+            if bound >= best_dists.max():
+                continue
+
+            if self._left[node] < 0:
+                dists, s = self._leaf_distances(node, target, has_removed)
+                merge_candidates(dists, np.arange(s, s + len(dists)))
+                continue
+
+            stack.extend(self._children(node, target, bound))
+
+        # Буфер новых лиц просматриваем полным перебором
+        if self._delta_count:
+            dists = np.maximum(
+                2.0 - 2.0 * (self._delta_points[:self._delta_count] @ target), 0.0)
+            merge_candidates(dists, len(self._points) + np.arange(self._delta_count))
+
+        order = np.argsort(best_dists)
+        found = np.isfinite(best_dists[order])
+        return best_dists[order][found], best_pos[order][found]
+
+    def _query_radius(self, target: np.ndarray,
+                      radius_sq: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Находит все точки не дальше радиуса, возвращает квадраты расстояний и позиции"""
+        found_dists, found_pos = [], []
+        has_removed = self._num_alive < len(self._points)
+
+        stack = [(0, 0.0)] if self._num_alive else []
+        while stack:
+            node, bound = stack.pop()
+            if bound > radius_sq:
+                continue
+
+            if self._left[node] < 0:
+                dists, s = self._leaf_distances(node, target, has_removed)
+                inside = np.flatnonzero(dists <= radius_sq)
+                found_dists.append(dists[inside])
+                found_pos.append(s + inside)
+                continue
+
+            stack.extend(self._children(node, target, bound))
+
+        if self._delta_count:
+            dists = np.maximum(
+                2.0 - 2.0 * (self._delta_points[:self._delta_count] @ target), 0.0)
+            inside = np.flatnonzero(dists <= radius_sq)
+            found_dists.append(dists[inside])
+            found_pos.append(len(self._points) + inside)
+
+        if not found_dists:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        dists = np.concatenate(found_dists)
+        positions = np.concatenate(found_pos)
+        order = np.argsort(dists)
+        return dists[order], positions[order]
+
+    def _user_id_at(self, position: int) -> str:
+        """Возвращает id пользователя по позиции в дереве или в буфере"""
+        if position < len(self._points):
+            return self._user_ids[position]
+        return self._delta_ids[position - len(self._points)]
+
+    def query_knn(self, target: np.ndarray, k: int = 5) -> List[Tuple[str, float]]:
+        """
+        Находит k ближайших лиц.
+        Возвращает пары (id, евклидово расстояние между нормированными векторами),
+        отсортированные по возрастанию расстояния
+        """
+        if k <= 0:
+            return []
+
+        query = self._normalize(np.ravel(target))
+        with self._lock:
+            if self.size == 0:
+                return []
+            dists, positions = self._query_knn(query, min(k, self.size))
+            return [(self._user_id_at(pos), float(np.sqrt(dist)))
+                    for dist, pos in zip(dists, positions)]
+
+    def query_radius(self, target: np.ndarray, r: float) -> List[Tuple[str, float]]:
+        """
+        Находит все лица на евклидовом расстоянии не больше r между
+        нормированными векторами (r = sqrt(2 * косинусное расстояние))
+        """
+        query = self._normalize(np.ravel(target))
+        with self._lock:
+            if self.size == 0:
+                return []
+            dists, positions = self._query_radius(query, r * r)
+            return [(self._user_id_at(pos), float(np.sqrt(dist)))
+                    for dist, pos in zip(dists, positions)]
+
     def find_nearest(self, target: np.ndarray) -> Tuple[Optional[str], float]:
-        """Находит ближайшее лицо к целевому"""
-        if self.root is None:
-            return None, float('inf')
-            
-        _, best_node = self._find_nearest(self.root, target)
-        if best_node is None:
-            return None, float('inf')
-            
-        # Вычисляем финальное расстояние
-        final_dist = 1 - np.dot(best_node.face_data.flatten(), target.flatten()) / \
-                    (best_node.norm * np.linalg.norm(target))
-        return best_node.user_id, final_dist
-        
-    def save(self, filepath: str) -> None:
-        """Сохраняет k-d дерево в файл"""
-        if self.root is None:
-            return
-            
-        with open(filepath, 'wb') as f:
-            pickle.dump(self.root, f)
-            
-    def load(self, filepath: str) -> None:
-        """Загружает k-d дерево из файла"""
+        """Находит ближайшее лицо к целевому, возвращает id и косинусное расстояние"""
+        query = self._normalize(np.ravel(target))
+        with self._lock:
+            if self.size == 0:
+                return None, float('inf')
+            dists, positions = self._query_knn(query, 1)
+            if len(positions) == 0:
+                return None, float('inf')
+            best_id = self._user_id_at(positions[0])
+
+        # Для нормированных векторов 1 - cos = ||a - b||^2 / 2
+        return best_id, float(dists[0]) / 2.0
+
+    def _query_knn_batch(self, queries: np.ndarray, k: int,
+                         block_size: int = 8192) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Точный поиск k ближайших соседей для пачки запросов одним матричным
+        умножением по блокам точек. Возвращает матрицы (B, k) квадратов
+        расстояний и позиций, отсортированные по строкам
+        """
+        best_dists = np.full((len(queries), k), np.inf, dtype=np.float32)
+        best_pos = np.full((len(queries), k), -1, dtype=np.int64)
+        has_removed = self._num_alive < len(self._points)
+
+        # Дерево и буфер просматриваются как одна последовательность блоков
+        sources = [(self._points, 0, has_removed),
+                   (self._delta_points[:self._delta_count], len(self._points), False)]
+        for points, offset, masked in sources:
+            for start in range(0, len(points), block_size):
+                block = points[start:start + block_size]
+                dists = np.maximum(2.0 - 2.0 * (queries @ block.T), 0.0)
+                if masked:
+                    dists[:, ~self._alive[start:start + block_size]] = np.inf
+                positions = np.broadcast_to(
+                    offset + start + np.arange(len(block)), dists.shape)
+
+                all_dists = np.concatenate((best_dists, dists), axis=1)
+                all_pos = np.concatenate((best_pos, positions), axis=1)
+                top = np.argpartition(all_dists, k - 1, axis=1)[:, :k]
+                best_dists = np.take_along_axis(all_dists, top, axis=1)
+                best_pos = np.take_along_axis(all_pos, top, axis=1)
+
+        order = np.argsort(best_dists, axis=1)
+        return (np.take_along_axis(best_dists, order, axis=1),
+                np.take_along_axis(best_pos, order, axis=1))
+
+    def query_knn_batch(self, targets: np.ndarray, k: int = 5) -> List[List[Tuple[str, float]]]:
+        """Выполняет query_knn для пачки запросов одним матричным запросом"""
+        queries = self._normalize(np.reshape(targets, (len(targets), -1)))
+        with self._lock:
+            if self.size == 0 or k <= 0:
+                return [[] for _ in range(len(queries))]
+            dists, positions = self._query_knn_batch(queries, min(k, self.size))
+            return [[(self._user_id_at(pos), float(np.sqrt(dist)))
+                     for dist, pos in zip(row_dists, row_pos) if np.isfinite(dist)]
+                    for row_dists, row_pos in zip(dists, positions)]
+
+    def find_nearest_batch(self, targets: np.ndarray) -> List[Tuple[Optional[str], float]]:
+        """Выполняет find_nearest для пачки запросов одним матричным запросом"""
+        queries = self._normalize(np.reshape(targets, (len(targets), -1)))
+        with self._lock:
+            if self.size == 0:
+                return [(None, float('inf'))] * len(queries)
+            dists, positions = self._query_knn_batch(queries, 1)
+            return [(self._user_id_at(pos), float(dist) / 2.0) if np.isfinite(dist)
+                    else (None, float('inf'))
+                    for dist, pos in zip(dists[:, 0], positions[:, 0])]
+
+    def save(self, filepath: str, db_rows: Optional[int] = None) -> None:
+        """
+        Сохраняет k-d дерево бинарным снимком: заголовок, массивы узлов,
+        матрица векторов и таблица id. Файл записывается во временный и
+        атомарно подменяет старый, так что читатели никогда не видят
+        недописанный снимок. db_rows — число строк в БД, по которому
+        load проверяет, что снимок не устарел. Пустое дерево тоже
+        записывается, чтобы не остался снимок с удаленными лицами
+        """
+        self.merge()
+        with self._lock:
+            if isinstance(self._user_ids, FixedWidthIds):
+                user_ids = self._user_ids.raw
+            else:
+                user_ids = np.array([user_id.encode('utf-8') for user_id in self._user_ids],
+                                    dtype=bytes)
+            id_width = user_ids.dtype.itemsize
+            arrays = {
+                'points': self._points, 'user_ids': user_ids,
+                'split_dim': self._split_dim, 'split_value': self._split_value,
+                'left': self._left, 'right': self._right,
+                'start': self._start, 'end': self._end,
+            }
+            num_points, dimension = arrays['points'].shape
+            layout = _snapshot_layout(num_points, dimension, len(self._split_dim), id_width)
+
+            directory = os.path.dirname(os.path.abspath(filepath))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.kd_tree_', suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w+b') as f:
+                    f.write(b'\x00' * SNAPSHOT_HEADER.size)
+                    for name, dtype, shape, offset in layout:
+                        f.seek(offset)
+                        f.write(np.ascontiguousarray(arrays[name], dtype=dtype).tobytes())
+                    f.truncate(_aligned(f.tell()))
+
+                    checksum = _file_crc32(f, layout[0][3])
+                    f.seek(0)
+                    f.write(SNAPSHOT_HEADER.pack(
+                        SNAPSHOT_MAGIC, KD_TREE_FORMAT_VERSION, self.leaf_size, num_points,
+                        dimension, len(self._split_dim), id_width,
+                        -1 if db_rows is None else db_rows, checksum))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, filepath)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+        # Переименование становится постоянным только после синхронизации директории
+        if hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+    def load(self, filepath: str, expected_rows: Optional[int] = None,
+             verify_checksum: bool = True) -> None:
+        """
+        Загружает k-d дерево из снимка. Массивы не читаются в память, а
+        отображаются из файла (np.memmap), поэтому загрузка занимает
+        миллисекунды, а несколько процессов делят одну копию в кэше страниц.
+        Если задан expected_rows, он должен совпасть с числом строк БД,
+        записанным в снимок. Поврежденный или устаревший снимок вызывает ValueError
+        """
+        self.wait_for_merge()
         try:
             with open(filepath, 'rb') as f:
-                self.root = pickle.load(f)
-                # Подсчитываем размер дерева и определяем размерность
-                def count_nodes(node: Optional[KDNode]) -> int:
-                    if node is None:
-                        return 0
-                    if self.dimension == 0:
-                        self.dimension = node.face_data.shape[1]
-                    return 1 + count_nodes(node.left) + count_nodes(node.right)
-                self.size = count_nodes(self.root)
+                header = f.read(SNAPSHOT_HEADER.size)
+                if not header.startswith(SNAPSHOT_MAGIC):
+                    f.seek(0)
+                    try:
+                        state = pickle.load(f)
+                    except Exception as e:
+                        # Обрезанный или чужой файл: pickle бросает ошибки разных типов
+                        raise ValueError(f"Файл k-d дерева поврежден: {filepath}") from e
+                    return self._load_legacy(state, filepath)
+                if len(header) < SNAPSHOT_HEADER.size:
+                    raise ValueError(f"Снимок k-d дерева обрезан: {filepath}")
+                (_, version, leaf_size, num_points, dimension, num_nodes,
+                 id_width, db_rows, checksum) = SNAPSHOT_HEADER.unpack(header)
+                if version != KD_TREE_FORMAT_VERSION:
+                    raise ValueError(f"Неподдерживаемая версия снимка k-d дерева {version}: {filepath}")
+                layout = _snapshot_layout(num_points, dimension, num_nodes, id_width)
+                name, dtype, shape, offset = layout[-1]
+                if os.fstat(f.fileno()).st_size < offset + dtype.itemsize * int(np.prod(shape)):
+                    raise ValueError(f"Снимок k-d дерева обрезан: {filepath}")
+                if verify_checksum and _file_crc32(f, layout[0][3]) != checksum:
+                    raise ValueError(f"Контрольная сумма снимка k-d дерева не совпадает: {filepath}")
         except FileNotFoundError:
-            self.root = None
-            self.size = 0 
\ No newline at end of file
+            with self._lock:
+                self._reset()
+            return
+
+        if expected_rows is not None and db_rows != expected_rows:
+            raise ValueError(f"Снимок k-d дерева устарел: в нем {db_rows} строк БД, "
+                             f"в базе {expected_rows}")
+
+        arrays = {name: np.memmap(filepath, dtype=dtype, mode='r', offset=offset, shape=shape)
+                  if np.prod(shape) else np.empty(shape, dtype=dtype)
+                  for name, dtype, shape, offset in layout}
+        with self._lock:
+            self._reset()
+            self.leaf_size = leaf_size
+            self._set_tree(arrays['points'], FixedWidthIds(arrays['user_ids']), arrays)
+            self.dimension = dimension
+
+    def _load_legacy(self, state: dict, filepath: str) -> None:
+        """Загружает дерево из pickle-файла прежнего формата"""
+        if not isinstance(state, dict) or state.get('version') != LEGACY_PICKLE_FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемый формат файла k-d дерева: {filepath}")
+
+        with self._lock:
+            self._reset()
+            self.leaf_size = state['leaf_size']
+            self._set_tree(state['points'], state['user_ids'], state)
+            self.dimension = self._points.shape[1]
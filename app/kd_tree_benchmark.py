@@ -0,0 +1,345 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from typing import List, Tuple, Dict, Optional
+from app.feature_extractor import PCAProjector
+from app.kd_tree import KDTree
+
+
+class LegacyKDNode:
+    """Узел рекурсивного k-d дерева из прежней версии app.kd_tree"""
+
+    def __init__(self, face_data: np.ndarray, user_id: str,
+                 left: Optional['LegacyKDNode'] = None,
+                 right: Optional['LegacyKDNode'] = None,
+                 axis: int = 0):
+        self.face_data = face_data
+        self.user_id = user_id
+        self.left = left
+        self.right = right
+        self.axis = axis
+        self.median_value = float(np.median(face_data, axis=0)[axis])
+        self.norm = np.linalg.norm(face_data)
+
+
+class LegacyKDTree:
+    """
+    Прежняя реализация k-d дерева на объектах KDNode.
+    Оставлена только как точка отсчета для сравнения производительности.
+    """
+
+    def __init__(self):
+        self.root: Optional[LegacyKDNode] = None
+        self.size = 0
+        self.dimension = 0
+
+    def _build_tree(self, faces: List[Tuple[np.ndarray, str]],
+                    start: int, end: int, axis: int) -> Optional[LegacyKDNode]:
+        if start >= end:
+            return None
+
+        faces_slice = faces[start:end]
+        if len(faces_slice) > 1:
+            variances = np.var([x[0] for x in faces_slice], axis=0)
+            axis = np.argmax(variances)
+
+        faces_sorted = sorted(faces_slice,
+                              key=lambda x: np.median(x[0], axis=0)[axis])
+        median_idx = len(faces_sorted) // 2
+        node = LegacyKDNode(faces_sorted[median_idx][0],
+                            faces_sorted[median_idx][1],
+                            axis=axis)
+
+        faces[start:end] = faces_sorted
+        mid = start + median_idx
+        node.left = self._build_tree(faces, start, mid,
+                                     (axis + 1) % self.dimension)
+        node.right = self._build_tree(faces, mid + 1, end,
+                                      (axis + 1) % self.dimension)
+        return node
+
+    def build(self, faces: List[Tuple[np.ndarray, str]]) -> None:
+        if not faces:
+            return
+        self.dimension = faces[0][0].shape[1]
+        self.root = self._build_tree(faces, 0, len(faces), 0)
+        self.size = len(faces)
+
+    def _find_nearest(self, node: Optional[LegacyKDNode],
+                      target: np.ndarray,
+                      best_dist: float = float('inf'),
+                      best_node: Optional[LegacyKDNode] = None) -> Tuple[float, Optional[LegacyKDNode]]:
+        if node is None:
+            return best_dist, best_node
+
+        target_norm = np.linalg.norm(target)
+        current_dist = 1 - np.dot(node.face_data.flatten(), target.flatten()) / \
+            (node.norm * target_norm)
+        if current_dist < best_dist:
+            best_dist = current_dist
+            best_node = node
+
+        target_val = np.median(target, axis=0)[node.axis]
+        if target_val < node.median_value:
+            first, second = node.left, node.right
+        else:
+            first, second = node.right, node.left
+
+        best_dist, best_node = self._find_nearest(first, target,
+                                                  best_dist, best_node)
+        axis_dist = abs(target_val - node.median_value)
+        if axis_dist < best_dist * 1.5:
+            best_dist, best_node = self._find_nearest(second, target,
+                                                      best_dist, best_node)
+        return best_dist, best_node
+
+    def find_nearest(self, target: np.ndarray) -> Tuple[Optional[str], float]:
+        if self.root is None:
+            return None, float('inf')
+        best_dist, best_node = self._find_nearest(self.root, target)
+        if best_node is None:
+            return None, float('inf')
+        return best_node.user_id, best_dist
+
+
+def generate_embeddings(num_faces: int, dimension: int,
+                        num_queries: int,
+                        rng: np.random.Generator) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Генерирует кластеризованные векторы лиц и запросы — зашумленные копии
+    случайных лиц из галереи, как при реальной идентификации
+    """
+    num_clusters = max(1, num_faces // 100)
+    centers = rng.normal(size=(num_clusters, dimension)).astype(np.float32)
+    labels = rng.integers(0, num_clusters, num_faces)
+    gallery = centers[labels] + 0.3 * rng.normal(size=(num_faces, dimension)).astype(np.float32)
+
+    query_idx = rng.integers(0, num_faces, num_queries)
+    queries = gallery[query_idx] + 0.05 * rng.normal(size=(num_queries, dimension)).astype(np.float32)
+    return gallery, queries
+
+
+def benchmark_kd_tree(database_sizes: List[int] = [1000, 10000, 100000],
+                      num_queries: int = 100,
+                      dimension: int = 128,
+                      legacy_max_size: int = 100000) -> List[Dict]:
+    """
+    Сравнение времени запроса прежнего k-d дерева на объектах KDNode
+    и нового дерева на плоских массивах
+    """
+    results = []
+    rng = np.random.default_rng(42)
+    os.makedirs("results/kd_tree", exist_ok=True)
+
+    for db_size in database_sizes:
+        print(f"\nТестирование базы данных размером {db_size} лиц...")
+        gallery, queries = generate_embeddings(db_size, dimension, num_queries, rng)
+        faces = [(gallery[i], f"user_{i}") for i in range(db_size)]
+
+        # Новое дерево на массивах
+        tree = KDTree()
+        start_time = time.time()
+        tree.build(faces)
+        array_build_time = time.time() - start_time
+
+        array_times = []
+        array_answers = []
+        for query in queries:
+            start_time = time.time()
+            user_id, _ = tree.find_nearest(query)
+            array_times.append(time.time() - start_time)
+            array_answers.append(user_id)
+
+        result = {
+            'database_size': db_size,
+            'array_build_time': array_build_time,
+            'array_avg_query_time': np.mean(array_times),
+            'array_std_query_time': np.std(array_times),
+            'legacy_build_time': np.nan,
+            'legacy_avg_query_time': np.nan,
+            'legacy_std_query_time': np.nan,
+            'legacy_match_rate': np.nan,
+            'speedup': np.nan
+        }
+
+        # Прежнее дерево работает с лицами формы (1, D)
+        if db_size <= legacy_max_size:
+            legacy_tree = LegacyKDTree()
+            legacy_faces = [(face.reshape(1, -1), user_id) for face, user_id in faces]
+            start_time = time.time()
+            legacy_tree.build(legacy_faces)
+            result['legacy_build_time'] = time.time() - start_time
+
+            legacy_times = []
+            legacy_answers = []
+            for query in queries:
+                start_time = time.time()
+                user_id, _ = legacy_tree.find_nearest(query.reshape(1, -1))
+                legacy_times.append(time.time() - start_time)
+                legacy_answers.append(user_id)
+
+            result['legacy_avg_query_time'] = np.mean(legacy_times)
+            result['legacy_std_query_time'] = np.std(legacy_times)
+            # Новое дерево точное, поэтому совпадение с ним — доля верных ответов
+            result['legacy_match_rate'] = np.mean(
+                [a == b for a, b in zip(legacy_answers, array_answers)])
+            result['speedup'] = result['legacy_avg_query_time'] / result['array_avg_query_time']
+            print(f"Прежнее дерево: {result['legacy_avg_query_time']:.6f} с на запрос, "
+                  f"точных ответов: {result['legacy_match_rate']:.1%}")
+
+        print(f"Дерево на массивах: {result['array_avg_query_time']:.6f} с на запрос")
+        if not np.isnan(result['speedup']):
+            print(f"Ускорение: {result['speedup']:.1f}x")
+
+        results.append(result)
+
+    results_df = pd.DataFrame(results)
+    results_df.to_csv("results/kd_tree/array_vs_legacy.csv", index=False)
+    print("\nРезультаты сохранены в results/kd_tree/array_vs_legacy.csv")
+
+    return results
+
+
+def brute_force_search(gallery: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Евклидовы расстояния от запроса до всех нормированных лиц галереи"""
+    return np.linalg.norm(gallery - query / np.linalg.norm(query), axis=1)
+
+
+def benchmark_knn_recall(database_sizes: List[int] = [1000, 10000, 100000],
+                         num_queries: int = 100,
+                         dimension: int = 128,
+                         k: int = 10,
+                         radius: float = 0.5) -> List[Dict]:
+    """
+    Проверка полноты и времени запросов query_knn и query_radius
+    относительно полного перебора
+    """
+    results = []
+    rng = np.random.default_rng(42)
+    os.makedirs("results/kd_tree", exist_ok=True)
+
+    for db_size in database_sizes:
+        print(f"\nТестирование базы данных размером {db_size} лиц...")
+        gallery, queries = generate_embeddings(db_size, dimension, num_queries, rng)
+        user_ids = np.array([f"user_{i}" for i in range(db_size)])
+
+        tree = KDTree()
+        tree.build([(gallery[i], user_ids[i]) for i in range(db_size)])
+        normalized = gallery / np.linalg.norm(gallery, axis=1, keepdims=True)
+
+        brute_times, knn_times, radius_times = [], [], []
+        knn_recalls, radius_recalls = [], []
+        for query in queries:
+            start_time = time.time()
+            dists = brute_force_search(normalized, query)
+            true_knn = set(user_ids[np.argsort(dists)[:k]])
+            true_radius = set(user_ids[dists <= radius])
+            brute_times.append(time.time() - start_time)
+
+            start_time = time.time()
+            knn = tree.query_knn(query, k)
+            knn_times.append(time.time() - start_time)
+
+            start_time = time.time()
+            in_radius = tree.query_radius(query, radius)
+            radius_times.append(time.time() - start_time)
+
+            knn_recalls.append(len(true_knn & {user_id for user_id, _ in knn}) / len(true_knn))
+            if true_radius:
+                radius_recalls.append(
+                    len(true_radius & {user_id for user_id, _ in in_radius}) / len(true_radius))
+
+        result = {
+            'database_size': db_size,
+            'brute_force_avg_query_time': np.mean(brute_times),
+            'knn_avg_query_time': np.mean(knn_times),
+            'knn_recall': np.mean(knn_recalls),
+            'radius_avg_query_time': np.mean(radius_times),
+            'radius_recall': np.mean(radius_recalls) if radius_recalls else np.nan
+        }
+        print(f"Полный перебор: {result['brute_force_avg_query_time']:.6f} с")
+        print(f"query_knn (k={k}): {result['knn_avg_query_time']:.6f} с, "
+              f"полнота {result['knn_recall']:.3f}")
+        print(f"query_radius (r={radius}): {result['radius_avg_query_time']:.6f} с, "
+              f"полнота {result['radius_recall']:.3f}")
+        results.append(result)
+
+    results_df = pd.DataFrame(results)
+    results_df.to_csv("results/kd_tree/knn_recall.csv", index=False)
+    print("\nРезультаты сохранены в results/kd_tree/knn_recall.csv")
+
+    return results
+
+
+def benchmark_reduced_dimension(database_sizes: List[int] = [1000, 5000],
+                                num_queries: int = 100,
+                                raw_dimension: int = 10000,
+                                dimensions: List[int] = [128, 64],
+                                pca_sample_size: int = 2000) -> List[Dict]:
+    """
+    Сравнение дерева и линейного перебора на сырых векторах из 10 000 пикселей
+    и на их PCA-проекциях: время запроса, память и совпадение ответа
+    с точным поиском по сырым векторам
+    """
+    results = []
+    rng = np.random.default_rng(42)
+    os.makedirs("results/kd_tree", exist_ok=True)
+
+    for db_size in database_sizes:
+        print(f"\nТестирование базы данных размером {db_size} лиц...")
+        gallery, queries = generate_embeddings(db_size, raw_dimension, num_queries, rng)
+        user_ids = [f"user_{i}" for i in range(db_size)]
+
+        normalized = gallery / np.linalg.norm(gallery, axis=1, keepdims=True)
+        exact = [user_ids[np.argmin(brute_force_search(normalized, query))] for query in queries]
+        del normalized
+
+        for dimension in [raw_dimension] + dimensions:
+            if dimension == raw_dimension:
+                vectors, query_vectors = gallery, queries
+            else:
+                projector = PCAProjector(dimension).fit(gallery[:pca_sample_size])
+                vectors = projector.transform(gallery)
+                query_vectors = projector.transform(queries)
+
+            tree = KDTree()
+            tree.build_from_matrix(vectors, user_ids)
+            points = tree._points
+
+            tree_times, scan_times, answers = [], [], []
+            for query in query_vectors:
+                start_time = time.time()
+                user_id, _ = tree.find_nearest(query)
+                tree_times.append(time.time() - start_time)
+                answers.append(user_id)
+
+                start_time = time.time()
+                brute_force_search(points, query).argmin()
+                scan_times.append(time.time() - start_time)
+
+            result = {
+                'database_size': db_size,
+                'dimension': dimension,
+                'tree_avg_query_time': np.mean(tree_times),
+                'scan_avg_query_time': np.mean(scan_times),
+                'memory_mb': points.nbytes / 2**20,
+                'match_rate': np.mean([a == b for a, b in zip(answers, exact)])
+            }
+            print(f"D={dimension}: дерево {result['tree_avg_query_time']:.6f} с, "
+                  f"перебор {result['scan_avg_query_time']:.6f} с, "
+                  f"память {result['memory_mb']:.1f} МБ, "
+                  f"совпадение с точным ответом {result['match_rate']:.1%}")
+            results.append(result)
+
+    results_df = pd.DataFrame(results)
+    results_df.to_csv("results/kd_tree/reduced_dimension.csv", index=False)
+    print("\nРезультаты сохранены в results/kd_tree/reduced_dimension.csv")
+
+    return results
+
+
+if __name__ == "__main__":
+    benchmark_kd_tree()
+    benchmark_knn_recall()
+    benchmark_reduced_dimension()
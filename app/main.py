@@ -1,22 +1,29 @@
 import sys
-import cv2
-import numpy as np
+from typing import Optional
 from PySide6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                            QHBoxLayout, QPushButton, QLabel, QLineEdit, 
                            QMessageBox, QStackedWidget)
-from PySide6.QtCore import Qt, QTimer
+from PySide6.QtCore import Qt
 from PySide6.QtGui import QImage, QPixmap
+from database import BiometricDatabase
 from face_processor import FaceProcessor
+from face_tracker import FaceTracker
+from camera_workers import LatestFrameBuffer, CaptureThread, RecognitionWorker
 import os
 
+# Путь к файлу SQLite для автономного постамата; без него используется PostgreSQL
+SQLITE_PATH_ENV = 'BIOMETRIC_SQLITE_PATH'
+
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, db: Optional[BiometricDatabase] = None):
         super().__init__()
         self.setWindowTitle("Система распознавания лиц")
         self.setGeometry(100, 100, 800, 600)
         
         # Инициализация процессора лиц
-        self.face_processor = FaceProcessor()
+        self.face_processor = FaceProcessor(db=db)
+        # Детекция для видеопотока: уменьшенный кадр и слежение за последним лицом
+        self.face_tracker = FaceTracker(self.face_processor.face_cascade)
         
         # Создание центрального виджета
         self.central_widget = QWidget()
@@ -29,6 +36,10 @@ class MainWindow(QMainWindow):
         self.stacked_widget = QStackedWidget()
         self.layout.addWidget(self.stacked_widget)
         
+        # Счетчики детекции: частота кадров и задержка
+        self.detection_stats_label = QLabel()
+        self.layout.addWidget(self.detection_stats_label)
+        
         # Создание страниц
         self.main_page = QWidget()
         self.registration_page = QWidget()
@@ -44,10 +55,20 @@ class MainWindow(QMainWindow):
         self.setup_registration_page()
         self.setup_verification_page()
         
-        # Инициализация камеры
-        self.cap = cv2.VideoCapture(0)
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.update_frame)
+        # Камера и распознавание работают в своих потоках и общаются с GUI сигналами;
+        # между ними — буфер последнего кадра, так что отставший распознаватель пропускает кадры
+        self.frame_buffer = LatestFrameBuffer()
+        self.capture_thread = CaptureThread(self.face_tracker, self.frame_buffer)
+        self.capture_thread.frame_ready.connect(self.update_frame)
+        self.capture_thread.stats_updated.connect(self.update_detection_stats)
+        self.recognition_worker = RecognitionWorker(self.face_processor, self.frame_buffer)
+        self.recognition_worker.recognized.connect(self.on_recognized)
+        self.recognition_worker.verified.connect(self.on_verified)
+        self.recognition_worker.registered.connect(self.on_registered)
+        self.recognition_worker.face_missing.connect(
+            lambda: QMessageBox.warning(self, "Ошибка", "Лицо не обнаружено"))
+        self.recognition_worker.failed.connect(
+            lambda message: QMessageBox.warning(self, "Ошибка", message))
         
     def setup_main_page(self):
         layout = QVBoxLayout(self.main_page)
@@ -93,6 +114,11 @@ class MainWindow(QMainWindow):
         self.verification_video.setAlignment(Qt.AlignCenter)
         layout.addWidget(self.verification_video)
         
+        # Поле для ID: если он введен, лицо сверяется только с этим пользователем
+        self.verify_id_input = QLineEdit()
+        self.verify_id_input.setPlaceholderText("ID пользователя (необязательно)")
+        layout.addWidget(self.verify_id_input)
+        
         # Кнопки
         verify_btn = QPushButton("Проверить")
         back_btn = QPushButton("Назад")
@@ -103,71 +129,58 @@ class MainWindow(QMainWindow):
         layout.addWidget(verify_btn)
         layout.addWidget(back_btn)
         
-    def update_frame(self):
-        ret, frame = self.cap.read()
-        if ret:
-            # Конвертируем кадр в RGB
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            
-            # Обнаруживаем лицо
-            face_result = self.face_processor.detect_face(frame)
-            if face_result:
-                face, (x, y, w, h) = face_result
-                # Рисуем прямоугольник вокруг лица
-                cv2.rectangle(rgb_frame, (x, y), (x+w, y+h), (0, 255, 0), 2)
-            
-            # Конвертируем в QImage и отображаем
-            h, w, ch = rgb_frame.shape
-            bytes_per_line = ch * w
-            qt_image = QImage(rgb_frame.data, w, h, bytes_per_line, QImage.Format_RGB888)
-            
-            # Отображаем на соответствующей странице
-            current_page = self.stacked_widget.currentWidget()
-            if current_page == self.registration_page:
-                self.registration_video.setPixmap(QPixmap.fromImage(qt_image))
-            elif current_page == self.verification_page:
-                self.verification_video.setPixmap(QPixmap.fromImage(qt_image))
+    def update_frame(self, qt_image: QImage):
+        # Отображаем на соответствующей странице
+        current_page = self.stacked_widget.currentWidget()
+        if current_page == self.registration_page:
+            self.registration_video.setPixmap(QPixmap.fromImage(qt_image))
+        elif current_page == self.verification_page:
+            self.verification_video.setPixmap(QPixmap.fromImage(qt_image))
+        self.capture_thread.frame_displayed()
+        
+    def update_detection_stats(self, stats: dict):
+        self.detection_stats_label.setText(
+            f"Детекция: {stats['fps']:.0f} кадр/с, {stats['latency_ms']:.1f} мс, "
+            f"пропущено кадров: {stats['dropped']}")
                 
     def register_user(self):
         user_id = self.user_id_input.text()
         if not user_id:
             QMessageBox.warning(self, "Ошибка", "Введите ID пользователя")
             return
-            
-        ret, frame = self.cap.read()
-        if ret:
-            face_result = self.face_processor.detect_face(frame)
-            if face_result:
-                face, _ = face_result
-                self.face_processor.add_face(face, user_id)
-                QMessageBox.information(self, "Успех", "Пользователь успешно зарегистрирован")
-            else:
-                QMessageBox.warning(self, "Ошибка", "Лицо не обнаружено")
+        self.recognition_worker.request_register(user_id)
+        
+    def on_registered(self, user_id: str, elapsed: float):
+        QMessageBox.information(self, "Успех", "Пользователь успешно зарегистрирован")
                 
     def verify_user(self):
-        ret, frame = self.cap.read()
-        if ret:
-            face_result = self.face_processor.detect_face(frame)
-            if face_result:
-                face, _ = face_result
-                user_id = self.face_processor.recognize_face(face)
-                if user_id:
-                    QMessageBox.information(self, "Успех", f"Пользователь распознан: {user_id}")
-                else:
-                    QMessageBox.warning(self, "Ошибка", "Пользователь не распознан")
-            else:
-                QMessageBox.warning(self, "Ошибка", "Лицо не обнаружено")
+        self.recognition_worker.request_verify(self.verify_id_input.text().strip() or None)
+        
+    def on_recognized(self, user_id, elapsed: float):
+        if user_id:
+            QMessageBox.information(self, "Успех", f"Пользователь распознан: {user_id}")
+        else:
+            QMessageBox.warning(self, "Ошибка", "Пользователь не распознан")
+            
+    def on_verified(self, user_id: str, match: bool, elapsed: float):
+        if match:
+            QMessageBox.information(self, "Успех", f"Личность подтверждена: {user_id}")
+        else:
+            QMessageBox.warning(self, "Ошибка", f"Лицо не соответствует пользователю {user_id}")
                 
     def showEvent(self, event):
-        self.timer.start(30)  # Обновление каждые 30 мс
+        if not self.capture_thread.isRunning():
+            self.capture_thread.start()
+            self.recognition_worker.start()
         
     def closeEvent(self, event):
-        self.timer.stop()
-        self.cap.release()
+        self.capture_thread.stop()
+        self.recognition_worker.stop()
         event.accept()
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
-    window = MainWindow()
+    sqlite_path = os.environ.get(SQLITE_PATH_ENV)
+    window = MainWindow(BiometricDatabase(sqlite_path, backend='sqlite') if sqlite_path else None)
     window.show()
     sys.exit(app.exec())
\ No newline at end of file
@@ -26,11 +26,11 @@ class OptimizedBenchmark:
             faces = generator.generate_faces(size)
             
             # Очищаем базу данных
-            self.processor.db.clear_database()
+            self.processor.clear_database()
             
-            # Добавляем лица в базу
-            for i, face in enumerate(faces):
-                self.processor.add_face(face, f"user_{i}")
+            # Добавляем лица в базу одной транзакцией
+            self.processor.add_faces_bulk(
+                (face, f"user_{i}") for i, face in enumerate(faces))
             
             # Тестируем поиск
             query_times = []
@@ -64,6 +64,75 @@ class OptimizedBenchmark:
         
         return pd.DataFrame(results)
         
+    def run_batch_benchmark(self, database_size: int,
+                            batch_sizes: List[int],
+                            num_batches: int) -> pd.DataFrame:
+        """Сравнивает пакетное распознавание с поочередным для разных размеров пачки"""
+        generator = DataGenerator()
+        
+        # Заполняем базу данных один раз для всех размеров пачки
+        self.processor.clear_database()
+        self.processor.add_faces_bulk(
+            (face, f"user_{i}") for i, face in enumerate(generator.generate_faces(database_size)))
+        
+        results = []
+        for batch_size in batch_sizes:
+            print(f"Тестирование пачек размером: {batch_size}")
+            
+            batch_times = []
+            sequential_times = []
+            for _ in range(num_batches):
+                faces = generator.generate_faces(batch_size)
+                
+                _, batch_time = self.processor.recognize_batch(faces)
+                batch_times.append(batch_time)
+                
+                start_time = time.time()
+                for face in faces:
+                    self.processor.recognize_face(face)
+                sequential_times.append(time.time() - start_time)
+            
+            avg_batch_time = np.mean(batch_times)
+            results.append({
+                'database_size': database_size,
+                'batch_size': batch_size,
+                'avg_batch_time': avg_batch_time,
+                'std_batch_time': np.std(batch_times),
+                'avg_time_per_query': avg_batch_time / batch_size,
+                'sequential_time_per_query': np.mean(sequential_times) / batch_size,
+                'queries_per_second': batch_size / avg_batch_time,
+                'speedup': np.mean(sequential_times) / avg_batch_time
+            })
+        
+        return pd.DataFrame(results)
+        
+    def plot_batch_results(self, results: pd.DataFrame, save_path: str) -> None:
+        """Строит график времени на запрос в зависимости от размера пачки"""
+        plt.figure(figsize=(12, 8))
+        ax1 = plt.subplot(111)
+        
+        ax1.plot(results['batch_size'], results['sequential_time_per_query'],
+                 marker='o', label='Поочередные запросы', linewidth=2, markersize=8)
+        ax1.plot(results['batch_size'], results['avg_time_per_query'],
+                 marker='s', label='Пакетный запрос', linewidth=2, markersize=8)
+        
+        ax1.set_xscale('log', base=2)
+        ax1.set_yscale('log')
+        ax1.set_xlabel('Размер пачки (количество лиц)', fontsize=12)
+        ax1.set_ylabel('Время на один запрос (секунды)', fontsize=12)
+        ax1.set_title(f'Пакетное распознавание (база из {results.iloc[0]["database_size"]} лиц)',
+                      fontsize=14, pad=20)
+        ax1.grid(True, linestyle='--', alpha=0.7)
+        ax1.legend(loc='upper right', fontsize=10)
+        
+        for i, row in results.iterrows():
+            ax1.annotate(f'x{row["speedup"]:.1f}',
+                         (row['batch_size'], row['avg_time_per_query']),
+                         xytext=(10, -15), textcoords='offset points')
+        
+        plt.savefig(save_path, dpi=300, bbox_inches='tight')
+        plt.close()
+        
     def plot_results(self, results: pd.DataFrame, save_path: str) -> None:
         """Строит график результатов тестирования"""
         plt.figure(figsize=(12, 8))
@@ -1,40 +1,216 @@
 import cv2
 import numpy as np
-from typing import Tuple, List, Optional
+from typing import Tuple, List, Optional, Iterable, Callable, Union
+from collections import OrderedDict
 import os
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from app.database import BiometricDatabase
+from app.feature_extractor import FaceEmbedder
+from app.ingest_pipeline import IngestPipeline
 from app.kd_tree import KDTree
+from app.product_quantizer import PQIndex
+from app.search_index import SearchIndex
 
 class OptimizedFaceProcessor:
-    def __init__(self):
-        """Инициализация процессора лиц"""
+    # Максимальное косинусное расстояние, при котором лицо считается найденным
+    DISTANCE_THRESHOLD = 0.6
+    # Сколько пользователей держит кэш шаблонов для проверки 1:1
+    TEMPLATE_CACHE_SIZE = 10000
+    # Словари PQ-индекса, которыми закодирована колонка pq_code в базе
+    PQ_CODEBOOKS_PATH = 'pq_codebooks.npz'
+    
+    def __init__(self, embedder: Optional[FaceEmbedder] = None,
+                 index: Optional[SearchIndex] = None,
+                 index_path: str = 'kd_tree.idx',
+                 db: Optional[BiometricDatabase] = None):
+        """
+        Инициализация процессора лиц.
+        С обученным embedder индекс строится по компактным эмбеддингам,
+        иначе — по сырым пикселям лица. По умолчанию индекс — k-d дерево,
+        вместо него можно передать любой SearchIndex, например IVFIndex.
+        Если в index_path лежит снимок k-d дерева, соответствующий базе,
+        дерево отображается из него вместо построения по базе.
+        db — готовое подключение к базе (например, SQLite); по умолчанию PostgreSQL
+        """
+        self.logger = logging.getLogger(__name__)
         # Загружаем каскадный классификатор
-        cascade_path = 'haarcascade_frontalface_default.xml'
-        if not os.path.exists(cascade_path):
-            raise FileNotFoundError(f"Файл каскадного классификатора не найден: {cascade_path}")
+        self.cascade_path = 'haarcascade_frontalface_default.xml'
+        if not os.path.exists(self.cascade_path):
+            raise FileNotFoundError(f"Файл каскадного классификатора не найден: {self.cascade_path}")
             
-        self.face_cascade = cv2.CascadeClassifier(cascade_path)
+        self.face_cascade = cv2.CascadeClassifier(self.cascade_path)
         if self.face_cascade.empty():
             raise ValueError("Не удалось загрузить каскадный классификатор")
             
         # Инициализируем базу данных
-        self.db = BiometricDatabase()
+        self.db = db if db is not None else BiometricDatabase()
+        self.embedder = embedder
         
-        # Инициализируем k-d дерево
-        self.kd_tree = KDTree()
+        # Инициализируем индекс поиска
+        self.index = index if index is not None else KDTree()
+        self.index_path = index_path
         
-        # Загружаем существующие лица в k-d дерево
+        # Нормированные шаблоны пользователей для проверки 1:1, вытесняются по LRU.
+        # Версия растет при каждом изменении базы, чтобы не закэшировать
+        # шаблоны, прочитанные до конкурентной записи
+        self._templates: OrderedDict = OrderedDict()
+        self._templates_version = 0
+        self._templates_lock = threading.Lock()
+        
+        # Загружаем существующие лица в индекс
+        self._load_pq_codebooks()
         self._load_faces_to_tree()
         
-    def _load_faces_to_tree(self) -> None:
-        """Загружает лица из базы данных в k-d дерево"""
-        faces = self.db.get_all_faces()
-        if faces:
-            # Преобразуем данные в формат для k-d дерева
-            tree_data = [(face_data, user_id) for user_id, face_data in faces]
-            self.kd_tree.build(tree_data)
+    def _use_embeddings(self) -> bool:
+        return self.embedder is not None and self.embedder.is_fitted
+        
+    def _embed(self, faces: List[np.ndarray]) -> np.ndarray:
+        """Векторы для дерева: эмбеддинги или развернутые пиксели лиц"""
+        if self._use_embeddings():
+            return self.embedder.transform(faces)
+        return np.stack([np.ravel(face) for face in faces])
+        
+    def _index_rows(self) -> int:
+        """Число строк базы, из которых строится индекс"""
+        return self.db.count_embeddings() if self._use_embeddings() else self.db.get_database_size()
+        
+    def _invalidate_templates(self, user_ids: Optional[Iterable[str]] = None) -> None:
+        """Сбрасывает кэш шаблонов указанных пользователей или целиком"""
+        with self._templates_lock:
+            self._templates_version += 1
+            if user_ids is None:
+                self._templates.clear()
+            else:
+                for user_id in user_ids:
+                    self._templates.pop(user_id, None)
+                    
+    def _user_templates(self, user_id: str) -> np.ndarray:
+        """
+        Нормированные шаблоны пользователя (n, D): из кэша или
+        выборкой из базы по индексу faces(user_id)
+        """
+        with self._templates_lock:
+            templates = self._templates.get(user_id)
+            if templates is not None:
+                self._templates.move_to_end(user_id)
+                return templates
+            version = self._templates_version
+            
+        if self._use_embeddings():
+            templates = self.db.get_user_embeddings(user_id)
+        else:
+            templates = self.db.get_user_faces(user_id)
+        if len(templates) == 0:
+            # Пустой ответ не кэшируется, чтобы неизвестные id не вытесняли шаблоны
+            return templates
+        templates = SearchIndex._normalize(np.reshape(templates, (len(templates), -1)))
+        
+        with self._templates_lock:
+            if version == self._templates_version:
+                self._templates[user_id] = templates
+                if len(self._templates) > self.TEMPLATE_CACHE_SIZE:
+                    self._templates.popitem(last=False)
+        return templates
+        
+    def _load_snapshot(self) -> bool:
+        """Загружает k-d дерево из снимка, если он есть и совпадает с базой"""
+        if not isinstance(self.index, KDTree) or not os.path.exists(self.index_path):
+            return False
+        try:
+            self.index.load(self.index_path, expected_rows=self._index_rows())
+        except ValueError as e:
+            self.logger.warning(f"Снимок индекса не используется, индекс строится по базе: {e}")
+            return False
+        dimension = self.embedder.dimension if self._use_embeddings() else 100 * 100
+        return self.index.size == 0 or self.index.dimension == dimension
+        
+    def _load_faces_to_tree(self, use_snapshot: bool = True) -> None:
+        """Загружает лица из базы данных (или из снимка) в индекс поиска"""
+        # Читаем базу порциями прямо в матрицу индекса
+        if self._use_embeddings():
+            # Записи, добавленные без экстрактора, получают эмбеддинги сейчас
+            self.db.update_embeddings(self.embedder.transform)
+            if use_snapshot and self._load_snapshot():
+                return
+            if isinstance(self.index, PQIndex) and self.index.quantizer.is_fitted:
+                # PQ-индекс читает готовые коды, не загружая эмбеддинги в память
+                self.db.update_pq_codes(self._encode_pq)
+                self.index.build_from_code_chunks(self.db.iter_pq_codes(),
+                                                  self.db.count_pq_codes())
+            else:
+                was_fitted = self._pq_fitted()
+                self.index.build_from_chunks(self.db.iter_embeddings(),
+                                             self.db.count_embeddings())
+                self._sync_pq_codes(was_fitted)
+        elif not (use_snapshot and self._load_snapshot()):
+            self.index.build_from_chunks(self.db.iter_faces(),
+                                         self.db.get_database_size())
+            
+    def _load_pq_codebooks(self) -> None:
+        """Загружает словари, которыми закодирована база, чтобы коды в ней оставались верными"""
+        if not (isinstance(self.index, PQIndex) and self._use_embeddings()
+                and not self.index.quantizer.is_fitted
+                and os.path.exists(self.PQ_CODEBOOKS_PATH)):
+            return
+        quantizer = self.index.quantizer
+        quantizer.load(self.PQ_CODEBOOKS_PATH)
+        if quantizer.codebooks.shape[0] * quantizer.codebooks.shape[2] != self.embedder.dimension:
+            self.logger.warning("Словари PQ не подходят к эмбеддингам и будут обучены заново")
+            quantizer.codebooks = None
+            
+    def _pq_fitted(self) -> bool:
+        return isinstance(self.index, PQIndex) and self.index.quantizer.is_fitted
+        
+    def _sync_pq_codes(self, was_fitted: bool) -> None:
+        """
+        Если PQ-индекс только что обучил словари, сохраняет их и перекодирует
+        всю базу: коды, записанные прежними словарями, устарели
+        """
+        if was_fitted or not self._pq_fitted() or not self._use_embeddings():
+            return
+        self.index.quantizer.save(self.PQ_CODEBOOKS_PATH)
+        self.db.update_pq_codes(self._encode_pq, only_missing=False)
+        
+    def _encode_pq(self, embeddings: np.ndarray) -> np.ndarray:
+        """PQ-коды эмбеддингов в том же нормированном пространстве, что и индекс"""
+        return self.index.quantizer.encode(self.index._normalize(embeddings))
+        
+    def fit_embedder(self, embedder: Optional[FaceEmbedder] = None,
+                     sample_size: int = 10000) -> int:
+        """
+        Обучает PCA-проекцию на первых sample_size лицах базы, пересчитывает
+        эмбеддинги всех записей и перестраивает индекс.
+        Возвращает размер обучающей выборки
+        """
+        self.embedder = embedder or self.embedder or FaceEmbedder()
+        sample = []
+        for _, block in self.db.iter_faces():
+            sample.extend(block[:sample_size - len(sample)])
+            if len(sample) >= sample_size:
+                break
+        if not sample:
+            return 0
+            
+        self.embedder.fit(sample)
+        self.db.update_embeddings(self.embedder.transform, only_missing=False)
+        self._invalidate_templates()
+        if isinstance(self.index, PQIndex):
+            # Словари обучаются заново на новых эмбеддингах, старые коды устарели;
+            # _sync_pq_codes перекодирует базу, как только словари будут обучены
+            self.index.quantizer.codebooks = None
+            if os.path.exists(self.PQ_CODEBOOKS_PATH):
+                os.remove(self.PQ_CODEBOOKS_PATH)
+            self._load_faces_to_tree(use_snapshot=False)
+        else:
+            # Снимок хранит векторы прежней проекции
+            self._load_faces_to_tree(use_snapshot=False)
+        return len(sample)
             
-    def detect_face(self, image: np.ndarray) -> Optional[np.ndarray]:
+    def detect_face(self, image: np.ndarray,
+                    cascade: Optional[cv2.CascadeClassifier] = None) -> Optional[np.ndarray]:
         """Обнаруживает лицо на изображении"""
         if image is None or image.size == 0:
             return None
@@ -43,7 +219,7 @@ class OptimizedFaceProcessor:
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
         
         # Обнаруживаем лица
-        faces = self.face_cascade.detectMultiScale(
+        faces = (cascade or self.face_cascade).detectMultiScale(
             gray,
             scaleFactor=1.1,
             minNeighbors=5,
@@ -66,39 +242,168 @@ class OptimizedFaceProcessor:
         return face
         
     def add_face(self, face: np.ndarray, user_id: str) -> bool:
-        """Добавляет лицо в базу данных и k-d дерево"""
+        """Добавляет лицо в базу данных и индекс поиска"""
         if face is None or face.size == 0:
             return False
             
+        vector = self._embed([face])[0]
+        
         # Добавляем в базу данных
-        if not self.db.add_face(user_id, face):
-            return False
+        self.db.add_face(user_id, face, vector if self._use_embeddings() else None)
+        self._invalidate_templates([user_id])
             
-        # Добавляем в k-d дерево
-        faces = self.db.get_all_faces()
-        tree_data = [(face_data, uid) for uid, face_data in faces]
-        self.kd_tree.build(tree_data)
+        # Добавляем в индекс без полной перестройки
+        was_fitted = self._pq_fitted()
+        self.index.insert(vector, user_id)
+        self._sync_pq_codes(was_fitted)
         
         return True
         
+    def detect_faces_parallel(self, images: Iterable[np.ndarray],
+                              max_workers: Optional[int] = None) -> List[Optional[np.ndarray]]:
+        """Обнаруживает лица на изображениях в пуле потоков"""
+        # OpenCV отпускает GIL внутри detectMultiScale; каждому потоку — свой классификатор
+        local = threading.local()
+        
+        def detect(image: np.ndarray) -> Optional[np.ndarray]:
+            if not hasattr(local, 'cascade'):
+                local.cascade = cv2.CascadeClassifier(self.cascade_path)
+            return self.detect_face(image, local.cascade)
+            
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(detect, images))
+        
+    def add_faces_bulk(self, faces: Iterable[Tuple[np.ndarray, str]],
+                       detect: bool = False,
+                       max_workers: Optional[int] = None) -> int:
+        """
+        Массово добавляет пары (лицо, id) в базу данных одной транзакцией
+        и обновляет индекс один раз в конце.
+        При detect=True на входе кадры, лица на которых ищутся параллельно.
+        Возвращает количество добавленных лиц
+        """
+        faces = list(faces)
+        if detect:
+            crops = self.detect_faces_parallel([image for image, _ in faces], max_workers)
+            faces = [(crop, user_id) for crop, (_, user_id) in zip(crops, faces)]
+        faces = [(face, user_id) for face, user_id in faces
+                 if face is not None and face.size > 0]
+        if not faces:
+            return 0
+            
+        vectors = self._embed([face for face, _ in faces])
+        if self._use_embeddings():
+            self.db.add_faces_bulk((user_id, face, vector)
+                                   for (face, user_id), vector in zip(faces, vectors))
+        else:
+            self.db.add_faces_bulk((user_id, face) for face, user_id in faces)
+        self._invalidate_templates({user_id for _, user_id in faces})
+        was_fitted = self._pq_fitted()
+        self.index.insert_batch(vectors, [user_id for _, user_id in faces])
+        self._sync_pq_codes(was_fitted)
+        return len(faces)
+        
+    def ingest(self, source: Union[str, Iterable[str]],
+               user_id_from_path: Optional[Callable[[str], str]] = None,
+               pipeline: Optional[IngestPipeline] = None,
+               chunk_size: int = 1000) -> int:
+        """
+        Загружает фотографии из директории или списка путей: детекция идет
+        на всех ядрах в IngestPipeline, найденные лица пишутся в базу и
+        индекс пачками по chunk_size. По умолчанию id — имя файла без
+        расширения. Возвращает количество добавленных лиц
+        """
+        user_id_from_path = user_id_from_path or \
+            (lambda path: os.path.splitext(os.path.basename(path))[0])
+        pipeline = pipeline or IngestPipeline(self.cascade_path, ordered=False)
+        added = 0
+        chunk = []
+        for result in pipeline.run(source):
+            if result.face is None:
+                continue
+            chunk.append((result.face, user_id_from_path(result.path)))
+            if len(chunk) == chunk_size:
+                added += self.add_faces_bulk(chunk)
+                chunk = []
+        if chunk:
+            added += self.add_faces_bulk(chunk)
+        return added
+        
+    def remove_face(self, user_id: str) -> int:
+        """Удаляет все лица пользователя из базы данных и индекса"""
+        self.db.delete_faces(user_id)
+        self._invalidate_templates([user_id])
+        return self.index.remove(user_id)
+        
+    def clear_database(self) -> None:
+        """Очищает базу данных и индекс"""
+        self.db.clear_database()
+        self._invalidate_templates()
+        self.index.clear()
+        
     def recognize_face(self, face: np.ndarray) -> Tuple[Optional[str], float]:
-        """Распознает лицо с использованием k-d дерева"""
+        """Распознает лицо с использованием индекса поиска"""
         if face is None or face.size == 0:
             return None, float('inf')
             
-        # Находим ближайшее лицо в k-d дереве
-        user_id, distance = self.kd_tree.find_nearest(face)
+        # Находим ближайшее лицо в индексе
+        user_id, distance = self.index.find_nearest(self._embed([face])[0])
         
         # Если расстояние слишком большое, считаем что лицо не найдено
-        if distance > 0.6:  # Пороговое значение
+        if distance > self.DISTANCE_THRESHOLD:
             return None, float('inf')
             
         return user_id, distance
         
+    def verify(self, face: np.ndarray, user_id: str) -> Tuple[bool, float]:
+        """
+        Проверка 1:1 заявленной личности: лицо сравнивается только с шаблонами
+        user_id, без поиска по галерее, поэтому время не зависит от размера базы.
+        Возвращает признак совпадения и наименьшее косинусное расстояние
+        """
+        if face is None or face.size == 0:
+            return False, float('inf')
+            
+        templates = self._user_templates(user_id)
+        if len(templates) == 0:
+            return False, float('inf')
+            
+        query = SearchIndex._normalize(self._embed([face])[0])
+        distance = max(float(1.0 - np.max(templates @ query)), 0.0)
+        return distance <= self.DISTANCE_THRESHOLD, distance
+        
+    def recognize_batch(self, faces: List[np.ndarray]) -> Tuple[List[Tuple[Optional[str], float]], float]:
+        """
+        Распознает пачку лиц одним матричным запросом.
+        Возвращает результаты в порядке входных лиц и общее время обработки
+        """
+        start_time = time.time()
+        results = [(None, float('inf'))] * len(faces)
+        
+        valid = [i for i, face in enumerate(faces) if face is not None and face.size > 0]
+        if valid:
+            queries = self._embed([faces[i] for i in valid])
+            for i, (user_id, distance) in zip(valid, self.index.find_nearest_batch(queries)):
+                if distance <= self.DISTANCE_THRESHOLD:
+                    results[i] = (user_id, distance)
+                    
+        return results, time.time() - start_time
+        
     def save_state(self) -> None:
         """Сохраняет состояние процессора"""
-        self.kd_tree.save('kd_tree.pkl')
+        if isinstance(self.index, KDTree):
+            self.index.save(self.index_path, db_rows=self._index_rows())
+        else:
+            self.index.save(self.index_path)
+        if self._use_embeddings():
+            self.embedder.save('embedder.npz')
         
     def load_state(self) -> None:
         """Загружает состояние процессора"""
-        self.kd_tree.load('kd_tree.pkl') 
\ No newline at end of file
+        if os.path.exists('embedder.npz'):
+            self.embedder = self.embedder or FaceEmbedder()
+            self.embedder.load('embedder.npz')
+        if isinstance(self.index, KDTree):
+            self.index.load(self.index_path, expected_rows=self._index_rows())
+        else:
+            self.index.load(self.index_path) 
\ No newline at end of file
@@ -0,0 +1,98 @@
+import os
+import time
+import logging
+import numpy as np
+import pandas as pd
+from typing import List, Dict
+from app.attribute_pipeline import UNKNOWN_GENDER
+from app.enhanced_algorithm import EnhancedBiometricSearch
+from app.kd_tree_benchmark import generate_embeddings
+
+
+def benchmark_partitioned_search(database_sizes: List[int] = [1000, 10000, 100000],
+                                 num_queries: int = 200,
+                                 dimension: int = 128,
+                                 k: int = 5,
+                                 min_confidence: float = 0.9,
+                                 age_noise: float = 4.0,
+                                 unknown_fraction: float = 0.02) -> pd.DataFrame:
+    """
+    Сравнение поиска по подындексам (пол x возрастная группа) с поиском по
+    одному дереву: ускорение и потеря полноты относительно результатов
+    одного дерева. Атрибуты запроса — зашумленные атрибуты исходного лица,
+    как при независимой оценке DeepFace: пол ошибается с вероятностью
+    1 - уверенность, возраст отклоняется на age_noise лет
+    """
+    rng = np.random.default_rng(42)
+    results = []
+
+    for database_size in database_sizes:
+        print(f"\nТестирование базы данных размером {database_size} лиц...")
+        gallery, _ = generate_embeddings(database_size, dimension, 0, rng)
+        paths = [f"face_{i}.jpg" for i in range(database_size)]
+
+        search = EnhancedBiometricSearch()
+        search.build_index(gallery.astype(np.float64), paths)
+        search.genders = rng.integers(0, 2, database_size).astype(np.int8)
+        search.gender_confidences = rng.uniform(0.6, 1.0, database_size).astype(np.float32)
+        search.ages = rng.uniform(18, 75, database_size).astype(np.float32)
+        unknown = rng.random(database_size) < unknown_fraction
+        search.genders[unknown] = UNKNOWN_GENDER
+        search.ages[unknown] = np.nan
+        start_time = time.time()
+        search.build_partitions()
+        partition_build_time = time.time() - start_time
+
+        sources = rng.integers(0, database_size, num_queries)
+        queries = gallery[sources] + 0.05 * rng.normal(size=(num_queries, dimension))
+        attributes = []
+        for source in sources:
+            confidence = float(rng.uniform(0.6, 1.0))
+            gender = int(search.genders[source])
+            if gender != UNKNOWN_GENDER and rng.random() > confidence:
+                gender = 1 - gender
+            age = float(search.ages[source] + rng.normal(0, age_noise))
+            attributes.append((gender, confidence, age))
+
+        single_times, partitioned_times = [], []
+        recall_at_1, recall_at_k = [], []
+        for query, query_attributes in zip(queries, attributes):
+            start_time = time.time()
+            truth, _, _ = search.search(query, None, k, query_attributes=query_attributes)
+            single_times.append(time.time() - start_time)
+
+            start_time = time.time()
+            found, _, _ = search.search_partitioned(query, None, k, min_confidence=min_confidence,
+                                                    query_attributes=query_attributes)
+            partitioned_times.append(time.time() - start_time)
+
+            recall_at_1.append(found[0] == truth[0])
+            recall_at_k.append(len(set(found) & set(truth)) / len(truth))
+
+        result = {
+            'database_size': database_size,
+            'num_partitions': len(search.partitions),
+            'partition_build_time': partition_build_time,
+            'single_tree_time': np.mean(single_times),
+            'partitioned_time': np.mean(partitioned_times),
+            'speedup': np.mean(single_times) / np.mean(partitioned_times),
+            'recall_at_1': np.mean(recall_at_1),
+            f'recall_at_{k}': np.mean(recall_at_k),
+            'confident_fraction': np.mean([c >= min_confidence for _, c, _ in attributes])
+        }
+        results.append(result)
+        print(f"Одно дерево: {result['single_tree_time']:.6f} с, "
+              f"подындексы: {result['partitioned_time']:.6f} с "
+              f"(ускорение {result['speedup']:.1f}x)")
+        print(f"recall@1 {result['recall_at_1']:.3f}, recall@{k} {result[f'recall_at_{k}']:.3f} "
+              f"относительно поиска по одному дереву")
+
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    logging.disable(logging.INFO)
+    os.makedirs("results/partitioned", exist_ok=True)
+    results = benchmark_partitioned_search()
+    results.to_csv("results/partitioned/speedup_recall.csv", index=False)
+    print("\nРезультаты сохранены в results/partitioned/speedup_recall.csv")
@@ -0,0 +1,316 @@
+import numpy as np
+from typing import List, Tuple, Optional, Iterable
+import threading
+from app.ivf_index import kmeans
+from app.search_index import SearchIndex
+
+# Версия формата файла, в который сохраняется PQ-индекс
+PQ_INDEX_FORMAT_VERSION = 1
+
+
+class ProductQuantizer:
+    """
+    Продуктовое квантование векторов.
+
+    Вектор размерности D делится на num_subspaces подвекторов, каждый из
+    которых заменяется номером ближайшего центроида своего словаря из
+    num_centroids слов. При num_centroids <= 256 код занимает num_subspaces
+    байт на лицо. Расстояние от запроса до кода считается асимметрично:
+    для запроса один раз строится таблица расстояний до всех слов, а
+    расстояние до лица — сумма num_subspaces элементов этой таблицы.
+    """
+
+    def __init__(self, num_subspaces: int = 16, num_centroids: int = 256,
+                 kmeans_iters: int = 15, train_size: int = 65536, seed: int = 0):
+        if num_centroids > 256:
+            raise ValueError("Коды хранятся в uint8: num_centroids не больше 256")
+        self.num_subspaces = num_subspaces
+        self.num_centroids = num_centroids
+        self.kmeans_iters = kmeans_iters
+        self.train_size = train_size
+        self.seed = seed
+        # Словари (num_subspaces, num_centroids, D / num_subspaces)
+        self.codebooks: Optional[np.ndarray] = None
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.codebooks is not None
+
+    @property
+    def code_size(self) -> int:
+        """Размер кода одного лица в байтах"""
+        return self.num_subspaces
+
+    @property
+    def nbytes(self) -> int:
+        """Память, занятая словарями"""
+        return self.codebooks.nbytes if self.is_fitted else 0
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        """Представляет матрицу (N, D) как (num_subspaces, N, D / num_subspaces)"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n, dimension = vectors.shape
+        if dimension % self.num_subspaces:
+            raise ValueError(f"Размерность {dimension} не делится на "
+                             f"число подпространств {self.num_subspaces}")
+        return vectors.reshape(n, self.num_subspaces, -1).transpose(1, 0, 2)
+
+    def fit(self, vectors: np.ndarray) -> 'ProductQuantizer':
+        """Обучает словари k-means в каждом подпространстве"""
+        rng = np.random.default_rng(self.seed)
+        if len(vectors) > self.train_size:
+            vectors = vectors[rng.choice(len(vectors), self.train_size, replace=False)]
+        subvectors = self._split(vectors)
+        if len(vectors) < self.num_centroids:
+            raise ValueError(f"Для обучения нужно не меньше {self.num_centroids} векторов")
+
+        self.codebooks = np.stack([
+            kmeans(np.ascontiguousarray(part), self.num_centroids, self.kmeans_iters, rng)
+            for part in subvectors
+        ])
+        return self
+
+    def encode(self, vectors: np.ndarray, block_size: int = 8192) -> np.ndarray:
+        """Кодирует векторы (N, D) в коды (N, num_subspaces) uint8"""
+        if not self.is_fitted:
+            raise RuntimeError("Словари продуктового квантования не обучены")
+        vectors = np.reshape(vectors, (len(vectors), -1))
+        codes = np.empty((len(vectors), self.num_subspaces), dtype=np.uint8)
+        codebook_sq_norms = np.einsum('mkd,mkd->mk', self.codebooks, self.codebooks)
+
+        for start in range(0, len(vectors), block_size):
+            subvectors = self._split(vectors[start:start + block_size])
+            # ||x - c||^2 без ||x||^2, который не влияет на argmin
+            scores = codebook_sq_norms[:, None, :] - 2.0 * np.matmul(
+                subvectors, self.codebooks.transpose(0, 2, 1))
+            codes[start:start + block_size] = np.argmin(scores, axis=2).T
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        """Восстанавливает приближенные векторы (N, D) по кодам"""
+        parts = self.codebooks[np.arange(self.num_subspaces), codes.astype(np.int64)]
+        return parts.reshape(len(codes), -1)
+
+    def distance_table(self, query: np.ndarray) -> np.ndarray:
+        """Таблица (num_subspaces, num_centroids) квадратов расстояний от запроса до слов"""
+        subvectors = self._split(np.ravel(query)[None, :])[:, 0, :]
+        diff = self.codebooks - subvectors[:, None, :]
+        return np.einsum('mkd,mkd->mk', diff, diff)
+
+    def adc(self, table: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """Асимметричные квадраты расстояний от запроса до закодированных лиц"""
+        # Плоская таблица и смещения подпространств: одна выборка по индексам
+        offsets = np.arange(self.num_subspaces) * self.num_centroids
+        return table.ravel()[codes.astype(np.intp) + offsets].sum(axis=1)
+
+    def save(self, filepath: str) -> None:
+        """Сохраняет словари в файл .npz"""
+        # Через открытый файл: иначе np.savez допишет к пути расширение .npz
+        with open(filepath, 'wb') as f:
+            np.savez(f, codebooks=self.codebooks)
+
+    def load(self, filepath: str) -> None:
+        """Загружает словари из файла .npz"""
+        with np.load(filepath) as data:
+            self.codebooks = data['codebooks']
+        self.num_subspaces, self.num_centroids = self.codebooks.shape[:2]
+
+
+class PQIndex(SearchIndex):
+    """
+    Индекс на продуктово-квантованных кодах: в памяти хранятся только
+    коды по code_size байт на лицо и словари, поиск — полный просмотр
+    кодов с асимметричным расстоянием. Результаты приближенные.
+
+    Пока словари не обучены, добавленные лица хранятся как есть и
+    просматриваются точно; набрав train_threshold лиц, индекс обучает
+    словари на них и переводит их в коды.
+    """
+
+    def __init__(self, quantizer: Optional[ProductQuantizer] = None,
+                 train_threshold: int = 1024):
+        self.quantizer = quantizer or ProductQuantizer()
+        self.train_threshold = max(train_threshold, self.quantizer.num_centroids)
+        self._lock = threading.RLock()
+        self.clear()
+
+    @property
+    def size(self) -> int:
+        return self._num_alive + len(self._pending_ids)
+
+    @property
+    def nbytes(self) -> int:
+        pending = sum(points.nbytes for points in self._pending_points)
+        return self._codes[:self._count].nbytes + self.quantizer.nbytes + pending
+
+    def clear(self) -> None:
+        with self._lock:
+            self.dimension = 0
+            self._codes = np.empty((0, self.quantizer.code_size), dtype=np.uint8)
+            self._user_ids: List[str] = []
+            self._alive = np.empty(0, dtype=bool)
+            self._count = 0
+            self._num_alive = 0
+            # Лица, добавленные до обучения словарей
+            self._pending_points: List[np.ndarray] = []
+            self._pending_ids: List[str] = []
+
+    def build_from_matrix(self, vectors: np.ndarray, user_ids: List[str]) -> None:
+        """
+        Строит индекс. Если словари не обучены, векторы откладываются, как
+        при insert_batch, и словари обучаются на них, когда векторов
+        не меньше train_threshold
+        """
+        if len(vectors) == 0:
+            return
+
+        points = self._normalize(np.reshape(vectors, (len(vectors), -1)))
+        if self.quantizer.is_fitted:
+            self.build_from_codes(self.quantizer.encode(points), user_ids)
+            return
+
+        with self._lock:
+            self.clear()
+            self._pending_points = [points]
+            self._pending_ids = list(user_ids)
+            self.dimension = points.shape[1]
+            if len(self._pending_ids) >= self.train_threshold:
+                self._encode_pending()
+
+    def build_from_codes(self, codes: np.ndarray, user_ids: List[str]) -> None:
+        """Строит индекс из готовых кодов, например прочитанных из базы данных"""
+        with self._lock:
+            self.clear()
+            self._append(codes, user_ids)
+
+    def build_from_code_chunks(self, chunks: Iterable[Tuple[List[str], np.ndarray]],
+                               size: int) -> None:
+        """Строит индекс из потока чанков (id, коды), например из BiometricDatabase.iter_pq_codes"""
+        with self._lock:
+            self.clear()
+            for chunk_ids, codes in chunks:
+                self._append(codes, chunk_ids, reserve=size)
+
+    def _append(self, codes: np.ndarray, user_ids: List[str], reserve: int = 0) -> None:
+        """Дописывает коды, увеличивая массив удвоением"""
+        needed = self._count + len(codes)
+        if needed > len(self._codes):
+            grown = np.empty((max(64, reserve, 2 * self._count, needed), codes.shape[1]),
+                             dtype=np.uint8)
+            if self._count:
+                grown[:self._count] = self._codes[:self._count]
+            self._codes = grown
+            alive = np.zeros(len(grown), dtype=bool)
+            alive[:self._count] = self._alive[:self._count]
+            self._alive = alive
+
+        self._codes[self._count:needed] = codes
+        self._alive[self._count:needed] = True
+        self._user_ids.extend(user_ids)
+        self._count = needed
+        self._num_alive += len(codes)
+        self.dimension = self.quantizer.codebooks.shape[0] * self.quantizer.codebooks.shape[2]
+
+    def insert_batch(self, vectors: np.ndarray, user_ids: List[str]) -> None:
+        """Добавляет пачку лиц: кодирует их или, до обучения словарей, откладывает"""
+        if len(vectors) == 0:
+            return
+        points = self._normalize(np.reshape(vectors, (len(vectors), -1)))
+        with self._lock:
+            if self.quantizer.is_fitted:
+                self._append(self.quantizer.encode(points), user_ids)
+                return
+
+            self._pending_points.append(points)
+            self._pending_ids.extend(user_ids)
+            self.dimension = points.shape[1]
+            if len(self._pending_ids) >= self.train_threshold:
+                self._encode_pending()
+
+    def _encode_pending(self) -> None:
+        """Обучает словари на отложенных лицах и переводит их в коды"""
+        points = np.concatenate(self._pending_points)
+        if not self.quantizer.is_fitted:
+            self.quantizer.fit(points)
+        self._append(self.quantizer.encode(points), self._pending_ids)
+        self._pending_points, self._pending_ids = [], []
+
+    def remove(self, user_id: str) -> int:
+        with self._lock:
+            hits = [i for i, uid in enumerate(self._user_ids) if uid == user_id and self._alive[i]]
+            self._alive[hits] = False
+            self._num_alive -= len(hits)
+
+            keep = [uid != user_id for uid in self._pending_ids]
+            if not all(keep):
+                self._pending_points = [np.concatenate(self._pending_points)[keep]]
+                self._pending_ids = [uid for uid in self._pending_ids if uid != user_id]
+            return len(hits) + len(keep) - len(self._pending_ids)
+
+    def query_knn(self, target: np.ndarray, k: int = 5) -> List[Tuple[str, float]]:
+        query = self._normalize(np.ravel(target))
+        with self._lock:
+            if self.size == 0 or k <= 0:
+                return []
+            dists = np.empty(0, dtype=np.float32)
+            if self._count:
+                dists = self.quantizer.adc(self.quantizer.distance_table(query),
+                                           self._codes[:self._count])
+                dists[~self._alive[:self._count]] = np.inf
+            ids = self._user_ids
+            if self._pending_ids:
+                # Отложенные лица просматриваются точно
+                pending = np.concatenate(self._pending_points)
+                dists = np.concatenate((dists, np.maximum(2.0 - 2.0 * (pending @ query), 0.0)))
+                ids = self._user_ids[:self._count] + self._pending_ids
+
+            k = min(k, self.size)
+            top = np.argpartition(dists, k - 1)[:k]
+            top = top[np.argsort(dists[top])]
+            return [(ids[i], float(np.sqrt(max(dists[i], 0.0)))) for i in top]
+
+    def save(self, filepath: str) -> None:
+        """
+        Сохраняет словари, коды и отложенные лица в файл .npz. Отложенные
+        лица кодируются, только если их хватает для обучения словарей,
+        иначе сохраняются как есть
+        """
+        with self._lock:
+            if len(self._pending_ids) >= self.quantizer.num_centroids:
+                self._encode_pending()
+            alive = self._alive[:self._count]
+            fitted = self.quantizer.is_fitted
+            pending = np.concatenate(self._pending_points) if self._pending_ids \
+                else np.empty((0, self.dimension), dtype=np.float32)
+            with open(filepath, 'wb') as f:
+                np.savez(f, version=PQ_INDEX_FORMAT_VERSION,
+                         codebooks=self.quantizer.codebooks if fitted
+                         else np.empty((0, 0, 0), dtype=np.float32),
+                         codes=self._codes[:self._count][alive],
+                         user_ids=np.array(self._user_ids, dtype=str)[alive],
+                         pending_points=pending,
+                         pending_ids=np.array(self._pending_ids, dtype=str))
+
+    def load(self, filepath: str) -> None:
+        """Загружает словари, коды и отложенные лица из файла .npz"""
+        with np.load(filepath) as data:
+            if int(data['version']) != PQ_INDEX_FORMAT_VERSION:
+                raise ValueError(f"Неподдерживаемый формат файла PQ-индекса: {filepath}")
+            codebooks = data['codebooks']
+            codes, user_ids = data['codes'], data['user_ids'].tolist()
+            # В файлах, записанных до появления отложенных лиц, этих массивов нет
+            pending_points = data['pending_points'] if 'pending_points' in data.files else None
+            pending_ids = data['pending_ids'].tolist() if 'pending_ids' in data.files else []
+
+        with self._lock:
+            if codebooks.size:
+                self.quantizer.codebooks = codebooks
+                self.quantizer.num_subspaces, self.quantizer.num_centroids = codebooks.shape[:2]
+                self.build_from_codes(codes, user_ids)
+            else:
+                self.quantizer.codebooks = None
+                self.clear()
+            if pending_ids:
+                self._pending_points = [pending_points.astype(np.float32, copy=False)]
+                self._pending_ids = pending_ids
+                self.dimension = pending_points.shape[1]
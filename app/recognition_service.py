@@ -0,0 +1,298 @@
+import asyncio
+import argparse
+import base64
+import json
+import logging
+import os
+import threading
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Any
+from app.database import BiometricDatabase
+from app.optimized_face_processor import OptimizedFaceProcessor
+
+# Ограничение размера тела запроса
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+                405: 'Method Not Allowed', 413: 'Payload Too Large',
+                500: 'Internal Server Error'}
+
+
+class RequestError(Exception):
+    """Ошибка в запросе клиента, возвращается ему с кодом status"""
+
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class RecognitionService:
+    """
+    Сервис распознавания без графического интерфейса.
+
+    Процессор (и его индекс) создается один раз при запуске. Декодирование,
+    детекция и поиск выполняются в пуле потоков, не блокируя цикл событий.
+    Одновременные запросы identify собираются в пачку: первая заявка ждет
+    не дольше max_batch_delay, пока не наберется max_batch_size заявок,
+    после чего пачка уходит в индекс одним матричным запросом.
+    """
+
+    def __init__(self, processor: OptimizedFaceProcessor, max_batch_size: int = 64,
+                 max_batch_delay: float = 0.002, num_workers: Optional[int] = None):
+        self.processor = processor
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self._local = threading.local()
+        self._queue: Optional[asyncio.Queue] = None
+        self._batcher: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.batched_requests = 0
+        self.logger = logging.getLogger(__name__)
+
+    async def start(self) -> None:
+        """Запускает сборщик пачек в текущем цикле событий"""
+        self._queue = asyncio.Queue()
+        self._batcher = asyncio.get_running_loop().create_task(self._batch_loop())
+
+    async def stop(self) -> None:
+        if self._batcher is not None:
+            self._batcher.cancel()
+            try:
+                await self._batcher
+            except asyncio.CancelledError:
+                pass
+            self._batcher = None
+        self.executor.shutdown(wait=True)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _decode_face(self, payload: Dict[str, Any], key: str = 'image') -> np.ndarray:
+        """
+        Лицо из base64-изображения в запросе. При cropped=true изображение
+        считается уже вырезанным лицом, иначе лицо ищется каскадом
+        """
+        try:
+            data = base64.b64decode(payload[key], validate=True)
+        except (KeyError, TypeError, ValueError):
+            raise RequestError(f"Поле {key} должно содержать изображение в base64")
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise RequestError("Не удалось декодировать изображение")
+
+        if payload.get('cropped'):
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            return cv2.resize(gray, (100, 100)).astype(np.float32) / 255.0
+        # Классификатор не потокобезопасен: у каждого потока пула свой
+        if not hasattr(self._local, 'cascade'):
+            self._local.cascade = cv2.CascadeClassifier(self.processor.cascade_path)
+        face = self.processor.detect_face(image, self._local.cascade)
+        if face is None:
+            raise RequestError("Лицо не обнаружено")
+        return face
+
+    @staticmethod
+    def _user_id(payload: Dict[str, Any]) -> str:
+        user_id = payload.get('user_id')
+        if not isinstance(user_id, str) or not user_id:
+            raise RequestError("Поле user_id должно быть непустой строкой")
+        return user_id
+
+    @staticmethod
+    def _match(user_id: Optional[str], distance: float) -> Dict[str, Any]:
+        return {'user_id': user_id, 'distance': distance if user_id is not None else None}
+
+    async def _batch_loop(self) -> None:
+        """Собирает заявки identify в пачки и распознает их одним запросом к индексу"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_batch_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            faces = [face for face, _ in batch]
+            try:
+                results, _ = await self._run(self.processor.recognize_batch, faces)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batches += 1
+            self.batched_requests += len(batch)
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def enroll(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        user_id = self._user_id(payload)
+        face = await self._run(self._decode_face, payload)
+        added = await self._run(self.processor.add_face, face, user_id)
+        return {'user_id': user_id, 'enrolled': bool(added)}
+
+    async def identify(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        face = await self._run(self._decode_face, payload)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((face, future))
+        return self._match(*await future)
+
+    async def identify_batch(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        images = payload.get('images')
+        if not isinstance(images, list):
+            raise RequestError("Поле images должно быть списком изображений в base64")
+        faces = await asyncio.gather(*(self._run(self._decode_face,
+                                                 {'image': image, 'cropped': payload.get('cropped')})
+                                       for image in images))
+        results, _ = await self._run(self.processor.recognize_batch, list(faces))
+        return {'results': [self._match(*result) for result in results]}
+
+    async def verify(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        user_id = self._user_id(payload)
+        face = await self._run(self._decode_face, payload)
+        match, distance = await self._run(self.processor.verify, face, user_id)
+        # У незарегистрированного пользователя шаблонов нет — расстояние не определено
+        return {'user_id': user_id, 'match': match,
+                'distance': distance if np.isfinite(distance) else None}
+
+    async def health(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'faces': self.processor.index.size,
+            'batches': self.batches,
+            'average_batch_size': self.batched_requests / self.batches if self.batches else 0.0
+        }
+
+    async def handle(self, method: str, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Передает запрос обработчику по пути"""
+        routes = {
+            ('POST', '/enroll'): self.enroll,
+            ('POST', '/identify'): self.identify,
+            ('POST', '/identify_batch'): self.identify_batch,
+            ('POST', '/verify'): self.verify,
+            ('GET', '/health'): self.health
+        }
+        handler = routes.get((method, path))
+        if handler is None:
+            if any(route_path == path for _, route_path in routes):
+                raise RequestError(f"Метод {method} не поддерживается для {path}", 405)
+            raise RequestError(f"Неизвестный путь {path}", 404)
+        return await handler(payload)
+
+    async def handle_connection(self, reader: asyncio.StreamReader,
+                                writer: asyncio.StreamWriter) -> None:
+        """Минимальный HTTP/1.1 с JSON в теле и поддержкой keep-alive"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                try:
+                    method, path, _ = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self._respond(writer, 400, {'error': "Некорректная строка запроса"}, False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get('connection', '').lower() != 'close'
+
+                status, response = 200, None
+                try:
+                    try:
+                        length = int(headers.get('content-length', 0))
+                    except ValueError:
+                        length = -1
+                    if length < 0:
+                        # Без длины тела границу следующего запроса не найти
+                        keep_alive = False
+                        raise RequestError("Некорректный заголовок Content-Length")
+                    if length > MAX_BODY_SIZE:
+                        keep_alive = False
+                        raise RequestError("Слишком большой запрос", 413)
+                    body = await reader.readexactly(length) if length else b''
+                    try:
+                        payload = json.loads(body) if body else {}
+                    except ValueError:
+                        raise RequestError("Тело запроса должно быть JSON")
+                    if not isinstance(payload, dict):
+                        raise RequestError("Тело запроса должно быть JSON-объектом")
+                    response = await self.handle(method, path.split('?')[0], payload)
+                except RequestError as e:
+                    status, response = e.status, {'error': str(e)}
+                except Exception as e:
+                    self.logger.exception(f"Ошибка обработки {method} {path}")
+                    status, response = 500, {'error': str(e)}
+
+                await self._respond(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int,
+                       payload: Dict[str, Any], keep_alive: bool) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        head = (f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+                f"Content-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+
+async def serve(service: RecognitionService, host: str = '127.0.0.1', port: int = 8080,
+                unix_socket: Optional[str] = None) -> None:
+    """Запускает сервис на TCP-порту или Unix-сокете и обслуживает запросы до отмены"""
+    await service.start()
+    if unix_socket:
+        server = await asyncio.start_unix_server(service.handle_connection, path=unix_socket)
+        address = unix_socket
+    else:
+        server = await asyncio.start_server(service.handle_connection, host, port)
+        address = f"http://{host}:{port}"
+    service.logger.info(f"Сервис распознавания слушает {address}, "
+                        f"в индексе {service.processor.index.size} лиц")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+        if unix_socket and os.path.exists(unix_socket):
+            os.remove(unix_socket)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сервис распознавания лиц")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix-socket', help="путь Unix-сокета вместо TCP")
+    parser.add_argument('--sqlite', help="файл базы SQLite вместо PostgreSQL")
+    parser.add_argument('--max-batch-size', type=int, default=64)
+    parser.add_argument('--max-batch-delay', type=float, default=0.002,
+                        help="сколько ждать заявки identify для пачки, с")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db = BiometricDatabase(args.sqlite, backend='sqlite') if args.sqlite else None
+    service = RecognitionService(OptimizedFaceProcessor(db=db), args.max_batch_size,
+                                 args.max_batch_delay)
+    try:
+        asyncio.run(serve(service, args.host, args.port, args.unix_socket))
+    except KeyboardInterrupt:
+        pass
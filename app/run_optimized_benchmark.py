@@ -20,6 +20,11 @@ def main():
     benchmark.plot_results(results, 'results/optimized_benchmark_results.png')
     benchmark.create_animation('results/optimized_benchmark_animation.gif')
     
+    # Сравниваем пакетное распознавание с поочередным
+    batch_results = benchmark.run_batch_benchmark(1000, [1, 4, 16, 64, 256], 10)
+    benchmark.save_results(batch_results, 'results/optimized_batch_benchmark_results.csv')
+    benchmark.plot_batch_results(batch_results, 'results/optimized_batch_benchmark_results.png')
+    
     print("Тестирование завершено. Результаты сохранены в директории 'results'")
 
 if __name__ == "__main__":
@@ -0,0 +1,198 @@
+import numpy as np
+from typing import List, Tuple, Optional, Iterable
+import threading
+from app.database import collect_chunks
+
+
+class SearchIndex:
+    """
+    Общий интерфейс индексов поиска лиц.
+
+    Индекс хранит векторы, нормированные по L2, поэтому евклидово расстояние
+    между ними эквивалентно косинусному: ||a - b||^2 = 2 * (1 - cos(a, b)).
+    query_knn возвращает евклидовы расстояния, find_nearest — косинусное.
+    Наследники реализуют build_from_matrix, insert_batch, remove, clear,
+    query_knn, save и load; остальные методы выражены через них.
+    """
+
+    dimension = 0
+
+    @property
+    def size(self) -> int:
+        """Количество лиц в индексе"""
+        raise NotImplementedError
+
+    @property
+    def nbytes(self) -> int:
+        """Память, занятая векторами и служебными массивами индекса"""
+        raise NotImplementedError
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        """Приводит векторы к float32 и единичной L2-норме"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    def build(self, faces: List[Tuple[np.ndarray, str]]) -> None:
+        """Строит индекс из списка пар (лицо, id)"""
+        if not faces:
+            return
+        self.build_from_matrix(np.stack([np.ravel(face) for face, _ in faces]),
+                               [user_id for _, user_id in faces])
+
+    def build_from_matrix(self, vectors: np.ndarray, user_ids: List[str]) -> None:
+        """Строит индекс из матрицы векторов (N, D) и списка id"""
+        raise NotImplementedError
+
+    def build_from_chunks(self, chunks: Iterable[Tuple[List[str], np.ndarray]],
+                          size: int) -> None:
+        """Строит индекс из потока чанков (id, матрица), например из BiometricDatabase.iter_faces"""
+        user_ids, vectors = collect_chunks(chunks, size)
+        if len(vectors) == 0:
+            return
+        self.build_from_matrix(vectors, user_ids)
+
+    def clear(self) -> None:
+        """Удаляет все лица из индекса"""
+        raise NotImplementedError
+
+    def insert(self, face: np.ndarray, user_id: str) -> None:
+        """Добавляет одно лицо"""
+        self.insert_batch(np.ravel(face)[None, :], [user_id])
+
+    def insert_batch(self, vectors: np.ndarray, user_ids: List[str]) -> None:
+        """Добавляет пачку лиц (N, D)"""
+        raise NotImplementedError
+
+    def remove(self, user_id: str) -> int:
+        """Удаляет все лица пользователя, возвращает количество удаленных"""
+        raise NotImplementedError
+
+    def query_knn(self, target: np.ndarray, k: int = 5) -> List[Tuple[str, float]]:
+        """Находит k ближайших лиц, возвращает пары (id, евклидово расстояние)"""
+        raise NotImplementedError
+
+    def query_knn_batch(self, targets: np.ndarray, k: int = 5) -> List[List[Tuple[str, float]]]:
+        """Выполняет query_knn для пачки запросов"""
+        return [self.query_knn(target, k) for target in np.reshape(targets, (len(targets), -1))]
+
+    def find_nearest(self, target: np.ndarray) -> Tuple[Optional[str], float]:
+        """Находит ближайшее лицо, возвращает id и косинусное расстояние"""
+        found = self.query_knn(target, 1)
+        if not found:
+            return None, float('inf')
+        user_id, dist = found[0]
+        return user_id, dist * dist / 2.0
+
+    def find_nearest_batch(self, targets: np.ndarray) -> List[Tuple[Optional[str], float]]:
+        """Выполняет find_nearest для пачки запросов"""
+        return [(found[0][0], found[0][1] ** 2 / 2.0) if found else (None, float('inf'))
+                for found in self.query_knn_batch(targets, 1)]
+
+    def save(self, filepath: str) -> None:
+        """Сохраняет индекс в файл"""
+        raise NotImplementedError
+
+    def load(self, filepath: str) -> None:
+        """Загружает индекс из файла"""
+        raise NotImplementedError
+
+
+class FlatIndex(SearchIndex):
+    """Точный индекс полным перебором: одна матрица и одно умножение на запрос"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.clear()
+
+    @property
+    def size(self) -> int:
+        return int(self._alive[:self._count].sum())
+
+    @property
+    def nbytes(self) -> int:
+        return self._points[:self._count].nbytes + self._alive[:self._count].nbytes
+
+    def clear(self) -> None:
+        with self._lock:
+            self.dimension = 0
+            self._points = np.empty((0, 0), dtype=np.float32)
+            self._user_ids: List[str] = []
+            self._alive = np.empty(0, dtype=bool)
+            self._count = 0
+
+    def build_from_matrix(self, vectors: np.ndarray, user_ids: List[str]) -> None:
+        with self._lock:
+            self.clear()
+            self.insert_batch(vectors, user_ids)
+
+    def insert_batch(self, vectors: np.ndarray, user_ids: List[str]) -> None:
+        vectors = self._normalize(np.reshape(vectors, (len(vectors), -1)))
+        if len(vectors) == 0:
+            return
+
+        with self._lock:
+            if self.dimension == 0:
+                self.dimension = vectors.shape[1]
+            elif vectors.shape[1] != self.dimension:
+                raise ValueError(f"Размерность лица {vectors.shape[1]} не совпадает "
+                                 f"с размерностью индекса {self.dimension}")
+
+            # Матрица растет удвоением, чтобы вставка была амортизированно O(1)
+            needed = self._count + len(vectors)
+            if needed > len(self._points):
+                grown = np.empty((max(64, 2 * self._count, needed), self.dimension),
+                                 dtype=np.float32)
+                if self._count:
+                    grown[:self._count] = self._points[:self._count]
+                self._points = grown
+                alive = np.zeros(len(grown), dtype=bool)
+                alive[:self._count] = self._alive[:self._count]
+                self._alive = alive
+
+            self._points[self._count:needed] = vectors
+            self._alive[self._count:needed] = True
+            self._user_ids.extend(user_ids)
+            self._count = needed
+
+    def remove(self, user_id: str) -> int:
+        with self._lock:
+            hits = [i for i, uid in enumerate(self._user_ids) if uid == user_id and self._alive[i]]
+            self._alive[hits] = False
+            return len(hits)
+
+    def _query_knn_batch(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Квадраты расстояний и позиции k ближайших для пачки запросов"""
+        dists = np.maximum(2.0 - 2.0 * (queries @ self._points[:self._count].T), 0.0)
+        dists[:, ~self._alive[:self._count]] = np.inf
+        top = np.argpartition(dists, k - 1, axis=1)[:, :k]
+        top_dists = np.take_along_axis(dists, top, axis=1)
+        order = np.argsort(top_dists, axis=1)
+        return np.take_along_axis(top_dists, order, axis=1), np.take_along_axis(top, order, axis=1)
+
+    def query_knn(self, target: np.ndarray, k: int = 5) -> List[Tuple[str, float]]:
+        return self.query_knn_batch(np.ravel(target)[None, :], k)[0]
+
+    def query_knn_batch(self, targets: np.ndarray, k: int = 5) -> List[List[Tuple[str, float]]]:
+        queries = self._normalize(np.reshape(targets, (len(targets), -1)))
+        with self._lock:
+            if self.size == 0 or k <= 0:
+                return [[] for _ in range(len(queries))]
+            dists, positions = self._query_knn_batch(queries, min(k, self._count))
+            return [[(self._user_ids[pos], float(np.sqrt(dist)))
+                     for dist, pos in zip(row_dists, row_pos) if np.isfinite(dist)]
+                    for row_dists, row_pos in zip(dists, positions)]
+
+    def save(self, filepath: str) -> None:
+        with self._lock:
+            alive = self._alive[:self._count]
+            # Через открытый файл: иначе np.savez допишет к пути расширение .npz
+            with open(filepath, 'wb') as f:
+                np.savez(f, points=self._points[:self._count][alive],
+                         user_ids=np.array(self._user_ids, dtype=str)[alive])
+
+    def load(self, filepath: str) -> None:
+        with np.load(filepath) as data:
+            self.build_from_matrix(data['points'], data['user_ids'].tolist())
@@ -0,0 +1,141 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+from typing import List, Dict, Callable, Optional
+from app.enhanced_algorithm import EnhancedBiometricSearch
+from app.ivf_index import IVFIndex
+from app.kd_tree import KDTree
+from app.kd_tree_benchmark import generate_embeddings
+from app.product_quantizer import PQIndex, ProductQuantizer
+from app.search_index import FlatIndex
+
+
+def sklearn_tree_nbytes(tree) -> int:
+    """Память, занятая массивами sklearn KDTree"""
+    return sum(np.asarray(array).nbytes for array in tree.get_arrays())
+
+
+def measure(search: Callable[[np.ndarray], Optional[str]], queries: np.ndarray,
+            truth: List[str], memory_bytes: int, database_size: int) -> Dict:
+    """Среднее время запроса, recall@1 относительно точного ответа и занятая память"""
+    times, answers = [], []
+    for query in queries:
+        start_time = time.time()
+        answers.append(search(query))
+        times.append(time.time() - start_time)
+    return {
+        'avg_query_time': np.mean(times),
+        'recall_at_1': np.mean([a == b for a, b in zip(answers, truth)]),
+        'memory_usage_mb': memory_bytes / 2**20,
+        'bytes_per_face': memory_bytes / database_size
+    }
+
+
+def benchmark_search_indexes(database_size: int = 100000,
+                             num_queries: int = 200,
+                             dimension: int = 128,
+                             nprobes: List[int] = [1, 2, 4, 8, 16, 32, 64],
+                             pq_code_sizes: List[int] = [8, 16, 32]) -> pd.DataFrame:
+    """
+    Сравнение recall@1, времени запроса и памяти IVF-индекса при разных nprobe
+    и PQ-индекса при разных размерах кода с линейным поиском, k-d деревом
+    и улучшенным алгоритмом
+    """
+    rng = np.random.default_rng(42)
+    gallery, queries = generate_embeddings(database_size, dimension, num_queries, rng)
+    gallery /= np.linalg.norm(gallery, axis=1, keepdims=True)
+    user_ids = [f"user_{i}" for i in range(database_size)]
+    results = []
+
+    print(f"\nТестирование базы данных размером {database_size} лиц...")
+
+    # Точный ответ — линейный поиск
+    linear = FlatIndex()
+    linear.build_from_matrix(gallery, user_ids)
+    truth = [user_id for user_id, _ in linear.find_nearest_batch(queries)]
+    results.append({'algorithm': 'linear', 'parameter': np.nan,
+                    **measure(lambda q: linear.find_nearest(q)[0], queries, truth,
+                              linear.nbytes, database_size)})
+
+    kd_tree = KDTree()
+    kd_tree.build_from_matrix(gallery, user_ids)
+    results.append({'algorithm': 'kd_tree', 'parameter': np.nan,
+                    **measure(lambda q: kd_tree.find_nearest(q)[0], queries, truth,
+                              kd_tree.nbytes, database_size)})
+
+    enhanced = EnhancedBiometricSearch()
+    enhanced.build_index(gallery, user_ids)
+    results.append({'algorithm': 'enhanced', 'parameter': np.nan,
+                    **measure(lambda q: user_ids[enhanced.search(q, None, k=1)[0][0]],
+                              queries, truth, sklearn_tree_nbytes(enhanced.tree),
+                              database_size)})
+
+    ivf = IVFIndex()
+    start_time = time.time()
+    ivf.build_from_matrix(gallery, user_ids)
+    print(f"IVF: {len(ivf._centroids)} кластеров, построение {time.time() - start_time:.2f} с")
+    for nprobe in nprobes:
+        ivf.nprobe = nprobe
+        results.append({'algorithm': 'ivf', 'parameter': nprobe,
+                        **measure(lambda q: ivf.find_nearest(q)[0], queries, truth,
+                                  ivf.nbytes, database_size)})
+
+    for code_size in pq_code_sizes:
+        pq = PQIndex(ProductQuantizer(num_subspaces=code_size))
+        start_time = time.time()
+        pq.build_from_matrix(gallery, user_ids)
+        print(f"PQ {code_size} байт: построение {time.time() - start_time:.2f} с")
+        results.append({'algorithm': 'pq', 'parameter': code_size,
+                        **measure(lambda q: pq.find_nearest(q)[0], queries, truth,
+                                  pq.nbytes, database_size)})
+
+    results = pd.DataFrame(results)
+    results['database_size'] = database_size
+    for _, row in results.iterrows():
+        label = row['algorithm'] if np.isnan(row['parameter']) \
+            else f"{row['algorithm']} ({int(row['parameter'])})"
+        print(f"{label}: {row['avg_query_time']:.6f} с, recall@1 {row['recall_at_1']:.3f}, "
+              f"память {row['memory_usage_mb']:.1f} МБ ({row['bytes_per_face']:.0f} байт на лицо)")
+    return results
+
+
+def plot_recall_latency(results: pd.DataFrame, save_path: str) -> None:
+    """Строит кривую recall@1 от времени запроса"""
+    plt.figure(figsize=(12, 8))
+    ax1 = plt.subplot(111)
+
+    for algorithm, label, parameter in [('ivf', 'IVF', 'nprobe'), ('pq', 'PQ', 'байт')]:
+        curve = results[results['algorithm'] == algorithm]
+        ax1.plot(curve['avg_query_time'], curve['recall_at_1'],
+                 marker='o', label=label, linewidth=2, markersize=8)
+        for i, (_, row) in enumerate(curve.iterrows()):
+            # Подписи чередуются сверху и снизу, чтобы не накладываться
+            ax1.annotate(f'{parameter}={int(row["parameter"])}',
+                         (row['avg_query_time'], row['recall_at_1']),
+                         xytext=(5, -18 if i % 2 == 0 else 10), textcoords='offset points')
+
+    for algorithm, marker in [('linear', 's'), ('kd_tree', '^'), ('enhanced', 'D')]:
+        row = results[results['algorithm'] == algorithm]
+        ax1.scatter(row['avg_query_time'], row['recall_at_1'], marker=marker,
+                    s=100, label=algorithm, zorder=3)
+
+    ax1.set_xscale('log')
+    ax1.set_xlabel('Время запроса (секунды)', fontsize=12)
+    ax1.set_ylabel('recall@1', fontsize=12)
+    ax1.set_title(f'Полнота и скорость поиска (база из {results.iloc[0]["database_size"]} лиц)',
+                  fontsize=14, pad=20)
+    ax1.grid(True, linestyle='--', alpha=0.7)
+    ax1.legend(loc='lower right', fontsize=10)
+
+    plt.savefig(save_path, dpi=300, bbox_inches='tight')
+    plt.close()
+
+
+if __name__ == "__main__":
+    os.makedirs("results/search_index", exist_ok=True)
+    results = benchmark_search_indexes()
+    results.to_csv("results/search_index/recall_latency.csv", index=False)
+    plot_recall_latency(results, "results/search_index/recall_latency.png")
+    print("\nРезультаты сохранены в директории results/search_index")
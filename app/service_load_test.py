@@ -0,0 +1,152 @@
+import asyncio
+import argparse
+import base64
+import json
+import time
+import cv2
+import numpy as np
+from typing import List, Dict, Optional, Any
+
+
+class ServiceClient:
+    """Клиент сервиса распознавания на одном keep-alive соединении"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 8080,
+                 unix_socket: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+
+    async def connect(self) -> None:
+        if self.unix_socket:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.unix_socket)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def request(self, method: str, path: str,
+                      payload: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        body = json.dumps(payload or {}).encode('utf-8')
+        self.writer.write(f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+                          f"Content-Type: application/json\r\n"
+                          f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.strip().lower() == 'content-length':
+                length = int(value)
+        response = json.loads(await self.reader.readexactly(length))
+        if status != 200:
+            raise RuntimeError(f"{method} {path}: {status} {response.get('error')}")
+        return response
+
+    async def close(self) -> None:
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+def encode_face(face: np.ndarray) -> str:
+    """Лицо 100x100 в оттенках серого как PNG в base64"""
+    _, data = cv2.imencode('.png', face)
+    return base64.b64encode(data.tobytes()).decode('ascii')
+
+
+def generate_faces(num_faces: int, rng: np.random.Generator) -> np.ndarray:
+    """Синтетические лица: гладкие случайные изображения 100x100"""
+    small = rng.integers(0, 256, (num_faces, 10, 10)).astype(np.uint8)
+    return np.stack([cv2.resize(face, (100, 100), interpolation=cv2.INTER_CUBIC) for face in small])
+
+
+async def run_load_test(host: str = '127.0.0.1', port: int = 8080,
+                        unix_socket: Optional[str] = None, num_users: int = 1000,
+                        concurrency: int = 32, duration: float = 10.0,
+                        endpoint: str = 'identify') -> Dict[str, float]:
+    """
+    Регистрирует num_users синтетических лиц, затем concurrency клиентов
+    в течение duration секунд шлют запросы endpoint (identify или verify)
+    с зашумленными лицами. Возвращает задержки p50/p99 и пропускную способность
+    """
+    rng = np.random.default_rng(42)
+    faces = generate_faces(num_users, rng)
+    user_ids = [f"load_user_{i}" for i in range(num_users)]
+
+    clients = [ServiceClient(host, port, unix_socket) for _ in range(concurrency)]
+    await asyncio.gather(*(client.connect() for client in clients))
+
+    async def enroll(client: ServiceClient, start: int) -> None:
+        for i in range(start, num_users, concurrency):
+            await client.request('POST', '/enroll', {'user_id': user_ids[i], 'cropped': True,
+                                                     'image': encode_face(faces[i])})
+
+    print(f"Регистрация {num_users} лиц...")
+    await asyncio.gather(*(enroll(client, i) for i, client in enumerate(clients)))
+
+    # Запросы готовятся заранее, чтобы клиент не мешал замеру
+    sources = rng.integers(0, num_users, 1000)
+    noise = rng.normal(0, 5, (len(sources), 100, 100))
+    queries = [(user_ids[source],
+                encode_face(np.clip(faces[source] + n, 0, 255).astype(np.uint8)))
+               for source, n in zip(sources, noise)]
+
+    latencies: List[float] = []
+    correct = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker(client: ServiceClient, offset: int) -> None:
+        nonlocal correct
+        i = offset
+        while time.perf_counter() < deadline:
+            user_id, image = queries[i % len(queries)]
+            payload = {'image': image, 'cropped': True}
+            if endpoint == 'verify':
+                payload['user_id'] = user_id
+            start_time = time.perf_counter()
+            response = await client.request('POST', f'/{endpoint}', payload)
+            latencies.append(time.perf_counter() - start_time)
+            correct += response.get('match', response.get('user_id') == user_id)
+            i += concurrency
+
+    print(f"Нагрузка {endpoint}: {concurrency} клиентов, {duration:.0f} с...")
+    start_time = time.perf_counter()
+    await asyncio.gather(*(worker(client, i) for i, client in enumerate(clients)))
+    elapsed = time.perf_counter() - start_time
+
+    health = await clients[0].request('GET', '/health')
+    await asyncio.gather(*(client.close() for client in clients))
+
+    latencies_ms = 1000.0 * np.array(latencies)
+    return {
+        'requests': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'accuracy': correct / len(latencies),
+        'average_batch_size': health['average_batch_size']
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный тест сервиса распознавания")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--unix-socket')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--endpoint', choices=['identify', 'verify'], default='identify')
+    args = parser.parse_args()
+
+    result = asyncio.run(run_load_test(args.host, args.port, args.unix_socket, args.users,
+                                       args.concurrency, args.duration, args.endpoint))
+    print(f"Запросов: {result['requests']}, пропускная способность: "
+          f"{result['throughput']:.1f} запр./с")
+    print(f"Задержка p50: {result['p50_ms']:.1f} мс, p99: {result['p99_ms']:.1f} мс")
+    print(f"Точность: {result['accuracy']:.3f}, средний размер пачки: "
+          f"{result['average_batch_size']:.1f}")
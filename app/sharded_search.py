@@ -0,0 +1,359 @@
+import time
+import threading
+import weakref
+import multiprocessing
+import numpy as np
+from collections import deque
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, Tuple, Dict, Optional
+from app.system_info import available_cores
+from app.search_index import SearchIndex
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+def _top_k(queries: np.ndarray, points: np.ndarray, alive: np.ndarray, k: int,
+           block_size: int = 8192) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Точные k ближайших для пачки нормированных запросов полным перебором
+    по блокам точек. Возвращает матрицы (B, k) квадратов расстояний и
+    позиций, отсортированные по строкам; недостающие места — inf и -1
+    """
+    best_dists = np.full((len(queries), k), np.inf, dtype=np.float32)
+    best_pos = np.full((len(queries), k), -1, dtype=np.int64)
+    for start in range(0, len(points), block_size):
+        block = points[start:start + block_size]
+        dists = np.maximum(2.0 - 2.0 * (queries @ block.T), 0.0)
+        dists[:, ~alive[start:start + block_size]] = np.inf
+        positions = np.broadcast_to(start + np.arange(len(block)), dists.shape)
+
+        all_dists = np.concatenate((best_dists, dists), axis=1)
+        all_pos = np.concatenate((best_pos, positions), axis=1)
+        top = np.argpartition(all_dists, k - 1, axis=1)[:, :k]
+        best_dists = np.take_along_axis(all_dists, top, axis=1)
+        best_pos = np.take_along_axis(all_pos, top, axis=1)
+
+    order = np.argsort(best_dists, axis=1)
+    return (np.take_along_axis(best_dists, order, axis=1),
+            np.take_along_axis(best_pos, order, axis=1))
+
+
+def _shard_arrays(shm: SharedMemory, num_points: int,
+                  dimension: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Матрица точек и маска живых записей шарда поверх общей памяти"""
+    points = np.ndarray((num_points, dimension), dtype=np.float32, buffer=shm.buf)
+    alive = np.ndarray((num_points,), dtype=bool, buffer=shm.buf,
+                       offset=points.nbytes)
+    return points, alive
+
+
+def _shard_worker(conn, shm_name: str, num_points: int, dimension: int) -> None:
+    """Процесс шарда: отвечает на запросы (запросы, k) поиском по своему шарду"""
+    # Шардов столько же, сколько ядер: внутренние потоки BLAS только мешают
+    if threadpool_limits is not None:
+        threadpool_limits(1)
+    shm = SharedMemory(name=shm_name)
+    points, alive = _shard_arrays(shm, num_points, dimension)
+    try:
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            queries, k = request
+            start_time = time.perf_counter()
+            try:
+                dists, positions = _top_k(queries, points, alive, k)
+            except Exception as e:
+                conn.send(e)
+                continue
+            conn.send((dists, positions, time.perf_counter() - start_time))
+    finally:
+        del points, alive
+        shm.close()
+
+
+def _release_shard(conn, process, shm: SharedMemory) -> None:
+    """Останавливает процесс шарда и освобождает его общую память"""
+    try:
+        conn.send(None)
+    except (OSError, ValueError):
+        pass
+    process.join(timeout=5)
+    if process.is_alive():
+        process.terminate()
+        process.join()
+    conn.close()
+    shm.close()
+    shm.unlink()
+
+
+class Shard:
+    """
+    Часть галереи в общей памяти и процесс, который по ней ищет.
+    Векторы и маска живых записей лежат в одном блоке SharedMemory:
+    координатор помечает удаления прямо в нем, процесс видит их сразу.
+    id пользователей хранит только координатор
+    """
+
+    def __init__(self, vectors: np.ndarray, user_ids: List[str], context,
+                 window: int = 1000):
+        num_points, dimension = vectors.shape
+        self.shm = SharedMemory(create=True, size=max(1, vectors.nbytes + num_points))
+        self.points, self.alive = _shard_arrays(self.shm, num_points, dimension)
+        self.points[:] = vectors
+        self.alive[:] = True
+        self.num_alive = num_points
+        self.user_ids = np.array(user_ids, dtype=object)
+
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_shard_worker, daemon=True,
+                                       args=(child_conn, self.shm.name, num_points, dimension))
+        self.process.start()
+        child_conn.close()
+        self._finalizer = weakref.finalize(self, _release_shard, self.conn, self.process, self.shm)
+
+        self.queries = 0
+        self._latencies = deque(maxlen=window)
+
+    def send(self, queries: np.ndarray, k: int) -> None:
+        self.conn.send((queries, k))
+
+    def receive(self) -> Tuple[np.ndarray, np.ndarray]:
+        response = self.conn.recv()
+        if isinstance(response, Exception):
+            raise response
+        dists, positions, elapsed = response
+        self.queries += len(dists)
+        self._latencies.append(elapsed)
+        return dists, positions
+
+    def remove(self, user_id: str) -> int:
+        hits = np.flatnonzero((self.user_ids == user_id) & self.alive)
+        self.alive[hits] = False
+        self.num_alive -= len(hits)
+        return len(hits)
+
+    def stats(self) -> Dict[str, float]:
+        latencies = 1000.0 * np.array(self._latencies) if self._latencies else np.zeros(1)
+        return {
+            'size': self.num_alive,
+            'queries': self.queries,
+            'mean_latency_ms': float(latencies.mean()),
+            'p99_latency_ms': float(np.percentile(latencies, 99))
+        }
+
+    def close(self) -> None:
+        # Ссылки на общую память убираются до ее закрытия
+        self.points = self.alive = None
+        self._finalizer()
+
+
+class ShardedIndex(SearchIndex):
+    """
+    Точный поиск, разделенный между процессами.
+
+    Галерея делится на num_shards частей, каждая лежит в общей памяти и
+    обслуживается своим процессом, так что поиск занимает все ядра.
+    Запрос рассылается всем шардам, координатор сливает их top-k.
+    Новые лица сначала попадают в локальный буфер, который просматривается
+    в процессе координатора; когда в нем набирается shard_capacity лиц,
+    буфер становится новым шардом без остановки поиска.
+    """
+
+    def __init__(self, num_shards: Optional[int] = None, shard_capacity: int = 100000):
+        self.num_shards = num_shards or available_cores()
+        self.shard_capacity = shard_capacity
+        self._context = multiprocessing.get_context()
+        self._lock = threading.RLock()
+        self._shards: List[Shard] = []
+        self.clear()
+
+    @property
+    def size(self) -> int:
+        with self._lock:
+            return (sum(shard.num_alive for shard in self._shards) +
+                    int(self._delta_alive[:self._delta_count].sum()))
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            return (sum(shard.shm.size for shard in self._shards) +
+                    self._delta_points[:self._delta_count].nbytes + self._delta_count)
+
+    @property
+    def shards(self) -> List[Shard]:
+        return list(self._shards)
+
+    def clear(self) -> None:
+        with self._lock:
+            for shard in self._shards:
+                shard.close()
+            self._shards = []
+            self.dimension = 0
+            self._delta_points = np.empty((0, 0), dtype=np.float32)
+            self._delta_ids: List[str] = []
+            self._delta_alive = np.empty(0, dtype=bool)
+            self._delta_count = 0
+
+    def close(self) -> None:
+        """Останавливает процессы шардов и освобождает общую память"""
+        self.clear()
+
+    def __enter__(self) -> 'ShardedIndex':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _check_dimension(self, vectors: np.ndarray) -> None:
+        if self.dimension == 0:
+            self.dimension = vectors.shape[1]
+        elif vectors.shape[1] != self.dimension:
+            raise ValueError(f"Размерность лица {vectors.shape[1]} не совпадает "
+                             f"с размерностью индекса {self.dimension}")
+
+    def add_shard(self, vectors: np.ndarray, user_ids: List[str]) -> Shard:
+        """Запускает новый шард с переданными лицами; поиск при этом не останавливается"""
+        vectors = self._normalize(np.reshape(vectors, (len(vectors), -1)))
+        # Процесс и общая память создаются вне блокировки, подключается шард атомарно
+        shard = Shard(vectors, user_ids, self._context)
+        with self._lock:
+            self._check_dimension(vectors)
+            self._shards.append(shard)
+        return shard
+
+    def build_from_matrix(self, vectors: np.ndarray, user_ids: List[str]) -> None:
+        """Делит галерею на num_shards равных шардов"""
+        self.clear()
+        if len(vectors) == 0:
+            return
+        vectors = self._normalize(np.reshape(vectors, (len(vectors), -1)))
+        bounds = np.linspace(0, len(vectors), min(self.num_shards, len(vectors)) + 1).astype(int)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            self.add_shard(vectors[start:end], list(user_ids[start:end]))
+
+    def insert_batch(self, vectors: np.ndarray, user_ids: List[str]) -> None:
+        """Добавляет лица в буфер координатора; полный буфер становится шардом"""
+        vectors = self._normalize(np.reshape(vectors, (len(vectors), -1)))
+        if len(vectors) == 0:
+            return
+
+        with self._lock:
+            self._check_dimension(vectors)
+            needed = self._delta_count + len(vectors)
+            if needed > len(self._delta_points):
+                grown = np.empty((max(64, 2 * self._delta_count, needed), self.dimension),
+                                 dtype=np.float32)
+                if self._delta_count:
+                    grown[:self._delta_count] = self._delta_points[:self._delta_count]
+                self._delta_points = grown
+                alive = np.zeros(len(grown), dtype=bool)
+                alive[:self._delta_count] = self._delta_alive[:self._delta_count]
+                self._delta_alive = alive
+            self._delta_points[self._delta_count:needed] = vectors
+            self._delta_alive[self._delta_count:needed] = True
+            self._delta_ids.extend(user_ids)
+            self._delta_count = needed
+
+            if self._delta_count < self.shard_capacity:
+                return
+            alive = self._delta_alive[:self._delta_count]
+            points = self._delta_points[:self._delta_count][alive]
+            ids = [uid for uid, keep in zip(self._delta_ids, alive) if keep]
+            self._delta_points = np.empty((0, self.dimension), dtype=np.float32)
+            self._delta_ids = []
+            self._delta_alive = np.empty(0, dtype=bool)
+            self._delta_count = 0
+            # Шард подключается под той же блокировкой, чтобы лица не пропали из выдачи
+            self.add_shard(points, ids)
+
+    def remove(self, user_id: str) -> int:
+        with self._lock:
+            removed = sum(shard.remove(user_id) for shard in self._shards)
+            hits = [i for i, uid in enumerate(self._delta_ids)
+                    if uid == user_id and self._delta_alive[i]]
+            self._delta_alive[hits] = False
+            return removed + len(hits)
+
+    def _query_knn_batch(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Рассылает пачку запросов всем шардам, ищет в буфере и сливает top-k.
+        Возвращает матрицы (B, k) квадратов расстояний и id
+        """
+        sent = []
+        error = None
+        all_dists, all_ids = [], []
+        try:
+            for shard in self._shards:
+                shard.send(queries, k)
+                sent.append(shard)
+            # Пока шарды считают, координатор просматривает свой буфер.
+            # Позиции -1 приходятся на расстояния inf и отбрасываются при выдаче
+            if self._delta_count:
+                dists, positions = _top_k(queries, self._delta_points[:self._delta_count],
+                                          self._delta_alive[:self._delta_count], k)
+                all_dists.append(dists)
+                all_ids.append(np.array(self._delta_ids, dtype=object)[np.maximum(positions, 0)])
+        except Exception as e:
+            error = e
+        # Ответ читается у каждого шарда, которому ушел запрос, даже после ошибки:
+        # иначе он останется в канале и достанется следующему запросу
+        for shard in sent:
+            try:
+                dists, positions = shard.receive()
+            except Exception as e:
+                error = error or e
+                continue
+            all_dists.append(dists)
+            all_ids.append(shard.user_ids[np.maximum(positions, 0)])
+        if error is not None:
+            raise error
+
+        all_dists = np.concatenate(all_dists, axis=1)
+        all_ids = np.concatenate(all_ids, axis=1)
+        top = np.argpartition(all_dists, k - 1, axis=1)[:, :k]
+        top_dists = np.take_along_axis(all_dists, top, axis=1)
+        order = np.argsort(top_dists, axis=1)
+        return (np.take_along_axis(top_dists, order, axis=1),
+                np.take_along_axis(np.take_along_axis(all_ids, top, axis=1), order, axis=1))
+
+    def query_knn(self, target: np.ndarray, k: int = 5) -> List[Tuple[str, float]]:
+        return self.query_knn_batch(np.ravel(target)[None, :], k)[0]
+
+    def query_knn_batch(self, targets: np.ndarray, k: int = 5) -> List[List[Tuple[str, float]]]:
+        queries = self._normalize(np.reshape(targets, (len(targets), -1)))
+        with self._lock:
+            if self.size == 0 or k <= 0:
+                return [[] for _ in range(len(queries))]
+            dists, user_ids = self._query_knn_batch(queries, min(k, self.size))
+        return [[(user_id, float(np.sqrt(dist)))
+                 for dist, user_id in zip(row_dists, row_ids) if np.isfinite(dist)]
+                for row_dists, row_ids in zip(dists, user_ids)]
+
+    def shard_stats(self) -> List[Dict[str, float]]:
+        """Размер, число запросов и задержка поиска (средняя и p99) по каждому шарду"""
+        with self._lock:
+            return [shard.stats() for shard in self._shards]
+
+    def save(self, filepath: str) -> None:
+        with self._lock:
+            points = [np.empty((0, self.dimension), dtype=np.float32)]
+            user_ids = [np.empty(0, dtype=object)]
+            points += [shard.points[shard.alive] for shard in self._shards]
+            user_ids += [shard.user_ids[shard.alive] for shard in self._shards]
+            # Буфер, в который еще ничего не добавляли, имеет форму (0, 0)
+            if self._delta_count:
+                alive = self._delta_alive[:self._delta_count]
+                points.append(self._delta_points[:self._delta_count][alive])
+                user_ids.append(np.array(self._delta_ids, dtype=object)[alive])
+            # Через открытый файл: иначе np.savez допишет к пути расширение .npz
+            with open(filepath, 'wb') as f:
+                np.savez(f, points=np.concatenate(points),
+                         user_ids=np.concatenate(user_ids).astype(str))
+
+    def load(self, filepath: str) -> None:
+        with np.load(filepath) as data:
+            self.build_from_matrix(data['points'], data['user_ids'].tolist())
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+from typing import List, Optional
+from app.system_info import available_cores
+from app.kd_tree_benchmark import generate_embeddings
+from app.search_index import FlatIndex
+from app.sharded_search import ShardedIndex
+
+
+def benchmark_sharded_search(database_size: int = 1000000, dimension: int = 128,
+                             shard_counts: Optional[List[int]] = None,
+                             num_queries: int = 1024, batch_size: int = 32,
+                             k: int = 5) -> pd.DataFrame:
+    """
+    Пропускная способность точного поиска в зависимости от числа шардов
+    относительно одного процесса (FlatIndex), задержка поиска по шардам
+    и совпадение выдачи с точным поиском
+    """
+    cores = available_cores()
+    shard_counts = shard_counts or [n for n in (1, 2, 4, 8, 16, 32) if n <= cores]
+    rng = np.random.default_rng(42)
+    print(f"Генерация {database_size} векторов размерности {dimension}...")
+    gallery, queries = generate_embeddings(database_size, dimension, num_queries, rng)
+    user_ids = [f"user_{i}" for i in range(database_size)]
+    batches = [queries[i:i + batch_size] for i in range(0, num_queries, batch_size)]
+
+    flat = FlatIndex()
+    flat.build_from_matrix(gallery, user_ids)
+    start_time = time.time()
+    truth = [found for batch in batches for found in flat.query_knn_batch(batch, k)]
+    single_throughput = num_queries / (time.time() - start_time)
+    flat.clear()
+    print(f"Один процесс: {single_throughput:.1f} запросов/с")
+
+    results = []
+    for num_shards in shard_counts:
+        with ShardedIndex(num_shards=num_shards) as index:
+            index.build_from_matrix(gallery, user_ids)
+            index.query_knn_batch(batches[0], k)  # прогрев процессов шардов
+
+            start_time = time.time()
+            found = [row for batch in batches for row in index.query_knn_batch(batch, k)]
+            throughput = num_queries / (time.time() - start_time)
+            stats = index.shard_stats()
+
+        recall = np.mean([len({uid for uid, _ in f} & {uid for uid, _ in t}) / len(t)
+                          for f, t in zip(found, truth)])
+        result = {
+            'database_size': database_size,
+            'num_shards': num_shards,
+            'cores': cores,
+            'throughput': throughput,
+            'speedup': throughput / single_throughput,
+            'mean_shard_latency_ms': np.mean([s['mean_latency_ms'] for s in stats]),
+            'max_shard_p99_latency_ms': max(s['p99_latency_ms'] for s in stats),
+            f'recall_at_{k}': recall
+        }
+        results.append(result)
+        print(f"Шардов: {num_shards}: {throughput:.1f} запросов/с "
+              f"(ускорение {result['speedup']:.2f}x), задержка шарда на пачку "
+              f"{result['mean_shard_latency_ms']:.1f} мс, recall@{k} {recall:.3f}")
+
+    return pd.DataFrame(results)
+
+
+if __name__ == "__main__":
+    os.makedirs("results/sharded", exist_ok=True)
+    database_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    results = benchmark_sharded_search(database_size)
+    results.to_csv("results/sharded/throughput.csv", index=False)
+    print("\nРезультаты сохранены в results/sharded/throughput.csv")
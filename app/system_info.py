@@ -0,0 +1,8 @@
+import os
+
+
+def available_cores() -> int:
+    """Число ядер, доступных процессу (с учетом ограничений контейнера)"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
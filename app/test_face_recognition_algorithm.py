@@ -2,33 +2,64 @@ import os
 import time
 import numpy as np
 import pandas as pd
+import io
 import face_recognition
-from typing import List, Dict
+from typing import List, Dict, Optional
 from pathlib import Path
+from app.embedding_cache import EmbeddingCache, package_version
+
+# Имя модели в ключе кэша: face_encodings с моделью по умолчанию
+FACE_RECOGNITION_MODEL = 'face_recognition/small'
+
+
+def encode_image(image_path: str, cache: EmbeddingCache) -> Optional[np.ndarray]:
+    """Кодирует лицо на изображении, повторно используя закэшированный результат"""
+    with open(image_path, 'rb') as image_file:
+        image_bytes = image_file.read()
+
+    def compute(data: bytes):
+        encodings = face_recognition.face_encodings(
+            face_recognition.load_image_file(io.BytesIO(data)))
+        # Отсутствие лица тоже кэшируется, чтобы не искать его повторно
+        return (encodings[0] if encodings else None), {}
+
+    encoding, _ = cache.get_or_compute(image_bytes, FACE_RECOGNITION_MODEL,
+                                       package_version('face_recognition'), compute)
+    return encoding
+
 
 def benchmark_face_recognition_algorithm(database_sizes: List[int] = [10, 50, 100, 250, 500, 1000],
                                       num_queries: int = 10,
-                                      runs_per_query: int = 3) -> List[Dict]:
+                                      runs_per_query: int = 3,
+                                      cache: Optional[EmbeddingCache] = None) -> List[Dict]:
     """
-    Тестирование производительности алгоритма с использованием face_recognition
+    Тестирование производительности алгоритма с использованием face_recognition.
+    Изображения кодируются один раз на максимальный размер базы, а между
+    запусками кодировки берутся из кэша эмбеддингов
     """
     results = []
+    cache = cache or EmbeddingCache()
     
     # Создаем директории для результатов
     os.makedirs("results/face_recognition", exist_ok=True)
+
+    # Загрузка и кодирование изображений из базы данных
+    encodings_by_index = {}
+    for i in range(max(database_sizes)):
+        try:
+            encoding = encode_image(f"test_data/face_{i}.jpg", cache)
+            if encoding is None:
+                raise ValueError("лицо не найдено")
+            encodings_by_index[i] = encoding
+        except Exception as e:
+            print(f"Ошибка при обработке изображения face_{i}.jpg: {e}")
+    print(f"Кэш эмбеддингов: {cache.stats()}")
     
     for db_size in database_sizes:
         print(f"\nТестирование базы данных размером {db_size} изображений...")
         
-        # Загрузка и кодирование изображений из базы данных
-        database_encodings = []
-        for i in range(db_size):
-            try:
-                image = face_recognition.load_image_file(f"test_data/face_{i}.jpg")
-                encoding = face_recognition.face_encodings(image)[0]
-                database_encodings.append(encoding)
-            except Exception as e:
-                print(f"Ошибка при обработке изображения face_{i}.jpg: {e}")
+        database_encodings = [encodings_by_index[i] for i in range(db_size)
+                              if i in encodings_by_index]
         
         query_times = []
         
@@ -38,8 +69,9 @@ def benchmark_face_recognition_algorithm(database_sizes: List[int] = [10, 50, 10
             
             try:
                 # Загрузка тестового изображения
-                query_image = face_recognition.load_image_file(f"test_data/query_face_{q_idx}.jpg")
-                query_encoding = face_recognition.face_encodings(query_image)[0]
+                query_encoding = encode_image(f"test_data/query_face_{q_idx}.jpg", cache)
+                if query_encoding is None:
+                    raise ValueError("лицо не найдено")
                 
                 run_times = []
                 for _ in range(runs_per_query):
@@ -0,0 +1,46 @@
+import numpy as np
+from app.product_quantizer import PQIndex
+
+
+def test_save_load_small_gallery(tmp_path):
+    """Галерея меньше num_centroids сохраняется без обучения словарей и ищется точно"""
+    rng = np.random.default_rng(0)
+    vectors = rng.random((100, 32), dtype=np.float32)
+    user_ids = [f'u{i}' for i in range(100)]
+    index = PQIndex()
+    index.insert_batch(vectors, user_ids)
+    index.remove('u7')
+
+    path = tmp_path / 'pq.idx'
+    index.save(str(path))
+    assert path.exists()
+    assert not index.quantizer.is_fitted
+
+    loaded = PQIndex()
+    loaded.load(str(path))
+    assert loaded.size == 99
+    assert not loaded.quantizer.is_fitted
+    assert loaded.query_knn(vectors[42], 1)[0][0] == 'u42'
+    assert all(user_id != 'u7' for user_id, _ in loaded.query_knn(vectors[7], 5))
+
+    # Дальнейшие вставки обучают словари, как и до сохранения
+    more = rng.random((loaded.train_threshold, 32), dtype=np.float32)
+    loaded.insert_batch(more, [f'v{i}' for i in range(len(more))])
+    assert loaded.quantizer.is_fitted
+    assert loaded.size == 99 + len(more)
+
+
+def test_save_load_trained_gallery(tmp_path):
+    """Обученный индекс восстанавливает словари и коды"""
+    rng = np.random.default_rng(1)
+    vectors = rng.random((2000, 32), dtype=np.float32)
+    index = PQIndex()
+    index.build_from_matrix(vectors, [f'u{i}' for i in range(2000)])
+
+    path = tmp_path / 'pq.idx'
+    index.save(str(path))
+    loaded = PQIndex()
+    loaded.load(str(path))
+    assert loaded.size == 2000
+    assert np.array_equal(loaded.quantizer.codebooks, index.quantizer.codebooks)
+    assert loaded.query_knn(vectors[5], 1) == index.query_knn(vectors[5], 1)